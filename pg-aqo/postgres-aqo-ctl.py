@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+import argparse
+import getpass
+import json
+import math
+import os
+import sys
+import timeit
+import warnings
+from typing import Any, Dict, List, TextIO, Tuple
+
+import pandas as pd
+import psycopg2 as pg
+
+# plan archives and the workload runner helpers are shared with the utilities
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+import plan_archive  # noqa: E402
+import workload_runner  # noqa: E402
+from workload_runner import (CACHE_STATES, COMMENT_PREFIX, is_workload_query, measure, message,  # noqa: E402
+                             read_queries_for_training, read_raw_workload, select_queries_for_training, simplify_query,
+                             write_training_status)
+
+AQO_MODES = ["intelligent", "forced", "controlled", "learn", "frozen", "disabled"]
+AQO_RESET_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "postgres-aqo-reset.sql")
+
+
+class AqoQuery:
+    """Provides a number of utilities to conveniently run SQL queries on AQO instances."""
+    def __init__(self, query: str):
+        simplified = simplify_query(query)
+        self.pure_query = simplified
+        self.explain_query = "EXPLAIN (ANALYZE, FORMAT JSON) " + simplified
+
+    def query(self) -> str:
+        return self.pure_query
+
+    def explain(self) -> str:
+        return self.explain_query
+
+    def run_analyze(self, cursor: "pg.cursor") -> List[Dict[Any, Any]]:
+        cursor.execute(self.explain_query)
+        return cursor.fetchone()[0]
+
+
+class AqoCtl:
+    """Enables control of the AQO mode and of the data AQO has learned."""
+    def __init__(self, cursor: "pg.cursor"):
+        self.cursor = cursor
+
+    def mode(self, mode: str) -> None:
+        """Sets the AQO mode (one of AQO_MODES) for all following queries of the session."""
+        if mode not in AQO_MODES:
+            raise ValueError(f"Unknown AQO mode: {mode}")
+        self.cursor.execute(f"SET aqo.mode = '{mode}'")
+
+    def off(self) -> None:
+        """Disables AQO."""
+        self.mode("disabled")
+
+    def reset(self, reset_script: str = AQO_RESET_SCRIPT) -> None:
+        """Deletes everything AQO has learned so far, without restarting Postgres."""
+        with open(reset_script, "r") as script_file:
+            statements = [stmt.strip() for stmt in script_file.read().split(";")]
+        for statement in statements:
+            lines = [line for line in statement.splitlines() if not line.strip().startswith(COMMENT_PREFIX)]
+            if any(line.strip() for line in lines):
+                self.cursor.execute("\n".join(lines))
+
+
+class CacheControl(workload_runner.CacheControl):
+    """Establishes the cache state each workload query is measured in (see `workload_runner.CacheControl`).
+
+    For 'cold', the queries are executed on a new connection after the restart, which replays the session statements
+    of the workload.
+    """
+    def __init__(self, state="as-is", *, pg_connect: str = None,
+                 restart_cmd="./postgres-aqo-db-restart.sh"):
+        super().__init__(state, pg_connect=pg_connect, restart_cmd=restart_cmd)
+
+    def prepare(self, cursor: "pg.cursor", query: str, session_statements: List[str]) -> "pg.cursor":
+        """Establishes the cache state for the query, providing the cursor to execute the query with."""
+        if self.state == "warm":
+            cursor.execute("EXPLAIN (FORMAT JSON) " + simplify_query(query))
+            self.prewarm(cursor, next(entry["Plan"] for entry in cursor.fetchone()[0] if "Plan" in entry))
+        elif self.state == "cold":
+            conn = self.empty_caches()
+            conn.autocommit = True
+            cursor = conn.cursor()
+            for statement in session_statements:
+                cursor.execute(statement)
+        return cursor
+
+
+class MetricsLog(workload_runner.MetricsLog):
+    FIELDS = ["timestamp", "action", "index", "training", "aqo_mode", "t_set_ms", "t_explain_run_ms", "t_statement_ms",
+              "t_cache_ms", "t_planning_ms", "t_execution_ms", "cache_state"]
+
+
+def query_metrics(result: List[Dict[Any, Any]]) -> Dict[str, Any]:
+    """Extracts the server-side measurements from a query result."""
+    plan_entry = next((entry for entry in result if "Plan" in entry), {})
+    return {"t_planning_ms": plan_entry.get("Planning Time"), "t_execution_ms": plan_entry.get("Execution Time")}
+
+
+def execute_single_query(cursor: "pg.cursor", query: str, *, workload=True, aqo_mode="learn",
+                         timings: Dict[str, float] = None) -> Any:
+    """Runs a query in the given AQO mode.
+
+    In contrast to BAO, AQO learns from EXPLAIN ANALYZE queries as well, so each workload query is executed exactly
+    once. The result consists of an Aqo entry (mode of the run), followed by the EXPLAIN ANALYZE output.
+
+    If timings is given, the client-side wall times (in ms) of the individual steps are stored in it, using the same
+    keys as postgres-bao-ctl.py: t_set_ms for the AQO settings, t_explain_run_ms for the query run and t_statement_ms
+    for non-workload queries.
+    """
+    timings = timings if timings is not None else {}
+    if not workload:
+        with measure(timings, "t_statement_ms"):
+            cursor.execute(query)
+        return
+
+    aqo_ctl = AqoCtl(cursor)
+    aqo_query = AqoQuery(query)
+
+    with measure(timings, "t_set_ms"):
+        aqo_ctl.mode(aqo_mode)
+    with measure(timings, "t_explain_run_ms"):
+        explain_output = aqo_query.run_analyze(cursor)
+    return [{"Aqo": {"Mode": aqo_mode}}] + explain_output
+
+
+def run_workload(workload: List[Tuple[str, bool]], *, conn: "pg.connection", training_mode="learn",
+                 evaluation_mode="frozen", out: TextIO = None, metrics: MetricsLog = None,
+                 cache: CacheControl = None) -> int:
+    """Executes a given workload on the AQO instance, writing the results to out (stdout by default).
+
+    Training queries are executed in training_mode, all other queries in evaluation_mode. Each result is written as a
+    single JSON line as soon as it is available. The number of results written is returned.
+
+    If metrics are given, a record with the timings of each statement and query is written to it (see `MetricsLog`).
+
+    The cache control determines the cache state each workload query is measured in (see `CacheControl`). The state is
+    recorded in the Aqo entry of each result.
+    """
+    out = out if out else sys.stdout
+    cache = cache if cache else CacheControl()
+    n_written = 0
+    session_statements = []
+    cursor = conn.cursor()
+    for query_idx, (query, use_for_training) in enumerate(workload):
+        timings = {}
+        if not is_workload_query(query):
+            execute_single_query(cursor, query, workload=False, timings=timings)
+            session_statements.append(query)
+            if metrics:
+                metrics.log("statement", index=query_idx, **timings)
+            continue
+
+        message("Now running query", query)
+        if cache.state != "as-is":
+            with measure(timings, "t_cache_ms"):
+                cursor = cache.prepare(cursor, query, session_statements)
+        aqo_mode = training_mode if use_for_training else evaluation_mode
+        result = execute_single_query(cursor, query, aqo_mode=aqo_mode, timings=timings)
+        result[0]["Aqo"]["Training"] = bool(use_for_training)
+        result[0]["Aqo"]["Cache state"] = cache.state
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+        n_written += 1
+        if metrics:
+            metrics.log("query", index=query_idx, training=use_for_training, aqo_mode=aqo_mode,
+                        cache_state=cache.state, **timings, **query_metrics(result))
+    return n_written
+
+
+def write_runtime(args: argparse.Namespace, runtime: int) -> None:
+    action = "workload" if args.run_workload else "reset"
+    out_file = args.timing_out if args.timing_out else "aqo-ctl-timing.csv"
+    timing_df = pd.DataFrame({"action": [action], "runtime": [runtime]})
+    timing_df.to_csv(out_file, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Utility to run an SQL workload and control the AQO extension.")
+    arg_grp = parser.add_mutually_exclusive_group()
+    arg_grp.add_argument("--run-workload", action="store_true", help="Run a specific workload on the AQO/Postgres instance. Training queries are executed in the --training-mode, all others in the --evaluation-mode.")
+    arg_grp.add_argument("--reset-aqo", action="store_true", help=f"Delete everything AQO has learned so far, using the statements in {os.path.basename(AQO_RESET_SCRIPT)}. Postgres keeps running.")
+    parser.add_argument("--workload", "-w", action="store", help="File to load the workload from. Only used if --run-workload is set.")
+    parser.add_argument("--training-mode", action="store", choices=AQO_MODES, default="learn", help="AQO mode to execute the training queries in. Defaults to 'learn'.")
+    parser.add_argument("--evaluation-mode", action="store", choices=AQO_MODES, default="frozen", help="AQO mode to execute the queries in, that are not used for training. Defaults to 'frozen', i.e. AQO uses its model but does not learn anymore.")
+    parser.add_argument("--training-fraction", action="store", type=float, help="Fraction of the workload queries to be used as training data. By default, all queries will be used for training.")
+    parser.add_argument("--training-in", action="store", help="File to read which workload queries should be used for training. Has to have the same format as produced by --training-out.")
+    parser.add_argument("--training-out", action="store", help="File to document which queries were used for training.")
+    parser.add_argument("--output", "-o", action="store", help=f"File to write the workload results to (one JSON-encoded plan per line). Each result is written as soon as it is available. If the file ends with {plan_archive.ARCHIVE_SUFFIX}, the results are written as a compressed plan archive (see utils/archive-plans.py). Defaults to stdout.")
+    parser.add_argument("--pg-connect", "-c", metavar="connect", action="store", help="Custom Postgres connect string")
+    parser.add_argument("--cache-state", action="store", choices=CACHE_STATES, default="as-is", help="Cache state to measure each workload query in: 'cold' restarts Postgres and drops the OS page cache (via drop-caches.bin) before each query, 'warm' loads all relations and indexes of the query plan into the buffer cache via pg_prewarm, 'as-is' leaves the caches alone. Defaults to 'as-is'.")
+    parser.add_argument("--metrics-out", action="store", help="File to write detailed timings of each workload action to: client-side wall times of the AQO settings and of the query run, as well as server-side planning and execution times. Written as CSV if the file ends with .csv, as JSON lines otherwise.")
+    parser.add_argument("--timing", "-t", action="store_true", help="Measure the execution time of this script")
+    parser.add_argument("--timing-out", action="store", help="Write timing information to the given file")
+    parser.add_argument("--quiet", "-q", action="store_true", help="Don't write messages to stderr.", default=False)
+
+    args = parser.parse_args()
+    if not (args.run_workload or args.reset_aqo):
+        parser.error("No action given, use either --run-workload or --reset-aqo")
+    if args.run_workload and not args.workload:
+        parser.error("No workload given. Use --workload to specify the source file.")
+
+    workload_runner.QUIET = args.quiet
+
+    if args.timing:
+        start_time = timeit.default_timer()
+
+    pg_connect = args.pg_connect if args.pg_connect else "dbname=imdb user={u} host=localhost".format(u=getpass.getuser())
+    postgres = pg.connect(pg_connect)
+
+    # AQO stores its knowledge within the transaction of the query it learned from. Therefore every query has to be
+    # committed right away.
+    postgres.autocommit = True
+
+    if args.run_workload:
+        workload = read_raw_workload(args.workload)
+        if args.training_fraction and not args.training_in:
+            workload = select_queries_for_training(workload, args.training_fraction)
+        elif args.training_in:
+            if args.training_fraction:
+                warnings.warn("Ignoring --training-fraction argument since source file was specified explicitly.")
+            workload = read_queries_for_training(workload, args.training_in)
+
+        # queries without explicit annotation are used for training
+        workload = [query if type(query) == tuple else (query, True) for query in workload]
+        if args.training_out:
+            write_training_status(workload, args.training_out)
+
+        if args.output and args.output.endswith(plan_archive.ARCHIVE_SUFFIX):
+            out_file = plan_archive.PlanArchiveWriter(args.output)
+        else:
+            out_file = open(args.output, "w") if args.output else sys.stdout
+        metrics = MetricsLog(args.metrics_out) if args.metrics_out else None
+        cache = CacheControl(args.cache_state, pg_connect=pg_connect)
+        run_workload(workload, conn=postgres, training_mode=args.training_mode, evaluation_mode=args.evaluation_mode,
+                     out=out_file, metrics=metrics, cache=cache)
+        cache.close()
+
+        if metrics:
+            metrics.close()
+        if args.output:
+            out_file.close()
+    elif args.reset_aqo:
+        with postgres.cursor() as cursor:
+            AqoCtl(cursor).reset()
+    else:
+        raise ValueError("Unknown action given. This is a bug!")
+
+    postgres.close()
+
+    if args.timing:
+        end_time = timeit.default_timer()
+        runtime = math.floor((end_time - start_time) * 1000)
+        if args.timing_out:
+            write_runtime(args, runtime)
+        else:
+            print(runtime)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,64 +1,56 @@
 #!/usr/bin/env python3
 
 import argparse
-import functools
+import collections
+import concurrent.futures
 import getpass
+import glob
+import itertools
 import json
 import math
 import os
-import random
+import re
+import shutil
 import signal
+import socket
+import sqlite3
+import subprocess
 import sys
+import threading
+import time
 import timeit
 import warnings
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Dict, List, TextIO, Tuple, Union
 
 import numpy as np
 import pandas as pd
 import psycopg2 as pg
+import psycopg2.pool
 
-SELECT_QUERY_PREFIX = "select"
-EXPLAIN_QUERY_PREFIX = "explain"
-COMMENT_PREFIX = "--"
+# plan archives and the workload runner helpers are shared with the utilities
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+import plan_archive  # noqa: E402
+import workload_runner  # noqa: E402
+from workload_runner import (CACHE_STATES, TRAINING_SELECTIONS, is_workload_query, measure, message,  # noqa: E402
+                             read_queries_for_training, read_raw_workload, select_queries_for_training, simplify_query,
+                             write_training_status)
 
 BAO_NUM_ARMS = int(os.environ.get("BAO_NUM_ARMS", 5))
 
-QUIET = False
-
-
-def message(*contents: str) -> None:
-    """print for stderr."""
-    global QUIET
-
-    if QUIET:
-        return
-    print(*contents, file=sys.stderr)
-
-
-def is_workload_query(query: str) -> bool:
-    normalized = query.lower()
-    return normalized.startswith(SELECT_QUERY_PREFIX) or normalized.startswith(EXPLAIN_QUERY_PREFIX)
-
-
-def simplify_query(query: str) -> str:
-    """Deletes all leading statements of a query up to the first SELECT statement (e.g. EXPLAIN)."""
-    if not is_workload_query(query):
-        return query
-
-    select_stmt_idx = query.lower().find(SELECT_QUERY_PREFIX)
-    if select_stmt_idx >= 0:
-        return query[select_stmt_idx:]
-    else:
-        # query is already simplified
-        return query
-
 
 class BaoQuery:
-    """Provides a number of utilities to conveniently run SQL queries on BAO instances."""
-    def __init__(self, query: str):
+    """Provides a number of utilities to conveniently run SQL queries on BAO instances.
+
+    If the name of a prepared statement is given (see `PreparedStatements`), the query is run by executing that
+    statement rather than by sending the query text. If buffers is set, the analyzed plans include the buffer usage
+    (and I/O timings, if track_io_timing is enabled) of each plan node.
+    """
+    def __init__(self, query: str, *, statement: str = None, buffers=False):
         simplified = simplify_query(query)
         self.pure_query = simplified
-        self.explain_query = "EXPLAIN (ANALYZE, FORMAT JSON) " + simplified
+        self.executed_query = f"EXECUTE {statement}" if statement else simplified
+        explain_options = "ANALYZE, BUFFERS, FORMAT JSON" if buffers else "ANALYZE, FORMAT JSON"
+        self.explain_query = f"EXPLAIN ({explain_options}) " + self.executed_query
 
     def query(self) -> str:
         return self.pure_query
@@ -67,30 +59,125 @@ class BaoQuery:
         return self.explain_query
 
     def run(self, cursor: "pg.cursor") -> None:
-        cursor.execute(self.pure_query)
+        cursor.execute(self.executed_query)
 
     def run_analyze(self, cursor: "pg.cursor") -> Dict[Any, Any]:
         cursor.execute(self.explain_query)
         return cursor.fetchone()[0]
 
+    def run_explain(self, cursor: "pg.cursor") -> Dict[Any, Any]:
+        """Obtains the plan (including BAO's choice and the planning time) without executing the query."""
+        cursor.execute("EXPLAIN (SUMMARY, FORMAT JSON) " + self.executed_query)
+        return cursor.fetchone()[0]
+
+    def run_logged(self, cursor: "pg.cursor", auto_explain: "AutoExplain", explain_output: Dict[Any, Any]) -> Dict[Any, Any]:
+        """Executes the query once, obtaining the analyzed plan via auto_explain.
+
+        The result has the same structure as the output of `run_analyze`. Since auto_explain does not report the BAO
+        entry and the planning time, these are taken from the output of `run_explain`.
+        """
+        bao_entry = next((entry for entry in explain_output if "Bao" in entry), {"Bao": {}})
+        planning_time = next((entry["Planning Time"] for entry in explain_output if "Planning Time" in entry), None)
+
+        auto_explain.clear()
+        self.run(cursor)
+        logged_plan, execution_time = auto_explain.last_plan()
+        analyzed_plan = {"Plan": logged_plan["Plan"], "Planning Time": planning_time, "Execution Time": execution_time}
+        return [bao_entry, analyzed_plan]
+
+
+class AutoExplain:
+    """Captures the EXPLAIN ANALYZE plans of executed queries via the auto_explain module.
+
+    The plans are sent to the client as notices, such that no server log has to be parsed. Loading the module requires
+    superuser privileges (or auto_explain being available in $libdir/plugins).
+    """
+    NOTICE_PATTERN = re.compile(r"duration: (?P<duration>\d+(\.\d+)?) ms\s+plan:\s*(?P<plan>.*)", re.DOTALL)
+
+    def __init__(self, conn: "pg.connection", *, buffers=False):
+        self.conn = conn
+        self.buffers = buffers
+
+    def enable(self) -> None:
+        with self.conn.cursor() as cursor:
+            cursor.execute("LOAD 'auto_explain'")
+            cursor.execute("SET auto_explain.log_min_duration = 0")
+            cursor.execute("SET auto_explain.log_analyze = 'on'")
+            cursor.execute("SET auto_explain.log_timing = 'on'")
+            cursor.execute("SET auto_explain.log_format = 'json'")
+            cursor.execute("SET auto_explain.log_level = 'notice'")
+            if self.buffers:
+                cursor.execute("SET auto_explain.log_buffers = 'on'")
+
+    def clear(self) -> None:
+        del self.conn.notices[:]
+
+    def last_plan(self) -> Tuple[Dict[Any, Any], float]:
+        """Provides the plan of the last query executed since `clear`, along with its execution time in ms."""
+        for notice in reversed(self.conn.notices):
+            match = AutoExplain.NOTICE_PATTERN.search(notice)
+            if match:
+                return json.loads(match.group("plan")), float(match.group("duration"))
+        raise ValueError("No plan captured by auto_explain. Is the module available on the server?")
+
+
+def enable_io_timing(conn: "pg.connection") -> bool:
+    """Enables track_io_timing for the session, such that analyzed plans include I/O timings next to the buffer usage.
+
+    Setting the parameter requires superuser privileges (or the permission to set it). If it cannot be set, only the
+    buffer usage is captured. Since a failed statement aborts the current transaction, this has to happen before any
+    other statement of the session.
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SET track_io_timing = on")
+        return True
+    except pg.Error as e:
+        conn.rollback()
+        warnings.warn(f"Unable to enable track_io_timing, the plans will not include I/O timings: {e}")
+        return False
+
+
+class SessionSettings:
+    """Tracks the values of the settings (GUCs) of a session, such that only changed settings have to be sent.
+
+    All changed settings are sent in a single round trip. Whenever the session state is lost or modified behind the
+    back of the tracker (e.g. by a rollback or by SET statements of the workload), `invalidate` has to be called.
+    """
+    def __init__(self):
+        self.values = {}
+
+    def apply(self, cursor: "pg.cursor", **settings: Any) -> None:
+        changed = {name: str(value) for name, value in settings.items() if self.values.get(name) != str(value)}
+        if not changed:
+            return
+        cursor.execute("; ".join(f"SET {name}='{value}'" for name, value in changed.items()))
+        self.values.update(changed)
+
+    def invalidate(self) -> None:
+        self.values.clear()
+
 
 class BaoCtl:
-    """Enables control of the BAO training/planning mode."""
-    def __init__(self, cursor: "pg.cursor"):
+    """Enables control of the BAO training/planning mode.
+
+    If the settings of the session are tracked (see `SessionSettings`), only the settings that actually change are
+    sent. Otherwise, all settings are sent each time (still in a single round trip).
+    """
+    def __init__(self, cursor: "pg.cursor", settings: SessionSettings = None):
         self.cursor = cursor
+        self.settings = settings if settings else SessionSettings()
 
     def on(self, planning=True, learning=True) -> None:
         """Enables BAO according to the parameters given."""
         selection = 'on' if planning else 'off'
         rewards = 'on' if learning else 'off'
-        self.cursor.execute("SET enable_bao='on'")
-        self.cursor.execute(f"SET enable_bao_rewards='{rewards}'")
-        self.cursor.execute(f"SET enable_bao_selection='{selection}'")
-        self.cursor.execute(f"SET bao_num_arms={BAO_NUM_ARMS}")
+        self.settings.apply(self.cursor, enable_bao="on", enable_bao_rewards=rewards, enable_bao_selection=selection,
+                            bao_num_arms=BAO_NUM_ARMS)
 
     def off(self) -> None:
         """Disables BAO."""
-        self.cursor.execute("SET enable_bao='off'")
+        self.settings.apply(self.cursor, enable_bao="off")
 
     def no_selection(self) -> None:
         """Disables BAO planning (i.e. only the Postgres optimizer runs), leaving everything else on."""
@@ -101,134 +188,962 @@ class BaoCtl:
         self.on(learning=False)
 
 
-def read_raw_workload(workload: str) -> List[str]:
-    contents = []
-    with open(workload, "r") as workload_file:
-        contents = workload_file.readlines()
-
-    return [query for query in contents if not query.startswith(COMMENT_PREFIX)]
-
-
-def read_queries_for_training(workload: List[str], src: str) -> List[Tuple[str, bool]]:
-    training_df = pd.read_csv(src)
-    workload_df = pd.DataFrame({"query": workload})
-    merged_df = workload_df.merge(training_df, how="left")
-    if merged_df.training.isna().any():
-        missing_count = merged_df.training.isna().sum()
-        warnings.warn(f"Could not completely reconstruct training information. Excluding missing queries from training. {missing_count} queries affected.")
-        merged_df.training.fillna(value=False, inplace=True)
-    return list(zip(merged_df["query"], merged_df.training))
-
-
-def select_queries_for_training(workload: List[str], training_fraction: float) -> List[Tuple[str, bool]]:
-    """Chooses a fraction of the workload queries for training, annotating each query accordingly."""
-    n_queries = len(workload)
-    num_training_queries = math.ceil(training_fraction * n_queries)
-    training_idx = random.sample(range(n_queries), k=num_training_queries)
-    query_idx = np.full(n_queries, fill_value=False, dtype=bool)
-    query_idx[training_idx] = True
-    annotated_queries = zip(workload, query_idx)
-    return list(annotated_queries)
-
-
-def execute_single_query(cursor: "pg.cursor", query: str, *, workload=True, for_training=True) -> Any:
-    """Runs a query, leveraging BAO functionality."""
+class PreparedStatements:
+    """Prepares each distinct workload query once per session, such that repeated executions skip parsing.
+
+    Postgres caches the plan of prepared statements without parameters, i.e. BAO chooses the plan of a statement only
+    once. To let each model generation choose its own plans, all statements are deallocated once the generation
+    changes.
+    """
+    def __init__(self):
+        self.statements = {}
+        self.generation = None
+        self.statement_ids = itertools.count()
+
+    def prepare(self, cursor: "pg.cursor", query: str, generation: int = None) -> str:
+        """Provides the name of the prepared statement for a query, preparing it if necessary."""
+        if generation != self.generation:
+            if self.statements:
+                cursor.execute("DEALLOCATE ALL")
+                self.statements.clear()
+            self.generation = generation
+        pure_query = simplify_query(query).strip().rstrip(";")
+        if pure_query not in self.statements:
+            statement = f"bao_query_{next(self.statement_ids)}"
+            cursor.execute(f"PREPARE {statement} AS {pure_query}")
+            self.statements[pure_query] = statement
+        return self.statements[pure_query]
+
+
+TRAINING_WEIGHTS = ["none", "t_exec", "cout"]
+
+
+def training_strata(workload: List[str], labels: Dict[str, str] = None) -> List[str]:
+    """Determines the template of each query, to stratify the training selection by.
+
+    Queries with a label (e.g. 17a, see `read_baseline_labels`) belong to the template of the label (i.e. 17), all
+    other queries to the template given by their FROM clause (see `query_template`).
+    """
+    labels = labels if labels else {}
+    strata = []
+    for query in workload:
+        label = labels.get(normalize_query(query))
+        strata.append(re.sub(r"[a-z]+$", "", label) if label else query_template(query))
+    return strata
+
+
+def training_weights(workload: List[str], baseline: Dict[str, float]) -> List[float]:
+    """Weights each query by its baseline value. Queries without baseline value get the median weight."""
+    known_values = [value for value in baseline.values() if value > 0]
+    default_weight = float(np.median(known_values)) if known_values else 1.0
+    weights = [baseline.get(normalize_query(query)) for query in workload]
+    return [weight if weight and weight > 0 else default_weight for weight in weights]
+
+
+def execute_single_query(cursor: "pg.cursor", query: str, *, workload=True, for_training=True, auto_explain: AutoExplain = None,
+                         timings: Dict[str, float] = None, measured_first=False, settings: SessionSettings = None,
+                         statement: str = None, buffers=False) -> Any:
+    """Runs a query, leveraging BAO functionality.
+
+    If auto_explain is given, each workload query is executed just once and the analyzed plan is captured by
+    auto_explain. Otherwise the query is executed twice, as described below. If measured_first is set, the EXPLAIN
+    ANALYZE run happens before the run BAO learns from, such that it observes the cache state that was established
+    before the query (see `CacheControl`).
+
+    If timings is given, the client-side wall times (in ms) of the individual steps are stored in it: t_set_ms for
+    the BAO settings, t_learning_run_ms for the run BAO learns from and t_explain_run_ms for the run that obtains the
+    plan (a plain EXPLAIN in single-run mode) or t_statement_ms for non-workload queries.
+
+    The settings track the BAO settings of the session, such that unchanged settings are not sent again (see
+    `SessionSettings`). If the name of a prepared statement is given, the query is executed via that statement. If
+    buffers is set, the plan includes the buffer usage of each node (see `BaoQuery`).
+    """
+    timings = timings if timings is not None else {}
     if not workload:
-        cursor.execute(query)
+        with measure(timings, "t_statement_ms"):
+            cursor.execute(query)
         return
 
+    bao_ctl = BaoCtl(cursor, settings)
+    bao_query = BaoQuery(query, statement=statement, buffers=buffers)
+
+    if auto_explain:
+        # The plain EXPLAIN only plans the query to obtain BAO's choice. Afterwards, the query is executed exactly once
+        # with the requested learning mode.
+        with measure(timings, "t_set_ms"):
+            bao_ctl.no_learning()
+        with measure(timings, "t_explain_run_ms"):
+            explain_output = bao_query.run_explain(cursor)
+        with measure(timings, "t_set_ms"):
+            bao_ctl.on(learning=for_training)
+        with measure(timings, "t_learning_run_ms"):
+            return bao_query.run_logged(cursor, auto_explain, explain_output)
+
     # At this point, we need to run a workload query. Since BAO appears to be
     # unable to learn from EXPLAIN ANALYZE queries, but we are mainly interested
     # in the query plans, we need to execute the query twice:
     # The first execution runs the query "as is" with BAO enabled, to enable it
     # to learn from the query. The second execution is the actual EXPLAIN
     # ANALYZE RUN with learning disabled (just to be sure).
-    bao_ctl = BaoCtl(cursor)
-    bao_query = BaoQuery(query)
+    if measured_first:
+        with measure(timings, "t_set_ms"):
+            bao_ctl.no_learning()
+        with measure(timings, "t_explain_run_ms"):
+            result = bao_query.run_analyze(cursor)
 
-    bao_ctl.on(learning=for_training)
-    bao_query.run(cursor)
+    with measure(timings, "t_set_ms"):
+        bao_ctl.on(learning=for_training)
+    with measure(timings, "t_learning_run_ms"):
+        bao_query.run(cursor)
 
-    bao_ctl.no_learning()
-    return json.dumps(bao_query.run_analyze(cursor))
+    if measured_first:
+        return result
+    with measure(timings, "t_set_ms"):
+        bao_ctl.no_learning()
+    with measure(timings, "t_explain_run_ms"):
+        return bao_query.run_analyze(cursor)
 
 
 def bao_retrain():
-    global QUIET
-    quiet = "> /dev/null 2>&1" if QUIET else ""
+    quiet = "> /dev/null 2>&1" if workload_runner.QUIET else ""
     os.system(f"""cd bao/bao_server && CUDA_VISIBLE_DEVICES="" python3 baoctl.py --retrain {quiet}""")
     os.system("sync")
 
 
-def bao_reset():
-    global QUIET
-    quiet = "> /dev/null" if QUIET else ""
+class MetricsLog(workload_runner.MetricsLog):
+    FIELDS = ["timestamp", "action", "index", "client", "generation", "training", "t_set_ms", "t_learning_run_ms",
+              "t_explain_run_ms", "t_statement_ms", "t_prepare_ms", "t_cache_ms", "t_rerun_ms", "t_planning_ms", "t_execution_ms",
+              "t_retrain_ms", "background", "bao_hint", "bao_prediction", "cache_state", "timed_out", "segment",
+              "policy", "retrain", "reason", "experience", "regret"]
+
+
+def result_bao_entry(result: List[Dict[Any, Any]]) -> Dict[str, Any]:
+    """Provides the BAO entry of a query result. If the plan does not include one (e.g. EXPLAIN EXECUTE of a prepared
+    statement), an empty entry is inserted in front, such that the result keeps the structure of BAO results."""
+    if not any("Bao" in entry for entry in result):
+        result.insert(0, {"Bao": {}})
+    return next(entry["Bao"] for entry in result if "Bao" in entry)
+
+
+def query_metrics(result: List[Dict[Any, Any]]) -> Dict[str, Any]:
+    """Extracts the server-side measurements and BAO's choice from a query result."""
+    bao_entry = next((entry["Bao"] for entry in result if "Bao" in entry), {})
+    plan_entry = next((entry for entry in result if "Plan" in entry), {})
+    return {"t_planning_ms": plan_entry.get("Planning Time"), "t_execution_ms": plan_entry.get("Execution Time"),
+            "bao_hint": bao_entry.get("Bao recommended hint"), "bao_prediction": bao_entry.get("Bao prediction"),
+            "cache_state": bao_entry.get("Cache state"), "timed_out": bao_entry.get("Timed out", False)}
+
+
+class BaoTrainer:
+    """Keeps track of the BAO model generation and retrains the model, either blocking or in the background.
+
+    Each completed retraining starts a new model generation. In background mode, the training runs in a separate
+    process while queries continue to be planned by the current model. BAO itself trains into a temporary location and
+    only then swaps the new model in and notifies the server, so the switch between generations is atomic. If a retrain
+    is requested while another one is still running, it is started as soon as the current one has finished.
+    """
+    def __init__(self, *, background=False, metrics: MetricsLog = None):
+        self.background = background
+        self.generation = 0
+        self.process = None
+        self.start_time = None
+        self.pending = False
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        self.total_retrain_ms = 0
+
+    def retrain(self) -> None:
+        if not self.background:
+            timings = {}
+            with measure(timings, "t_retrain_ms"):
+                bao_retrain()
+            self.generation += 1
+            self.total_retrain_ms += timings["t_retrain_ms"]
+            if self.metrics:
+                self.metrics.log("retrain", generation=self.generation, background=False, **timings)
+            return
+
+        self.poll()
+        if self.process:
+            self.pending = True
+        else:
+            self._start()
+
+    def poll(self) -> int:
+        """Checks whether a background retraining has finished, providing the current model generation."""
+        with self.lock:
+            if self.process and self.process.poll() is not None:
+                self._finish()
+                if self.pending:
+                    self.pending = False
+                    self._start()
+            return self.generation
+
+    def wait(self) -> None:
+        """Blocks until all requested retrainings have finished."""
+        while self.process:
+            self.process.wait()
+            self.poll()
+
+    def _start(self) -> None:
+        message(f"Starting background retraining for model generation {self.generation + 1}")
+        output = subprocess.DEVNULL if workload_runner.QUIET else None
+        self.start_time = timeit.default_timer()
+        self.process = subprocess.Popen(["python3", "baoctl.py", "--retrain"], cwd="bao/bao_server",
+                                        env=dict(os.environ, CUDA_VISIBLE_DEVICES=""), stdout=output, stderr=output)
+
+    def _finish(self) -> None:
+        if self.process.returncode != 0:
+            warnings.warn(f"Background retraining failed with exit code {self.process.returncode}")
+        else:
+            self.generation += 1
+            message(f"Background retraining done, now at model generation {self.generation}")
+            retrain_time = (timeit.default_timer() - self.start_time) * 1000
+            self.total_retrain_ms += retrain_time
+            if self.metrics:
+                self.metrics.log("retrain", generation=self.generation, background=True, t_retrain_ms=retrain_time)
+        self.process = None
+        os.system("sync")
+
+
+BAO_SERVER_DIR = "bao/bao_server"
+BAO_SERVER_PID_FILE = ".bao_server.pid"
+BAO_SERVER_PORT = int(os.environ.get("BAO_SERVER_PORT", 9381))
+BAO_SNAPSHOT_DIR = "bao-snapshots"
+
+
+def bao_server_stop(timeout=30) -> None:
+    """Stops the BAO server (but not Postgres), waiting until the server process has terminated.
+
+    If the server does not terminate within the timeout, it is killed and an error is raised. This also happens if the
+    server has terminated but has not been reaped by its parent process yet (i.e. it is a zombie).
+    """
+    if not os.path.exists(BAO_SERVER_PID_FILE):
+        warnings.warn(f"{BAO_SERVER_PID_FILE} not found. Assuming that the BAO server is not running.")
+        return
+    with open(BAO_SERVER_PID_FILE, "r") as pid_file:
+        pid = int(pid_file.read().strip())
+
+    message(f".. Stopping BAO server (PID {pid})")
+    try:
+        os.kill(pid, signal.SIGINT)
+        deadline = timeit.default_timer() + timeout
+        while timeit.default_timer() < deadline:
+            os.kill(pid, 0)
+            time.sleep(0.1)
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        os.remove(BAO_SERVER_PID_FILE)
+        return
+    os.remove(BAO_SERVER_PID_FILE)
+    raise RuntimeError(f"BAO server (PID {pid}) did not terminate within {timeout} seconds and has been killed")
+
+
+def bao_server_start(timeout=30) -> None:
+    """Starts the BAO server the same way postgres-bao-start.sh does, waiting until it accepts connections."""
+    message(".. Starting BAO server")
+    # the server writes to its own copy of the file handle
+    with open("bao_server.log", "a") as log_file:
+        server = subprocess.Popen([os.path.abspath("bao/bao-venv/bin/python3"), "main.py"], cwd=BAO_SERVER_DIR,
+                                  env=dict(os.environ, CUDA_VISIBLE_DEVICES=""), stdout=log_file, stderr=subprocess.STDOUT)
+    with open(BAO_SERVER_PID_FILE, "w") as pid_file:
+        pid_file.write(f"{server.pid}\n")
+
+    deadline = timeit.default_timer() + timeout
+    while timeit.default_timer() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("BAO server terminated during startup, check bao_server.log")
+        try:
+            with socket.create_connection(("localhost", BAO_SERVER_PORT), timeout=1):
+                message(f".. BAO server started, running on PID {server.pid}")
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"BAO server did not accept connections on port {BAO_SERVER_PORT} within {timeout} seconds")
+
+
+def bao_clear_data() -> None:
+    """Deletes BAO's experience and all of its models. The BAO server must not be running."""
+    db_file = os.path.join(BAO_SERVER_DIR, "bao.db")
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    for model_dir in glob.glob(os.path.join(BAO_SERVER_DIR, "bao_*_model")):
+        shutil.rmtree(model_dir)
+
+
+def bao_reset(*, keep_postgres=False):
+    """Deletes everything BAO has learned so far.
+
+    By default, both Postgres and the BAO server are restarted. If keep_postgres is set, only the BAO server is
+    restarted, which is much faster and retains the state of the Postgres buffer cache.
+    """
+    if keep_postgres:
+        bao_server_stop()
+        bao_clear_data()
+        bao_server_start()
+        return
+
+    quiet = "> /dev/null" if workload_runner.QUIET else ""
     os.system(f"./postgres-bao-shutdown.sh {quiet}")
     os.system("rm bao/bao_server/bao.db")
     os.system("rm -rf bao/bao_server/bao_*_model")
     os.system(f"./postgres-bao-start.sh --no-env {quiet}")
 
 
-def run_workload_chunked(workload: Union[List[str], List[Tuple[str, bool]]], *, conn: "pg.connection", training_chunk_size: int) -> List[str]:
-    """Executes a given workload on the BAO instance."""
+def bao_snapshot(name: str) -> None:
+    """Stores BAO's current experience and models under the given name. The BAO server may keep running."""
+    snapshot_dir = os.path.join(BAO_SNAPSHOT_DIR, name)
+    if os.path.exists(snapshot_dir):
+        shutil.rmtree(snapshot_dir)
+    os.makedirs(snapshot_dir)
+
+    # the sqlite backup API provides a consistent copy, even if the server writes to the database at the same time
+    db_file = os.path.join(BAO_SERVER_DIR, "bao.db")
+    if os.path.exists(db_file):
+        with sqlite3.connect(db_file) as source, sqlite3.connect(os.path.join(snapshot_dir, "bao.db")) as target:
+            source.backup(target)
+    for model_dir in glob.glob(os.path.join(BAO_SERVER_DIR, "bao_*_model")):
+        shutil.copytree(model_dir, os.path.join(snapshot_dir, os.path.basename(model_dir)))
+    message(f".. Stored BAO snapshot in {snapshot_dir}")
+
+
+def bao_restore(name: str) -> None:
+    """Replaces BAO's experience and models by a snapshot. Only the BAO server is restarted, Postgres keeps running."""
+    snapshot_dir = os.path.join(BAO_SNAPSHOT_DIR, name)
+    if not os.path.isdir(snapshot_dir):
+        raise ValueError(f"No BAO snapshot named {name} in {BAO_SNAPSHOT_DIR}")
+
+    bao_server_stop()
+    bao_clear_data()
+    for entry in os.listdir(snapshot_dir):
+        source = os.path.join(snapshot_dir, entry)
+        target = os.path.join(BAO_SERVER_DIR, entry)
+        if os.path.isdir(source):
+            shutil.copytree(source, target)
+        else:
+            shutil.copy2(source, target)
+    bao_server_start()
+    message(f".. Restored BAO snapshot {name}")
+
+
+def query_template(query: str) -> str:
+    """Determines the template of a query, i.e. its FROM clause.
+
+    For JOB-like workloads, all variants of a query (e.g. 17a to 17f) join the same relations and only differ in their
+    filter predicates.
+    """
+    normalized = " ".join(simplify_query(query).lower().split())
+    match = re.search(r"\bfrom\b(?P<relations>.*?)\bwhere\b", normalized)
+    return match.group("relations").strip() if match else normalized
+
+
+class CacheControl(workload_runner.CacheControl):
+    """Establishes the cache state each workload query is measured in (see `workload_runner.CacheControl`).
+
+    For 'warm', the relations and indexes of the plan chosen by BAO are loaded. For 'cold', the session reconnects
+    after the restart.
+    """
+    def __init__(self, state="as-is", *, pg_connect: str = None, restart_cmd="./postgres-bao-db-restart.sh"):
+        super().__init__(state, pg_connect=pg_connect, restart_cmd=restart_cmd)
+
+    def prepare(self, session: "WorkloadSession", query: str) -> None:
+        if self.state == "warm":
+            BaoCtl(session.cursor, session.settings).no_learning()
+            explain_output = BaoQuery(query).run_explain(session.cursor)
+            self.prewarm(session.cursor, next(entry["Plan"] for entry in explain_output if "Plan" in entry))
+        elif self.state == "cold":
+            session.reconnect(self.empty_caches())
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(simplify_query(query).split()).lower()
+
+
+def read_baseline(baseline_file: str, column="t_exec") -> Dict[str, float]:
+    """Reads the median value (e.g. execution time) of each query from a result file, as written by calculate-cout.py."""
+    baseline_df = pd.read_csv(baseline_file, usecols=["query", column])
+    baseline_df["query"] = baseline_df["query"].map(normalize_query)
+    return baseline_df.groupby("query")[column].median().to_dict()
+
+
+def read_baseline_labels(baseline_file: str) -> Dict[str, str]:
+    """Reads the label of each query from a result file, if it has been calculated with query sources."""
+    baseline_df = pd.read_csv(baseline_file, usecols=lambda col: col in ["query", "label"])
+    if "label" not in baseline_df:
+        return {}
+    baseline_df = baseline_df.dropna()
+    return dict(zip(baseline_df["query"].map(normalize_query), baseline_df["label"].astype(str)))
+
+
+class QueryBudget:
+    """Determines the time budget (in ms) of each workload query and what happens if a query exceeds it.
+
+    The budget is either absolute (timeout), or relative to the runtime of the query on a baseline (factor). The
+    baseline runtimes are the median execution times per query of an earlier result file, as written by
+    calculate-cout.py (e.g. a run of Postgres without BAO). If both are given, the absolute budget is a lower bound of
+    the relative one and the budget of queries without baseline runtime. Without any budget, queries may run forever.
+
+    If rerun is set, timed out queries are executed once more without BAO selection, i.e. using the plan of the
+    Postgres optimizer.
+    """
+    def __init__(self, *, timeout: float = None, factor: float = None, baseline_file: str = None, rerun=False):
+        self.timeout = timeout
+        self.factor = factor
+        self.rerun = rerun
+        self.baseline = read_baseline(baseline_file) if baseline_file else {}
+
+    def for_query(self, query: str) -> Union[int, None]:
+        baseline_runtime = self.baseline.get(normalize_query(query)) if self.factor else None
+        if baseline_runtime is None:
+            return math.ceil(self.timeout) if self.timeout else None
+        return math.ceil(max(self.factor * baseline_runtime, self.timeout if self.timeout else 0))
+
+
+RETRAIN_POLICIES = ["fixed", "time", "experience", "regret", "backoff"]
+
+
+class RetrainPolicy:
+    """Decides whether the model is retrained, each time a chunk of training queries has been executed.
+
+    The policy observes all workload queries: the number of training queries since the last retraining (i.e. the new
+    experience) and, if baseline runtimes are given (see `read_baseline`), the regret of these queries, i.e. how much
+    longer they took than with the plans of the Postgres optimizer. The regret is given relative to the baseline
+    runtime of the same queries. This base policy always retrains, i.e. after every chunk.
+    """
+    name = "fixed"
+
+    def __init__(self, *, baseline: Dict[str, float] = None):
+        self.baseline = baseline if baseline else {}
+        self.n_retrains = 0
+        self.lock = threading.Lock()
+        self._reset()
+
+    def observe(self, query: str, result: List[Dict[Any, Any]], *, training: bool) -> None:
+        baseline_runtime = self.baseline.get(normalize_query(query))
+        execution_time = next((entry for entry in result if "Plan" in entry), {}).get("Execution Time")
+        with self.lock:
+            if training:
+                self.experience += 1
+            if baseline_runtime is not None and execution_time is not None:
+                self.regret_ms += execution_time - baseline_runtime
+                self.baseline_ms += baseline_runtime
+
+    def retrained(self) -> None:
+        self.n_retrains += 1
+        self._reset()
+
+    def _reset(self) -> None:
+        self.experience = 0
+        self.regret_ms = 0
+        self.baseline_ms = 0
+        self.last_retrain = timeit.default_timer()
+
+    def regret(self) -> Union[float, None]:
+        return self.regret_ms / self.baseline_ms if self.baseline_ms else None
+
+    def state(self) -> Dict[str, Any]:
+        return {"experience": self.experience, "regret": self.regret()}
+
+    def checkpoint(self) -> Dict[str, Any]:
+        """Provides everything the policy has observed so far, such that a resumed run can continue with it."""
+        with self.lock:
+            return {"n_retrains": self.n_retrains, "experience": self.experience, "regret_ms": self.regret_ms,
+                    "baseline_ms": self.baseline_ms, "since_retrain_s": timeit.default_timer() - self.last_retrain}
+
+    def restore(self, checkpoint: Dict[str, Any]) -> None:
+        """Continues from a checkpoint. The time the run was interrupted does not count towards the time since the last
+        retraining."""
+        self.n_retrains = checkpoint["n_retrains"]
+        self.experience = checkpoint["experience"]
+        self.regret_ms = checkpoint["regret_ms"]
+        self.baseline_ms = checkpoint["baseline_ms"]
+        self.last_retrain = timeit.default_timer() - checkpoint["since_retrain_s"]
+
+    def decide(self) -> Tuple[bool, str]:
+        """Provides whether to retrain now, as well as the reason."""
+        return True, f"{self.experience} new training queries"
+
+
+class TimeRetrainPolicy(RetrainPolicy):
+    """Retrains once a certain amount of time (in s) has passed since the last retraining."""
+    name = "time"
+
+    def __init__(self, interval: float, **kwargs):
+        super().__init__(**kwargs)
+        self.interval = interval
+
+    def decide(self) -> Tuple[bool, str]:
+        elapsed_time = timeit.default_timer() - self.last_retrain
+        if not self.experience:
+            return False, "no new training queries"
+        return elapsed_time >= self.interval, f"{elapsed_time:.0f}s since the last retraining (budget {self.interval:.0f}s)"
+
+
+class ExperienceRetrainPolicy(RetrainPolicy):
+    """Retrains once a certain number of training queries has been executed since the last retraining."""
+    name = "experience"
+
+    def __init__(self, n_queries: int, **kwargs):
+        super().__init__(**kwargs)
+        self.n_queries = n_queries
+
+    def decide(self) -> Tuple[bool, str]:
+        return self.experience >= self.n_queries, f"{self.experience} new training queries (budget {self.n_queries})"
+
+
+class RegretRetrainPolicy(RetrainPolicy):
+    """Retrains once the queries since the last retraining were slower than their baseline by more than the threshold,
+    e.g. 0.1 if they took 10% longer in total."""
+    name = "regret"
+
+    def __init__(self, threshold: float, **kwargs):
+        super().__init__(**kwargs)
+        self.threshold = threshold
+
+    def decide(self) -> Tuple[bool, str]:
+        regret = self.regret()
+        if not self.experience or regret is None:
+            return False, "no new training queries with baseline runtime"
+        return regret > self.threshold, f"regret of {regret:.1%} (threshold {self.threshold:.1%})"
+
+
+class BackoffRetrainPolicy(RetrainPolicy):
+    """Retrains after n_queries new training queries at first, multiplying this interval by the factor after each
+    retraining. As the model stabilizes, it is retrained less and less often."""
+    name = "backoff"
+
+    def __init__(self, n_queries: int, factor: float, **kwargs):
+        super().__init__(**kwargs)
+        self.n_queries = n_queries
+        self.factor = factor
+
+    def decide(self) -> Tuple[bool, str]:
+        interval = math.ceil(self.n_queries * self.factor ** self.n_retrains)
+        return self.experience >= interval, f"{self.experience} new training queries (interval {interval})"
+
+
+class WorkloadSession:
+    """A client that executes (a part of) the workload on its own connection.
+
+    The session keeps track of the BAO settings of its connection (see `SessionSettings`). If prepared is set, each
+    distinct workload query is prepared once and executed via its prepared statement (see `PreparedStatements`). If
+    buffers is set, the plans include the buffer usage and, where track_io_timing can be enabled, I/O timings.
+    """
+    def __init__(self, client_id: int, conn: "pg.connection", *, single_run=False, cache: CacheControl = None,
+                 budget: QueryBudget = None, prepared=False, buffers=False):
+        self.client_id = client_id
+        self.single_run = single_run
+        self.buffers = buffers
+        self.cache = cache if cache else CacheControl()
+        self.budget = budget if budget else QueryBudget()
+        self.prepared = prepared
+        self.settings = SessionSettings()
+        self.prepared_statements = None
+        self.conn = None
+        self.statements = []
+        self.latencies = []
+        self.cancelled = False
+        self.reconnect(conn)
+
+    def reconnect(self, conn: "pg.connection") -> None:
+        """Switches to a new connection, restoring the session state (i.e. all statements executed so far)."""
+        # prepared statements survive a rollback, but not a new connection
+        if self.prepared and conn is not self.conn:
+            self.prepared_statements = PreparedStatements()
+        self.conn = conn
+        if self.buffers:
+            enable_io_timing(conn)
+        self.cursor = conn.cursor()
+        self.settings.invalidate()
+        self.auto_explain = None
+        if self.single_run:
+            self.auto_explain = AutoExplain(conn, buffers=self.buffers)
+            self.auto_explain.enable()
+        for statement in self.statements:
+            self.cursor.execute(statement)
+
+    def cancel(self) -> None:
+        """Cancels the running query of the session (if any), as well as all following ones. Called from other threads,
+        e.g. on interrupt."""
+        self.cancelled = True
+        self.conn.cancel()
+
+    def recover(self) -> None:
+        """Rolls back the transaction of a cancelled query. Since this reverts all SET statements as well, the session
+        state is restored afterwards."""
+        self.conn.rollback()
+        self.reconnect(self.conn)
+
+    def execute(self, query: str, *, workload=True, for_training=True, timings: Dict[str, float] = None,
+                generation: int = None) -> Any:
+        """Executes a statement or a workload query. The generation of the current model is required for prepared
+        statements, to re-plan them with each new model."""
+        timings = timings if timings is not None else {}
+        statement = None
+        if not workload:
+            self.statements.append(query)
+            # the statement might change any setting
+            self.settings.invalidate()
+        else:
+            if self.cache.state != "as-is":
+                with measure(timings, "t_cache_ms"):
+                    self.cache.prepare(self, query)
+            if self.prepared_statements:
+                with measure(timings, "t_prepare_ms"):
+                    statement = self.prepared_statements.prepare(self.cursor, query, generation)
+
+        budget = self.budget.for_query(query) if workload else None
+        if budget:
+            self.cursor.execute(f"SET statement_timeout = {budget}")
+
+        start_time = timeit.default_timer()
+        try:
+            result = execute_single_query(self.cursor, query, workload=workload, for_training=for_training,
+                                          auto_explain=self.auto_explain, timings=timings,
+                                          measured_first=self.cache.state != "as-is", settings=self.settings,
+                                          statement=statement, buffers=self.buffers)
+        except pg.extensions.QueryCanceledError:
+            if not budget or self.cancelled:
+                raise
+            elapsed_time = (timeit.default_timer() - start_time) * 1000
+            self.recover()
+            self.cursor.execute(f"SET statement_timeout = {budget}")
+            result = self.handle_timeout(query, budget, elapsed_time, timings)
+
+        if budget:
+            self.cursor.execute("SET statement_timeout = 0")
+        if workload:
+            self.latencies.append(timeit.default_timer() - start_time)
+            result_bao_entry(result)["Cache state"] = self.cache.state
+        return result
+
+    def handle_timeout(self, query: str, budget: int, elapsed_time: float, timings: Dict[str, float]) -> Any:
+        """Provides the result of a query that exceeded its budget.
+
+        If the budget allows for a rerun, the result is the one of the rerun without BAO selection. Otherwise (or if
+        the rerun times out as well), the result consists of the plan chosen by BAO (without execution statistics)
+        and the time until the query was cancelled as execution time. In both cases, the BAO entry is marked as timed
+        out.
+        """
+        message(f"Query exceeded its budget of {budget} ms and has been cancelled")
+        bao_ctl = BaoCtl(self.cursor, self.settings)
+        bao_query = BaoQuery(query, buffers=self.buffers)
+        timeout_entry = {"Timed out": True, "Timeout": budget, "Elapsed time": elapsed_time}
+
+        result = None
+        if self.budget.rerun:
+            message("Re-running the query without BAO selection")
+            try:
+                with measure(timings, "t_rerun_ms"):
+                    bao_ctl.on(planning=False, learning=False)
+                    result = bao_query.run_analyze(self.cursor)
+                timeout_entry["Rerun without selection"] = True
+            except pg.extensions.QueryCanceledError:
+                if self.cancelled:
+                    raise
+                message("Re-run exceeded the budget as well")
+                self.recover()
+                self.cursor.execute(f"SET statement_timeout = {budget}")
+
+        if result is None:
+            bao_ctl.no_learning()
+            result = bao_query.run_explain(self.cursor)
+            next(entry for entry in result if "Plan" in entry)["Execution Time"] = elapsed_time
+
+        result_bao_entry(result).update(timeout_entry)
+        return result
+
+
+def assign_clients(segment: List[Tuple[int, str, bool]], n_clients: int, *, split="round-robin",
+                   template_clients: Dict[str, int] = None) -> List[List[Tuple[int, str, bool]]]:
+    """Distributes the workload queries of a segment among the clients, retaining their relative order.
+
+    Queries are either assigned round-robin, or by their template (see `query_template`), such that all queries of the
+    same template are executed by the same client. In the latter case, template_clients stores the assignment of the
+    templates and should be shared among all segments. Other statements (e.g. SET) are executed by all clients.
+    """
+    assignments = [[] for __ in range(n_clients)]
+    template_clients = template_clients if template_clients is not None else {}
+    n_queries = 0
+    for step in segment:
+        __, query, __ = step
+        if not is_workload_query(query):
+            for client_steps in assignments:
+                client_steps.append(step)
+            continue
+
+        if split == "template":
+            template = query_template(query)
+            if template not in template_clients:
+                template_clients[template] = min(range(n_clients), key=lambda client: len(assignments[client]))
+            client = template_clients[template]
+        else:
+            client = n_queries % n_clients
+        assignments[client].append(step)
+        n_queries += 1
+    return assignments
+
+
+def latency_stats(client: str, latencies: List[float], wall_time: float) -> Dict[str, Any]:
+    latencies_ms = np.array(latencies) * 1000
+    stats = {"client": client, "queries": len(latencies), "throughput": len(latencies) / wall_time if wall_time else np.nan,
+             "busy_time_ms": latencies_ms.sum()}
+    for name, percentile in [("p50", 50), ("p90", 90), ("p95", 95), ("p99", 99)]:
+        stats[f"latency_{name}_ms"] = np.percentile(latencies_ms, percentile) if len(latencies_ms) else np.nan
+    return stats
+
+
+def summarize_latencies(sessions: List[WorkloadSession], wall_time: float) -> pd.DataFrame:
+    """Provides throughput (queries per second) and latency percentiles of each client, as well as of all clients."""
+    stats = [latency_stats(str(session.client_id), session.latencies, wall_time) for session in sessions]
+    all_latencies = [latency for session in sessions for latency in session.latencies]
+    stats.append(latency_stats("all", all_latencies, wall_time))
+    return pd.DataFrame(stats)
+
+
+class WorkloadJournal:
+    """Progress journal of a workload run, which allows to resume the run after it has been interrupted.
+
+    The journal is a file of JSON-encoded events, one per line. Each event is flushed to disk immediately. Events may
+    carry a checkpoint of the retrain policy (see `RetrainPolicy.checkpoint`), the latest one is restored on resume.
+    """
+    def __init__(self, path: str, *, resume=False):
+        self.path = path
+        self.completed_queries = set()
+        self.completed_retrains = set()
+        self.generation = 0
+        self.policy_checkpoint = None
+
+        if resume and os.path.exists(path):
+            with open(path, "r") as journal_file:
+                for line in journal_file:
+                    # a crash may have left an incomplete last line
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if event["event"] == "query":
+                        self.completed_queries.add(event["index"])
+                    elif event["event"] == "retrain":
+                        self.completed_retrains.add(event["segment"])
+                    self.generation = max(self.generation, event.get("generation", 0))
+                    self.policy_checkpoint = event.get("policy_checkpoint", self.policy_checkpoint)
+        self.journal_file = open(path, "a" if resume else "w")
+
+    def log(self, event: str, **data: Any) -> None:
+        self.journal_file.write(json.dumps(dict(event=event, **data)) + "\n")
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+
+    def close(self) -> None:
+        self.journal_file.close()
+
+
+class ResultWriter:
+    """Writes the query results in workload order, as soon as all preceding results are available.
+
+    Each result is flushed immediately and only then recorded in the journal, such that the journal never refers to
+    results that have not been written.
+    """
+    def __init__(self, out_file: TextIO, result_indexes: List[int], journal: WorkloadJournal = None):
+        self.out_file = out_file
+        self.result_indexes = collections.deque(result_indexes)
+        self.journal = journal
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.n_written = 0
+
+    def add(self, query_idx: int, result: str, **journal_data: Any) -> None:
+        with self.lock:
+            self.pending[query_idx] = (result, journal_data)
+            while self.result_indexes and self.result_indexes[0] in self.pending:
+                next_idx = self.result_indexes.popleft()
+                next_result, next_journal_data = self.pending.pop(next_idx)
+                self.out_file.write(next_result + "\n")
+                self.out_file.flush()
+                if self.journal:
+                    os.fsync(self.out_file.fileno())
+                    self.journal.log("query", index=next_idx, **next_journal_data)
+                self.n_written += 1
+
+
+def truncate_results(path: str, n_results: int) -> None:
+    """Drops all lines from a result file that come after the first n_results lines, e.g. a partially written one."""
+    if path.endswith(plan_archive.ARCHIVE_SUFFIX):
+        plan_archive.truncate_archive(path, n_results)
+        return
+    if not os.path.exists(path):
+        return
+    with open(path, "r+") as result_file:
+        for __ in range(n_results):
+            if not result_file.readline():
+                break
+        result_file.truncate(result_file.tell())
+
+
+def run_workload_chunked(workload: Union[List[str], List[Tuple[str, bool]]], *, conn: "pg.connection", training_chunk_size: int,
+                         single_run=False, trainer: BaoTrainer = None, client_conns: List["pg.connection"] = None,
+                         split="round-robin", stats_out: str = None, out: TextIO = None,
+                         journal: WorkloadJournal = None, metrics: MetricsLog = None, cache: CacheControl = None,
+                         budget: QueryBudget = None, policy: RetrainPolicy = None, prepared=False, buffers=False) -> int:
+    """Executes a given workload on the BAO instance, writing the results to out (stdout by default).
+
+    Each result is written as soon as it (and all results of preceding queries) is available, in workload order. The
+    number of results written is returned.
+
+    If single_run is set, each workload query is executed only once (see `execute_single_query`). The trainer is
+    responsible for the retraining actions and defaults to blocking retraining. The BAO entry of each result records
+    the generation of the model that was active when the query was started.
+
+    If multiple client connections are given, the workload queries between two retraining actions are distributed among
+    them (see `assign_clients`) and executed concurrently. In this case, conn is ignored.
+
+    If a journal is given, the progress of the execution is recorded in it. Queries and retraining actions that the
+    journal already contains (i.e. from an interrupted run) are skipped.
+
+    If metrics are given, a record with the timings of each statement and query is written to it (see `MetricsLog`).
+    Retraining actions are recorded by the trainer.
+
+    The cache control determines the cache state each workload query is measured in (see `CacheControl`). The state is
+    recorded in the BAO entry of each result.
+
+    The budget limits the runtime of each workload query (see `QueryBudget`). Queries that exceed it are cancelled
+    and marked as timed out in their BAO entry, afterwards the workload continues.
+
+    If prepared is set, the workload queries are executed via prepared statements (see `PreparedStatements`). If
+    buffers is set, the plans include the buffer usage (and I/O timings) of each plan node (see `WorkloadSession`).
+
+    Between two segments, the policy decides whether the model is actually retrained (see `RetrainPolicy`). By
+    default, it is retrained between all segments. Each decision is recorded in the metrics.
+    """
 
     # when executing a workload in chunks (i.e. with retraining bao every N queries), we need to make
     # sure that the chunks do not consist of "meta-queries" (i.e. queries that modify the postgres behaviour rather
     # than EXPLAINing or SELECTing). Therefore we split the workload into segments of query chunks and segments of
     # meta statements, all while retaining the original query execution order.
     if not workload:
-        return []
+        return 0
 
     # each query should be annotated by whether it should be used for BAO training. If this not the case already,
     # we assume the missing queries to  be suited for training
     workload = list(map(lambda query: query if type(query) == tuple else (query, True), workload))
 
-    cursor = conn.cursor()
-
-    # first up, insert retraining actions into the workload
-    action_workload = []
+    trainer = trainer if trainer else BaoTrainer()
+    policy = policy if policy else RetrainPolicy()
+    completed_queries = journal.completed_queries if journal else set()
+    completed_retrains = journal.completed_retrains if journal else set()
+    if journal:
+        trainer.generation = journal.generation
+        if journal.policy_checkpoint:
+            policy.restore(journal.policy_checkpoint)
+    client_conns = client_conns if client_conns else [conn]
+    sessions = [WorkloadSession(client_id, client_conn, single_run=single_run, cache=cache, budget=budget,
+                                prepared=prepared, buffers=buffers)
+                for client_id, client_conn in enumerate(client_conns)]
+
+    # first up, split the workload into segments. The model is retrained between two segments.
+    segments = [[]]
     current_chunk_size = 0
-    for query, use_for_training in workload:
+    for query_idx, (query, use_for_training) in enumerate(workload):
 
-        # if our current chunk of training queries is full, we insert a training action
+        # if our current chunk of training queries is full, we start a new segment
         if current_chunk_size == training_chunk_size:
-            action_workload.append((False, bao_retrain))  # False indicates no specific description
+            segments.append([])
             current_chunk_size = 0
 
-        if is_workload_query(query):
-            # workload queries can potentially influence the training set and require updating of the current
-            # training chunk
-            action = functools.partial(execute_single_query, cursor, query, for_training=use_for_training)
-            action_workload.append((query, action))
+        segments[-1].append((query_idx, query, use_for_training))
 
-            # if the query should be used for training, we update the size of the training chunk
-            if use_for_training:
-                current_chunk_size += 1
-                message(f"Using query {query} for training")
-        else:
-            # non-workload queris (e.g. SET statements) are not considered as part of the training chunk
-            action_workload.append((query, functools.partial(execute_single_query, cursor, query, workload=False)))
+        # workload queries can potentially influence the training set and require updating of the current
+        # training chunk. Non-workload queris (e.g. SET statements) are not considered as part of the training chunk
+        if is_workload_query(query) and use_for_training:
+            current_chunk_size += 1
+            message(f"Using query {query} for training")
 
     # now, execute the actual workload
-    results = []
-    for description, action in action_workload:
-        if description:
-            message("Now running query", description)
-        else:
-            message("Retraining the model")
-        results.append(action())
-
-    return [res + "\n" for res in results if res is not None]
-
-
-def write_results_file(results: List[str], out: str) -> None:
-    with open(out, "w") as out_file:
-        out_file.writelines(results)
-
-
-def write_results_stdout(results: List[str]) -> None:
-    for result in results:
-        print(result, end="")
+    result_indexes = [query_idx for query_idx, (query, __) in enumerate(workload)
+                      if is_workload_query(query) and query_idx not in completed_queries]
+    result_writer = ResultWriter(out if out else sys.stdout, result_indexes, journal)
+    if completed_queries:
+        message(f"Resuming workload, skipping {len(completed_queries)} queries that have already been executed")
+
+    def run_segment(session: WorkloadSession, steps: List[Tuple[int, str, bool]]) -> None:
+        for query_idx, query, use_for_training in steps:
+            if session.cancelled:
+                return
+            timings = {}
+            if not is_workload_query(query):
+                # other statements have to be repeated, even when resuming, to restore the session state
+                session.execute(query, workload=False, timings=timings)
+                if metrics:
+                    metrics.log("statement", index=query_idx, client=session.client_id, **timings)
+                continue
+            if query_idx in completed_queries:
+                continue
+
+            message("Now running query", query)
+            model_generation = trainer.poll()
+            result = session.execute(query, for_training=use_for_training, timings=timings, generation=model_generation)
+            result_bao_entry(result)["Model generation"] = model_generation
+            if len(sessions) > 1:
+                result_bao_entry(result)["Client"] = session.client_id
+            # with multiple clients, the checkpoint may already include the observations of queries that are journaled
+            # later on, which a resumed run observes a second time
+            policy.observe(query, result, training=use_for_training)
+            result_writer.add(query_idx, json.dumps(result), generation=model_generation,
+                              policy_checkpoint=policy.checkpoint())
+            if metrics:
+                metrics.log("query", index=query_idx, client=session.client_id, generation=model_generation,
+                            training=use_for_training, **timings, **query_metrics(result))
+
+    start_time = timeit.default_timer()
+    template_clients = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(sessions)) as executor:
+        for segment_idx, segment in enumerate(segments):
+            if segment_idx > 0 and segment_idx not in completed_retrains:
+                retrain, reason = policy.decide()
+                if metrics:
+                    metrics.log("retrain_decision", segment=segment_idx, generation=trainer.generation,
+                                policy=policy.name, retrain=retrain, reason=reason, **policy.state())
+                if retrain:
+                    message(f"Retraining the model: {reason}")
+                    trainer.retrain()
+                    policy.retrained()
+                else:
+                    message(f"Not retraining the model: {reason}")
+                # skipped retrainings are recorded as well, such that a resumed run does not catch up on them
+                if journal:
+                    journal.log("retrain", segment=segment_idx, generation=trainer.generation,
+                                background=trainer.background, retrained=retrain, policy_checkpoint=policy.checkpoint())
+
+            assignments = assign_clients(segment, len(sessions), split=split, template_clients=template_clients)
+            if len(sessions) == 1:
+                run_segment(sessions[0], assignments[0])
+                continue
+
+            # all clients have to finish their part of the segment before the model may be retrained
+            segment_runs = [executor.submit(run_segment, session, steps) for session, steps in zip(sessions, assignments)]
+            try:
+                for segment_run in segment_runs:
+                    segment_run.result()
+            except BaseException:
+                # The pool only shuts down once all clients have finished their part of the segment. To not wait for
+                # them on interrupt (see `cancel_execution`) or if one of them failed, their queries are cancelled.
+                for session in sessions:
+                    session.cancel()
+                raise
+
+    trainer.wait()
+    wall_time = timeit.default_timer() - start_time
+    if len(segments) > 1:
+        message(f"Retrained the model {policy.n_retrains} times at {len(segments) - 1} decision points "
+                f"({policy.name} policy), spending {trainer.total_retrain_ms / 1000:.1f}s on training")
+
+    latencies = summarize_latencies(sessions, wall_time)
+    message("Query latencies per client:\n" + latencies.to_string(index=False))
+    if stats_out:
+        latencies.to_csv(stats_out, index=False)
+
+    return result_writer.n_written
 
 
 def write_runtime(args: argparse.Namespace, runtime: int) -> None:
@@ -238,25 +1153,52 @@ def write_runtime(args: argparse.Namespace, runtime: int) -> None:
         action = "retrain"
     elif args.reset_bao:
         action = "reset"
+    elif args.snapshot:
+        action = "snapshot"
+    elif args.restore:
+        action = "restore"
 
     out_file = args.timing_out if args.timing_out else "bao-ctl-timing.csv"
     timing_df = pd.DataFrame({"action": [action], "runtime": [runtime]})
     timing_df.to_csv(out_file, index=False)
 
 
-def write_training_status(workload: List[Tuple[str, bool]], out: str) -> None:
-    training_df = pd.DataFrame(workload, columns=["query", "training"])
-    training_df.to_csv(out, index=False)
-
-
-def cancel_execution():
-    message("Cancelling execution due to user request")
+def select_training_workload(workload: List[str], args: argparse.Namespace) -> List[Tuple[str, bool]]:
+    labels = read_baseline_labels(args.baseline) if args.baseline else {}
+    strata = training_strata(workload, labels) if args.training_selection == "stratified" else None
+    weights = None
+    if args.training_weight != "none":
+        weights = training_weights(workload, read_baseline(args.baseline, column=args.training_weight))
+    annotated_workload = select_queries_for_training(workload, args.training_fraction, strategy=args.training_selection,
+                                                     strata=strata, weights=weights, seed=args.training_seed)
+    if strata:
+        training_strata_df = pd.DataFrame({"stratum": strata, "training": [training for __, training in annotated_workload]})
+        training_strata_df = training_strata_df.loc[[is_workload_query(query) for query in workload]]
+        n_covered = training_strata_df.groupby("stratum").training.any().sum()
+        message(f"Selected {training_strata_df.training.sum()} training queries, covering {n_covered} of "
+                f"{training_strata_df.stratum.nunique()} templates")
+    return annotated_workload
+
+
+def make_retrain_policy(args: argparse.Namespace) -> RetrainPolicy:
+    baseline = read_baseline(args.baseline) if args.baseline else None
+    if args.retrain_policy == "time":
+        return TimeRetrainPolicy(args.retrain_interval, baseline=baseline)
+    elif args.retrain_policy == "experience":
+        return ExperienceRetrainPolicy(args.retrain_experience, baseline=baseline)
+    elif args.retrain_policy == "regret":
+        return RegretRetrainPolicy(args.regret_threshold, baseline=baseline)
+    elif args.retrain_policy == "backoff":
+        return BackoffRetrainPolicy(args.retrain_experience, args.backoff_factor, baseline=baseline)
+    return RetrainPolicy(baseline=baseline)
+
+
+def cancel_execution(*args):
+    message("Cancelling execution due to user request. All results so far have been written, use --resume to continue.")
     sys.exit(1)
 
 
 def main():
-    global QUIET
-
     parser = argparse.ArgumentParser(
         description="Utility to run an SQL workload and control the BAO server.")
     arg_grp = parser.add_mutually_exclusive_group()
@@ -264,30 +1206,65 @@ def main():
                          help="Run a specific workload on the BAO/Postgres instance. This enables both the learning, as well as the planning feature of BAO.")
     arg_grp.add_argument("--retrain-bao", action="store_true",
                          help="Don't run any workload, simply train the BAO model.")
-    arg_grp.add_argument("--reset-bao", action="store_true", help="Delete everything BAO has learned so far. This will restart both Postgres, as well as the BAO server.")
+    arg_grp.add_argument("--reset-bao", action="store_true", help="Delete everything BAO has learned so far. This will restart both Postgres, as well as the BAO server (see --keep-postgres).")
+    arg_grp.add_argument("--snapshot", metavar="NAME", action="store", help=f"Don't run any workload, but store BAO's current experience and models as a snapshot with the given name (in {BAO_SNAPSHOT_DIR}).")
+    arg_grp.add_argument("--restore", metavar="NAME", action="store", help="Don't run any workload, but replace BAO's experience and models by the snapshot with the given name. Only the BAO server is restarted.")
+    parser.add_argument("--keep-postgres", action="store_true", help="Only restart the BAO server (but not Postgres) to reset BAO. This is much faster and keeps the buffer cache warm. Only used if --reset-bao is set.")
     parser.add_argument("--workload", "-w", action="store",
                         help="File to load the workload from. Only used if --run-workload is set.")
     parser.add_argument("--retrain", "-r", metavar="N", action="store", type=int, default=-1,
-                        help="Retrain the BAO model every N queries. Only used if --run-workload is set.")
+                        help="Retrain the BAO model every N queries (see --retrain-policy). Only used if --run-workload is set.")
+    parser.add_argument("--retrain-policy", action="store", choices=RETRAIN_POLICIES, default="fixed", help="When to retrain the model. 'fixed' retrains every N training queries (see --retrain). All other policies are consulted every N training queries (if --retrain is not given, after every training query, or after one training query per client with --clients) and only retrain if it pays off: 'time' once --retrain-interval seconds have passed since the last retraining, 'experience' once --retrain-experience new training queries have been executed, 'regret' once the queries since the last retraining took more than --regret-threshold longer than their --baseline runtime (i.e. with the plans of the Postgres optimizer), and 'backoff' after --retrain-experience new training queries at first, multiplying this interval by --backoff-factor after each retraining. Defaults to 'fixed'.")
+    parser.add_argument("--retrain-interval", metavar="S", action="store", type=float, default=300, help="Time budget of the 'time' retraining policy in seconds. Defaults to 300.")
+    parser.add_argument("--retrain-experience", metavar="N", action="store", type=int, default=20, help="Number of new training queries that trigger a retraining for the 'experience' policy, and initial interval of the 'backoff' policy. Defaults to 20.")
+    parser.add_argument("--regret-threshold", metavar="R", action="store", type=float, default=0.1, help="Relative regret that triggers a retraining for the 'regret' policy, e.g. 0.1 if the queries took 10%% longer than their baseline. Requires --baseline. Defaults to 0.1.")
+    parser.add_argument("--backoff-factor", metavar="F", action="store", type=float, default=2, help="Factor by which the retraining interval grows after each retraining with the 'backoff' policy. Defaults to 2.")
+    parser.add_argument("--background-retrain", action="store_true", help="Retrain the BAO model in a background process while the workload keeps running on the current model. The new model is used as soon as training has finished. Only used if --retrain is set.")
     parser.add_argument("--training-fraction", action="store", type=float, help="Fraction of the workload queries to be used as training data. By default, all queries will be used for training.")
+    parser.add_argument("--training-selection", action="store", choices=TRAINING_SELECTIONS, default="uniform", help="How to select the --training-fraction of the workload: 'uniform' samples from the entire workload, 'stratified' from each query template (the label in the --baseline file without variant letter, e.g. 17 for 17a, or the FROM clause of queries without label) in proportion to its size, with at least one query per template. Defaults to 'uniform'.")
+    parser.add_argument("--training-weight", action="store", choices=TRAINING_WEIGHTS, default="none", help="Prefer expensive queries for training: each query is selected with probability proportional to its execution time ('t_exec') or C_out value ('cout') in the --baseline file. Defaults to 'none', i.e. all queries are equally likely.")
+    parser.add_argument("--training-seed", action="store", type=int, help="Seed for the training selection, to select the same training queries in each run.")
     parser.add_argument("--training-in", action="store", help="File to read which workload queries should be used for training. Has to have the same format as produced by --training-out.")
     parser.add_argument("--training-out", action="store", help="File to document which queries were used for training.")
+    parser.add_argument("--single-run", action="store_true", help="Execute each workload query only once and capture its plan via the auto_explain module, rather than running the query a second time as EXPLAIN ANALYZE. Planning time and BAO's choice are obtained from a plain EXPLAIN of the query. Requires superuser privileges to load auto_explain.")
+    parser.add_argument("--prepared", action="store_true", help="Prepare each distinct workload query once per client and run it via its prepared statement, which saves parsing the query text for repeated queries. Since Postgres caches the plans of prepared statements, BAO chooses the plan of each query only once per model generation (all statements are re-prepared after each retraining). Note that the EXPLAIN output of prepared statements may lack BAO's entry.")
+    parser.add_argument("--buffers", action="store_true", help="Capture the buffer usage (shared hits and reads, temp spills) of each plan node, i.e. run EXPLAIN (ANALYZE, BUFFERS). If the session is allowed to enable track_io_timing (usually superusers only), the plans include I/O timings as well. See utils/calculate-cout.py for the per-query totals.")
+    parser.add_argument("--clients", metavar="N", action="store", type=int, default=1, help="Number of concurrent client sessions to distribute the workload among. Queries are still retrained in chunks, i.e. all clients finish their part of a chunk before the model is retrained. Since a chunk is never larger than --retrain, small values limit the concurrency.")
+    parser.add_argument("--client-split", action="store", choices=["round-robin", "template"], default="round-robin", help="How to distribute the workload queries among the clients: 'round-robin', or by 'template' (i.e. the relations joined by the query), such that each template is executed by a single client. Defaults to 'round-robin'.")
+    parser.add_argument("--client-stats", action="store", help="File to write throughput and latency statistics per client to (CSV).")
     parser.add_argument("--output", "-o", action="store",
-                        help="File to write the workload results to.")
+                        help=f"File to write the workload results to. Each result is written as soon as it is available. If the file ends with {plan_archive.ARCHIVE_SUFFIX}, the results are written as a compressed plan archive (see utils/archive-plans.py). Additionally, the progress of the run is recorded in OUTPUT.journal and the training annotation of the workload in OUTPUT.training.csv")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted workload run, skipping all queries (and retraining actions) that have already been completed according to the journal of the --output file. The training annotation of the interrupted run is reused.")
     parser.add_argument("--pg-connect", "-c", metavar="connect", action="store", help="Custom Postgres connect string")
+    parser.add_argument("--cache-state", action="store", choices=CACHE_STATES, default="as-is", help="Cache state to measure each workload query in: 'cold' restarts Postgres and drops the OS page cache (via drop-caches.bin) before each query, 'warm' loads all relations and indexes of the query plan into the buffer cache via pg_prewarm, 'as-is' leaves the caches alone. Unless 'as-is', the EXPLAIN ANALYZE run happens before the run BAO learns from. Defaults to 'as-is'.")
+    parser.add_argument("--timeout", metavar="MS", action="store", type=float, help="Cancel workload queries (server-side) that run longer than the given number of milliseconds. Cancelled queries are marked as timed out in their result and the workload continues. If --timeout-factor is given as well, this is the minimum budget of each query.")
+    parser.add_argument("--timeout-factor", metavar="F", action="store", type=float, help="Cancel workload queries that run longer than F times their runtime on a baseline. Requires --baseline.")
+    parser.add_argument("--baseline", action="store", help="Result file (as written by calculate-cout.py, CSV) to read the baseline runtimes of the queries from, e.g. a run without BAO. Queries are matched by their text.")
+    parser.add_argument("--timeout-rerun", action="store_true", help="Re-run timed out queries without BAO selection (i.e. with the plan of the Postgres optimizer) to obtain an actual result for them. The re-run is subject to the same budget.")
+    parser.add_argument("--metrics-out", action="store", help="File to write detailed timings of each workload action to, as the workload progresses: client-side wall times of the BAO settings and of both query runs, server-side planning and execution times, retraining durations and BAO's choice. Written as CSV if the file ends with .csv, as JSON lines otherwise.")
     parser.add_argument("--timing", "-t", action="store_true", help="Measure the execution time of this script")
     parser.add_argument("--timing-out", action="store", help="Write timing information to the given file")
     parser.add_argument("--quiet", "-q", action="store_true", help="Don't write messages to stderr.", default=False)
 
     args = parser.parse_args()
-    if not (args.run_workload or args.retrain_bao or args.reset_bao):
+    if not (args.run_workload or args.retrain_bao or args.reset_bao or args.snapshot or args.restore):
         parser.error(
-            "No action given, use either --run-workload, --reset-bao, or --retrain-bao")
+            "No action given, use either --run-workload, --reset-bao, --retrain-bao, --snapshot or --restore")
     if args.run_workload and not args.workload:
         parser.error(
             "No workload given. Use --workload to specify the source file.")
-
-    QUIET = args.quiet
+    if args.resume and not args.output:
+        parser.error("Resuming a workload run requires the --output file of that run.")
+    if args.timeout_factor and not args.baseline:
+        parser.error("A relative timeout requires the --baseline runtimes.")
+    if args.training_weight != "none" and not args.baseline:
+        parser.error("Weighting the training queries requires the --baseline values.")
+    if args.retrain_policy == "regret" and not args.baseline:
+        parser.error("The regret policy requires the --baseline runtimes.")
+    if args.cache_state == "cold" and args.clients > 1:
+        parser.error("Cold runs restart Postgres before each query and therefore require a single client.")
+
+    workload_runner.QUIET = args.quiet
     signal.signal(signal.SIGINT, cancel_execution)
 
     if args.timing:
@@ -299,36 +1276,78 @@ def main():
         # connect to the Postgres instance
         pg_connect = args.pg_connect if args.pg_connect else "dbname=imdb user={u} host=localhost".format(u=getpass.getuser())
         postgres = pg.connect(pg_connect)
+        client_pool = pg.pool.ThreadedConnectionPool(args.clients, args.clients, pg_connect) if args.clients > 1 else None
+        client_conns = [client_pool.getconn() for __ in range(args.clients)] if client_pool else None
 
         # prepare the workload
         workload = read_raw_workload(args.workload)
-        if args.training_fraction and not args.training_in:
-            workload = select_queries_for_training(workload, args.training_fraction)
+        training_file = args.output + ".training.csv" if args.output else None
+        if args.resume and os.path.exists(training_file):
+            workload = read_queries_for_training(workload, training_file)
+        elif args.training_fraction and not args.training_in:
+            workload = select_training_workload(workload, args)
         elif args.training_in:
             warnings.warn("Ignoring --training-fraction argument since source file was specified explicitly.")
             workload = read_queries_for_training(workload, args.training_in)
 
-        # prepare the computation
-        chunk_size = args.retrain if args.retrain >= 0 else np.inf
-        results = []
-
-        # the actual execution
-        results = run_workload_chunked(workload, conn=postgres, training_chunk_size=chunk_size)
-
-        # store results
-        result_writer = functools.partial(write_results_file, out=args.output) if args.output else write_results_stdout
-        result_writer(results)
+        # queries without explicit annotation are used for training
+        workload = [query if type(query) == tuple else (query, True) for query in workload]
 
-        # store additional data
+        # store the training annotation right away, such that interrupted runs can be resumed with the same one
+        if training_file and not args.resume:
+            write_training_status(workload, training_file)
         if args.training_out:
             write_training_status(workload, args.training_out)
 
+        # prepare the computation
+        # adaptive policies decide after each training query, unless told otherwise. With multiple clients, they decide
+        # after one training query per client, since the clients could not run concurrently otherwise.
+        if args.retrain >= 0:
+            chunk_size = args.retrain
+        else:
+            chunk_size = np.inf if args.retrain_policy == "fixed" else args.clients
+        journal = WorkloadJournal(args.output + ".journal", resume=args.resume) if args.output else None
+        if journal and args.resume:
+            truncate_results(args.output, len(journal.completed_queries))
+        if args.output and args.output.endswith(plan_archive.ARCHIVE_SUFFIX):
+            # each result has to be on disk before the journal refers to it, so every plan gets its own block
+            out_file = plan_archive.PlanArchiveWriter(args.output, append=args.resume, durable=True)
+        else:
+            out_file = open(args.output, "a" if args.resume else "w") if args.output else sys.stdout
+
+        # the actual execution, results are written as the workload progresses
+        metrics = MetricsLog(args.metrics_out, append=args.resume) if args.metrics_out else None
+        trainer = BaoTrainer(background=args.background_retrain, metrics=metrics)
+        cache = CacheControl(args.cache_state, pg_connect=pg_connect)
+        budget = QueryBudget(timeout=args.timeout, factor=args.timeout_factor, baseline_file=args.baseline,
+                             rerun=args.timeout_rerun)
+        policy = make_retrain_policy(args)
+        run_workload_chunked(workload, conn=postgres, training_chunk_size=chunk_size, single_run=args.single_run,
+                             trainer=trainer, client_conns=client_conns, split=args.client_split,
+                             stats_out=args.client_stats, out=out_file, journal=journal, metrics=metrics,
+                             cache=cache, budget=budget, policy=policy, prepared=args.prepared,
+                             buffers=args.buffers)
+        cache.close()
+
+        if metrics:
+            metrics.close()
+
+        if args.output:
+            journal.close()
+            out_file.close()
+
         # teardown
+        if client_pool:
+            client_pool.closeall()
         postgres.close()
     elif args.retrain_bao:
         bao_retrain()
     elif args.reset_bao:
-        bao_reset()
+        bao_reset(keep_postgres=args.keep_postgres)
+    elif args.snapshot:
+        bao_snapshot(args.snapshot)
+    elif args.restore:
+        bao_restore(args.restore)
     else:
         raise ValueError("Unknown action given. This is a bug!")
 
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import pathlib
+import sys
+
+import helper
+import plan_archive
+
+
+def pack(args: argparse.Namespace) -> None:
+    calculate_cout = helper.load_script(pathlib.Path(__file__).parent / "calculate-cout.py")
+    labels = None
+    if args.queries and args.sources:
+        labels_map = calculate_cout.read_query_sources(args.sources)
+        labels = [labels_map.get(calculate_cout.normalize_query(q), "") for q in calculate_cout.read_queries(args.queries)]
+
+    # psql output contains pretty-printed plans, but archives store one plan per line
+    raw_plans = calculate_cout.read_raw_plans(args.plans, args.mode)
+    compact_plans = (json.dumps(json.loads(raw_plan)) if args.mode == "psql" else raw_plan for raw_plan in raw_plans)
+    n_plans = plan_archive.write_archive(args.archive, compact_plans, labels, block_size=args.block_size)
+    stats = plan_archive.archive_stats(args.archive)
+    print(f"Packed {n_plans} plans into {stats['blocks']} blocks ({stats['bytes']} bytes)", file=sys.stderr)
+
+
+def show(args: argparse.Namespace) -> None:
+    archive = plan_archive.PlanArchive(args.archive)
+    positions = list(args.positions)
+    if args.label:
+        positions.extend(archive.positions(args.label).tolist())
+    invalid_positions = [position for position in positions if not 0 <= position < len(archive)]
+    if invalid_positions:
+        sys.exit(f"Archive contains {len(archive)} plans, invalid positions: {invalid_positions}")
+    for raw_plan in archive.raw_plans(positions):
+        print(json.dumps(json.loads(raw_plan), indent=2) if args.pretty else raw_plan)
+
+
+def info(args: argparse.Namespace) -> None:
+    archive = plan_archive.PlanArchive(args.archive)
+    stats = plan_archive.archive_stats(args.archive)
+    print(f"{stats['plans']} plans in {stats['blocks']} blocks ({stats['bytes']} bytes)")
+    labels = archive.labels()
+    if len(labels) and labels.any():
+        for position, label in zip(archive.index["position"].tolist(), labels.tolist()):
+            print(f"{position}: {label}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Utility to create and inspect plan archives, i.e. compressed and indexed EXPLAIN ANALYZE outputs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pack_parser = subparsers.add_parser("pack", help="Create an archive from the EXPLAIN ANALYZE output of a workload run.")
+    pack_parser.add_argument("plans", action="store", help="File containing the EXPLAIN ANALYZE output ('-' for stdin)")
+    pack_parser.add_argument("archive", action="store", help=f"Name of the archive file, should end with {plan_archive.ARCHIVE_SUFFIX}")
+    pack_parser.add_argument("--mode", "-m", action="store", choices=["psql", "bao", "aqo"], default="psql", help="Format of the EXPLAIN ANALYZE output, see calculate-cout.py. Defaults to 'psql'.")
+    pack_parser.add_argument("--queries", "-q", action="store", help="File containing the actual queries. Together with --sources, this labels the plans.")
+    pack_parser.add_argument("--sources", "-s", action="store", help="Directory containing the raw query files (before merging), file names will be used as labels.")
+    pack_parser.add_argument("--block-size", action="store", type=int, default=16, help="Number of plans to compress together. Larger blocks compress better, but more data has to be decompressed to access a single plan. Defaults to 16.")
+    pack_parser.set_defaults(action=pack)
+
+    show_parser = subparsers.add_parser("show", help="Print individual plans of an archive.")
+    show_parser.add_argument("archive", action="store", help="The archive file")
+    show_parser.add_argument("positions", action="store", type=int, nargs="*", help="Positions of the plans to print (starting at 0)")
+    show_parser.add_argument("--label", "-l", action="store", help="Print all plans with the given label")
+    show_parser.add_argument("--pretty", action="store_true", help="Pretty-print the plans")
+    show_parser.set_defaults(action=show)
+
+    info_parser = subparsers.add_parser("info", help="Print the size and the labels of an archive.")
+    info_parser.add_argument("archive", action="store", help="The archive file")
+    info_parser.set_defaults(action=info)
+
+    args = parser.parse_args()
+    args.action(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,121 +1,401 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import functools
+import gzip
+import importlib.util
+import itertools
 import json
 import logging
+import operator
 import os
 import pathlib
 import re
 import string
-from typing import Any, Dict, List
+import sys
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
 
+import numpy as np
 import pandas as pd
 
+import helper
+import plan_archive
+import plan_store
 
-def read_query_plans_psql(file: str) -> List[Any]:
-    raw_plans = []
-    with open(file, "r") as query_file:
-        raw_plans = query_file.read()
-    raw_plans = raw_plans.split("QUERY PLAN")[1:]
 
-    # remove all trailing/leading whitespace from the queries and remove all
-    # occurences of double-double quotes ("") due to json/csv escaping
-    raw_plans = [qp.strip(string.whitespace + '"').replace('""', '"') for qp in raw_plans]
+QUERY_PLAN = "QUERY PLAN"
+QUERY_PLAN_END = ']"'
 
-    plans = [json.loads(qp) for qp in raw_plans]
-    return plans
 
+@contextlib.contextmanager
+def open_input(file: str):
+    """Opens an input file for reading. '-' refers to stdin, which is left open. gzip files (e.g. plan archives) are
+    decompressed on the fly."""
+    if file == "-":
+        yield sys.stdin
+        return
+    with (gzip.open(file, "rt") if str(file).endswith(".gz") else open(file, "r")) as input_file:
+        yield input_file
 
-def read_query_plans_bao(file: str) -> List[Any]:
-    raw_plans = []
-    with open(file, "r") as query_file:
-        raw_plans = query_file.readlines()
 
-    plans = []
-    for qp in raw_plans:
-        parsed_plan = json.loads(qp)
+def read_raw_plans_psql(file: str) -> Iterator[str]:
+    """Lazily extracts the JSON text of the query plans from a psql CSV dump, yielding one plan at a time.
 
-        # the first entry in the EXPLAIN ANALYZE output is the BAO output,
-        # the second entry the actual planner data.
-        # We need to merge this into a single dict
-        refactored_plan = list(parsed_plan)
-        refactored_plan[1]["Bao"] = parsed_plan[0]["Bao"]
-        del refactored_plan[0]
-        plans.append(refactored_plan)
-    return plans
+    Only the lines of the plan currently being read are kept in memory. Everything outside of the actual plans
+    (e.g. SET statements or comments psql echoed) is skipped, so the raw psql output can be read directly, without
+    running clean-query-results.py first.
+    """
+    with open_input(file) as query_file:
+        current_plan = None
+        for line in query_file:
+            if line.startswith(QUERY_PLAN):
+                current_plan = []
+                continue
+            if current_plan is None:
+                continue
 
+            current_plan.append(line)
+            if line.startswith(QUERY_PLAN_END):
+                # remove all trailing/leading whitespace from the queries and remove all
+                # occurences of double-double quotes ("") due to json/csv escaping
+                raw_plan = "".join(current_plan).strip(string.whitespace + '"').replace('""', '"')
+                current_plan = None
+                yield raw_plan
 
-class OperatorNode:
-    def __init__(self, node_type, node_description, rows_processed, child_nodes=None):
-        self.node_type = node_type
-        self.node_description = node_description
-        self.rows_processed = rows_processed
-        self.child_nodes = child_nodes if child_nodes else []
 
-    def cout(self) -> int:
-        return self.rows_processed + sum(child.cout() for child in self.child_nodes)
-
-    def __repr__(self):
-        return str(self)
-
-    def __str__(self):
-        node_description = "{node} ({rows})".format(node=self.node_type, rows=self.rows_processed)
-        if self.child_nodes:
-            node_description += " <- (" + " + ".join(str(child) for child in self.child_nodes) + ")"
-        return node_description
-
-
-def is_join_node(node_type: str) -> bool:
-    return any(join_node == node_type for join_node in ["Nested Loop", "Hash Join"])
-
-
-def parse_query_plan(plan_node: List[Any]) -> OperatorNode:
-    node_description = ""
-    if is_join_node(plan_node["Node Type"]):
-        node_description = plan_node.get("Join Filter", "")
-    elif plan_node["Node Type"].endswith("Scan"):
-        node_description = plan_node.get("Relation Name", "")
-    else:
-        logging.debug("Unkown node type: %s", plan_node["Node Type"])
-
-    rows_processed = 0
-    if is_join_node(plan_node["Node Type"]):
-        rows_processed = plan_node["Actual Rows"]
-
-    node = OperatorNode(plan_node["Node Type"], node_description, rows_processed)
-
-    node.child_nodes = [parse_query_plan(child) for child in plan_node.get("Plans", [])]
-
-    return node
-
-
-def drop_prefix(text: str, prefix: str) -> str:
-    if text.startswith(prefix):
-        return text[len(prefix):]
-    else:
-        return text
+def read_raw_plans_bao(file: str) -> Iterator[str]:
+    """Lazily reads the JSON text of the query plans from a BAO or AQO result file (one plan per line)."""
+    with open_input(file) as query_file:
+        for qp in query_file:
+            if qp.strip():
+                yield qp
+
+
+def decode_plan_psql(raw_plan: str) -> Any:
+    return json.loads(raw_plan)
+
+
+def merge_optimizer_entry(raw_plan: str, entry: str) -> Any:
+    parsed_plan = json.loads(raw_plan)
+
+    # the first entry in the EXPLAIN ANALYZE output is the output of the optimizer extension (e.g. BAO),
+    # the second entry the actual planner data.
+    # We need to merge this into a single dict
+    refactored_plan = list(parsed_plan)
+    refactored_plan[1][entry] = parsed_plan[0][entry]
+    del refactored_plan[0]
+    return refactored_plan
+
+
+def decode_plan_bao(raw_plan: str) -> Any:
+    return merge_optimizer_entry(raw_plan, "Bao")
+
+
+def decode_plan_aqo(raw_plan: str) -> Any:
+    return merge_optimizer_entry(raw_plan, "Aqo")
+
+
+PLAN_READERS = {"psql": read_raw_plans_psql, "bao": read_raw_plans_bao, "aqo": read_raw_plans_bao}
+PLAN_DECODERS = {"psql": decode_plan_psql, "bao": decode_plan_bao, "aqo": decode_plan_aqo}
+
+
+def read_raw_plans(file: str, mode: str) -> Iterator[str]:
+    """Lazily reads the JSON text of the query plans from a file in the given format, or from a plan archive."""
+    # archives always store one plan per line, regardless of the format of the plans themselves
+    if plan_archive.is_archive(file):
+        return read_raw_plans_bao(file)
+    return PLAN_READERS[mode](file)
+
+
+# Join operators whose output cardinality makes up the C_out value. Merge joins have not been included in the original
+# definition and are therefore only considered for the cout_all_joins value, to keep existing C_out values comparable.
+COUT_JOIN_NODES = ("Nested Loop", "Hash Join")
+JOIN_NODES = COUT_JOIN_NODES + ("Merge Join",)
+
+# Node types are encoded by their position in this list, everything that is unknown maps to "Other".
+NODE_TYPES = ["Other", "Aggregate", "Append", "Bitmap Heap Scan", "Bitmap Index Scan", "BitmapAnd", "BitmapOr", "CTE Scan",
+              "Gather", "Gather Merge", "Group", "Hash", "Hash Join", "Incremental Sort", "Index Only Scan", "Index Scan",
+              "Limit", "Materialize", "Memoize", "Merge Append", "Merge Join", "Nested Loop", "Result", "Seq Scan",
+              "SetOp", "Sort", "Subquery Scan", "Unique", "WindowAgg"]
+NODE_TYPE_CODES = {node_type: code for code, node_type in enumerate(NODE_TYPES)}
+
+# Buffer counters of EXPLAIN (ANALYZE, BUFFERS), in blocks. Like all EXPLAIN ANALYZE counters, they include the counters
+# of the child nodes, so the counters of the root node are the totals of the whole query.
+BUFFER_COUNTERS = {"shared_hit": "Shared Hit Blocks", "shared_read": "Shared Read Blocks",
+                   "shared_dirtied": "Shared Dirtied Blocks", "shared_written": "Shared Written Blocks",
+                   "local_hit": "Local Hit Blocks", "local_read": "Local Read Blocks",
+                   "temp_read": "Temp Read Blocks", "temp_written": "Temp Written Blocks"}
+
+# I/O timings (in ms) are only reported if track_io_timing is enabled. Postgres 17 splits the shared/local timings,
+# which older versions report as "I/O Read Time", so all of them are summed up.
+IO_TIMINGS = {"io_read_ms": ("I/O Read Time", "Shared I/O Read Time", "Local I/O Read Time", "Temp I/O Read Time"),
+              "io_write_ms": ("I/O Write Time", "Shared I/O Write Time", "Local I/O Write Time", "Temp I/O Write Time")}
+
+
+def node_io(plan_node: Dict[str, Any]) -> Dict[str, float]:
+    """Extracts the buffer counters and I/O timings of a plan node. Counters that have not been captured are omitted."""
+    io = {counter: plan_node[key] for counter, key in BUFFER_COUNTERS.items() if key in plan_node}
+    for timing, keys in IO_TIMINGS.items():
+        values = [plan_node[key] for key in keys if key in plan_node]
+        if values:
+            io[timing] = sum(values)
+    return io
+
+
+class PlanBatch:
+    """Array-backed plan nodes for a whole batch of query plans.
+
+    Each node of each plan is one entry in a number of parallel arrays. The nodes are stored in pre-order and the
+    nodes of one plan form a contiguous segment, starting at `plan_offsets[i]` for the i-th plan. This allows to
+    calculate per-plan aggregates (e.g. C_out) by segment reductions, rather than by walking each tree.
+    """
+    __slots__ = ("plan_offsets", "node_type", "parent", "actual_rows", "plan_rows", "loops", "startup_time", "total_time",
+                 "io")
+
+    def __init__(self, plans: Iterable[Dict[str, Any]]):
+        plan_offsets, node_types, parents = [], [], []
+        actual_rows, plan_rows, loops, startup_times, total_times = [], [], [], [], []
+        io = {counter: [] for counter in list(BUFFER_COUNTERS) + list(IO_TIMINGS)}
+
+        for plan in plans:
+            plan_offsets.append(len(node_types))
+            stack = [(plan, -1)]
+            while stack:
+                plan_node, parent = stack.pop()
+                node_idx = len(node_types)
+                node_types.append(NODE_TYPE_CODES.get(plan_node["Node Type"], 0))
+                parents.append(parent)
+                actual_rows.append(plan_node.get("Actual Rows", 0))
+                plan_rows.append(plan_node.get("Plan Rows", 0))
+                loops.append(plan_node.get("Actual Loops", 0))
+                startup_times.append(plan_node.get("Actual Startup Time", np.nan))
+                total_times.append(plan_node.get("Actual Total Time", np.nan))
+                node_counters = node_io(plan_node)
+                for counter, values in io.items():
+                    values.append(node_counters.get(counter, np.nan))
+
+                # children are pushed in reverse order to pop (and therefore store) them in their original order
+                stack.extend((child, node_idx) for child in reversed(plan_node.get("Plans", [])))
+
+        self.plan_offsets = np.array(plan_offsets, dtype=np.int64)
+        self.node_type = np.array(node_types, dtype=np.int16)
+        self.parent = np.array(parents, dtype=np.int64)
+        # row counts are integers for Postgres versions up to 17 and should stay integers if possible to keep the
+        # C_out values exact. Therefore, we let numpy decide on the dtype here.
+        self.actual_rows = np.array(actual_rows) if actual_rows else np.zeros(0, dtype=np.int64)
+        self.plan_rows = np.array(plan_rows) if plan_rows else np.zeros(0, dtype=np.int64)
+        self.loops = np.array(loops, dtype=np.int64)
+        self.startup_time = np.array(startup_times, dtype=np.float64)
+        self.total_time = np.array(total_times, dtype=np.float64)
+        # counters that have not been captured (e.g. without BUFFERS or track_io_timing) are NaN
+        self.io = {counter: np.array(values, dtype=np.float64) for counter, values in io.items()}
+
+    def __len__(self) -> int:
+        return len(self.plan_offsets)
+
+    def is_node(self, node_types: Iterable[str]) -> np.ndarray:
+        """Provides a mask of all nodes that have one of the given node types."""
+        codes = [NODE_TYPE_CODES[node_type] for node_type in node_types]
+        return np.isin(self.node_type, codes)
+
+    def segment_sum(self, values: np.ndarray) -> np.ndarray:
+        """Sums the per-node values for each plan."""
+        if not len(self):
+            return np.zeros(0, dtype=values.dtype)
+        return np.add.reduceat(values, self.plan_offsets)
+
+    def segment_max(self, values: np.ndarray) -> np.ndarray:
+        """Determines the maximum of the per-node values for each plan."""
+        if not len(self):
+            return np.zeros(0, dtype=values.dtype)
+        return np.maximum.reduceat(values, self.plan_offsets)
+
+    def cout(self, join_nodes: Iterable[str] = COUT_JOIN_NODES) -> np.ndarray:
+        """Calculates the C_out value of each plan, i.e. the sum of all rows produced by its join nodes."""
+        join_rows = np.where(self.is_node(join_nodes), self.actual_rows, 0)
+        return self.segment_sum(join_rows)
+
+    def node_counts(self, node_types: Iterable[str] = None) -> np.ndarray:
+        """Counts the nodes (of the given types, or all nodes by default) of each plan."""
+        mask = self.is_node(node_types) if node_types else np.ones(len(self.node_type), dtype=bool)
+        return self.segment_sum(mask.astype(np.int64))
+
+    def io_totals(self) -> Dict[str, np.ndarray]:
+        """Provides the buffer counters and I/O timings of each plan as a whole, i.e. the ones of its root node."""
+        return {counter: values[self.plan_offsets] for counter, values in self.io.items()}
+
+    def exclusive(self, values: np.ndarray) -> np.ndarray:
+        """Subtracts the values of the children from the value of each node, e.g. to attribute inclusive counters to
+        the individual operators."""
+        children = self.parent >= 0
+        child_totals = np.zeros(len(values), dtype=values.dtype)
+        np.add.at(child_totals, self.parent[children], values[children])
+        return values - child_totals
+
+    def operator_io(self) -> Dict[str, np.ndarray]:
+        """Provides the buffer counters and I/O timings of each node on its own, i.e. without the ones of its
+        children. Nodes with counters that have not been captured (for the node or one of its children) are NaN."""
+        return {counter: self.exclusive(values) for counter, values in self.io.items()}
+
+
+# EXPLAIN prefix of the queries in a query batch, regardless of its options (e.g. BUFFERS)
+EXPLAIN_PREFIX = re.compile(r"^explain\s*\([^)]*\)\s*", re.IGNORECASE)
+
+
+def is_workload_query(query: str) -> bool:
+    normalized = query.lower()
+    return normalized.startswith("select") or normalized.startswith("explain")
 
 
 def read_queries(file: str) -> List[str]:
-    queries = []
-    with open(file, "r") as query_file:
-        queries = query_file.readlines()
-        queries = [drop_prefix(q, "explain (analyze, format json) ") for q in queries]
-    return queries
+    """Reads the workload queries (one per line) from a query batch.
+
+    All other lines (e.g. comments or SET statements) are skipped, so the batch does not have to be cleaned by
+    clean-query-batches.py first.
+    """
+    with open_input(file) as query_file:
+        return [EXPLAIN_PREFIX.sub("", q, count=1) for q in query_file if is_workload_query(q)]
+
+
+# The I/O totals are NaN (empty in CSV files) for plans without the respective counters, to tell them apart from plans
+# without any I/O.
+IO_COLUMNS = ["shared_hit", "shared_read", "shared_written", "temp_read", "temp_written", "io_read_ms", "io_write_ms"]
+RESULT_COLUMNS = ["query", "cout", "plan", "t_exec", "t_plan", "cout_all_joins", "fingerprint"] + IO_COLUMNS
+
+
+def io_value(value: float, counter: str) -> Any:
+    """Keeps captured block counts as integers. Counters that have not been captured stay NaN."""
+    if np.isnan(value) or counter not in BUFFER_COUNTERS:
+        return value
+    return int(value)
+
+
+def analyze_plans(query_plans: List[Any]) -> List[List[Any]]:
+    """Computes the per-plan metrics (i.e. the RESULT_COLUMNS without the query) for a batch of decoded plans."""
+    plan_batch = PlanBatch(qp[0]["Plan"] for qp in query_plans)
+    cout_values = plan_batch.cout().tolist()
+    cout_all_joins_values = plan_batch.cout(JOIN_NODES).tolist()
+    io_totals = plan_batch.io_totals()
+    io_values = zip(*([io_value(value, counter) for value in io_totals[counter].tolist()] for counter in IO_COLUMNS))
+    return [[cout, json.dumps(qp), qp[0]["Execution Time"], qp[0]["Planning Time"], cout_all_joins,
+             plan_store.plan_fingerprint(qp[0]["Plan"]), *io]
+            for qp, cout, cout_all_joins, io in zip(query_plans, cout_values, cout_all_joins_values, io_values)]
+
+
+def analyze_raw_plans(task: Tuple[int, str, List[str]]) -> Tuple[int, List[List[Any]]]:
+    """Decodes and analyzes a batch of raw plans. This is the unit of work that is distributed among worker processes.
+
+    The task consists of an identifier of the batch source (which is passed through unchanged), the plan format (see
+    PLAN_DECODERS) and the raw plans themselves.
+    """
+    source, mode, raw_plans = task
+    decoder = PLAN_DECODERS[mode]
+    return source, analyze_plans([decoder(raw_plan) for raw_plan in raw_plans])
+
+
+def batched(iterable: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, size))
+
+
+def ordered_map(func: Callable[[Any], Any], tasks: Iterable[Any], *, executor: concurrent.futures.Executor = None, window=1) -> Iterator[Any]:
+    """Lazily applies func to all tasks, yielding the results in the same order as the tasks.
+
+    If an executor is given, at most `window` tasks are submitted to it at the same time. Contrary to `Executor.map`
+    this keeps the tasks iterator lazy, such that arbitrarily large inputs can be processed with bounded memory.
+    """
+    if not executor:
+        yield from map(func, tasks)
+        return
+
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, task))
+    while pending:
+        yield pending.popleft().result()
+
+
+def assemble_rows(queries: Iterable[str], plan_metrics: Iterable[List[Any]], source_labels: Iterable[str] = None) -> Iterator[List[Any]]:
+    """Combines the queries with the metrics of their plans (as produced by `analyze_plans`) and optionally the labels."""
+    labels = iter(source_labels) if source_labels else itertools.repeat(None)
+    for query, metrics in itertools.zip_longest(queries, plan_metrics):
+        if query is None or metrics is None:
+            raise ValueError("Number of queries does not match the number of query plans")
+        label = next(labels)
+        row = [query] + metrics
+        if label is not None:
+            row.append(label)
+        yield row
+
+
+def write_csv(rows: Iterable[List[Any]], out: str, *, labelled=False) -> int:
+    """Writes the result rows to a CSV file as they are generated, returning the number of rows written.
+
+    The output is equivalent to writing a data frame of the rows via `to_csv(index=False)`.
+    """
+    columns = RESULT_COLUMNS + ["label"] if labelled else RESULT_COLUMNS
+    n_rows = 0
+    with open(out, "w", newline="") as out_file:
+        writer = csv.writer(out_file, lineterminator="\n")
+        writer.writerow(columns)
+        for row in rows:
+            # missing I/O totals are written as empty fields, the same way pandas writes NaN values
+            writer.writerow(["" if isinstance(value, float) and np.isnan(value) else value for value in row])
+            n_rows += 1
+    return n_rows
+
+
+def write_columnar(rows: Iterable[List[Any]], out: str, *, labelled=False, file_format="parquet") -> int:
+    """Writes the result rows to a columnar file, returning the number of rows written.
+
+    The file only contains the scalar columns, each with its own type. The plans are streamed to a separate, compressed
+    archive as they are generated (see `helper.plans_file`). Supported formats are 'parquet' and 'npz'.
+    """
+    columns = RESULT_COLUMNS + ["label"] if labelled else RESULT_COLUMNS
+    plan_idx = columns.index("plan")
+    scalar_columns = [col for col in columns if col != "plan"]
+    scalar_values = {col: [] for col in scalar_columns}
+
+    n_rows = 0
+    label_idx = columns.index("label") if labelled else None
+    with plan_archive.PlanArchiveWriter(helper.plans_file(out)) as plans_file:
+        for row in rows:
+            plans_file.add(row[plan_idx], label=row[label_idx] if labelled else "")
+            for col, value in zip(columns, row):
+                if col != "plan":
+                    scalar_values[col].append(value)
+            n_rows += 1
+
+    df = pd.DataFrame(scalar_values, columns=scalar_columns)
+    # the I/O totals mix block counts and NaN (if not captured), which has to end up as a numeric column either way
+    df[IO_COLUMNS] = df[IO_COLUMNS].astype(np.float64)
+    if file_format == "parquet":
+        df.to_parquet(out, index=False)
+    elif file_format == "npz":
+        # text columns have to be stored as unicode arrays, otherwise numpy would need to pickle them
+        np.savez_compressed(out, **{col: df[col].to_numpy(dtype=str) if df[col].dtype.kind == "O" else df[col].to_numpy()
+                                    for col in scalar_columns})
+    else:
+        raise ValueError("Unknown file format: " + file_format)
+    return n_rows
 
 
-def generate_dataframe(queries: List[str], operator_trees: List[OperatorNode], query_plans: List[Any], source_labels: Dict[str, str]) -> pd.DataFrame:
-    cout_values = [opt.cout() for opt in operator_trees]
-    serialized_plans = [json.dumps(qp) for qp in query_plans]
-    exec_times = [qp[0]["Execution Time"] for qp in query_plans]
-    plan_times = [qp[0]["Planning Time"] for qp in query_plans]
+def parquet_available() -> bool:
+    return any(importlib.util.find_spec(engine) for engine in ["pyarrow", "fastparquet"])
 
-    columns = {"query": queries, "cout": cout_values, "plan": serialized_plans, "t_exec": exec_times, "t_plan": plan_times}
-    if source_labels:
-        columns["label"] = source_labels
 
-    df = pd.DataFrame(columns)
-    return df
+RESULT_WRITERS = {"csv": write_csv,
+                  "parquet": functools.partial(write_columnar, file_format="parquet"),
+                  "npz": functools.partial(write_columnar, file_format="npz")}
 
 
 def normalize_query(query: str) -> str:
@@ -139,16 +419,54 @@ def read_query_sources(source_dir: str, query_pattern="") -> Dict[str, str]:
     return contents
 
 
+def result_file_name(plans_file: str, out_dir: str, file_format="csv") -> str:
+    """Derives the name of the result file for a plans file, e.g. job-run1.out becomes job-run1-cout.csv."""
+    name = pathlib.Path(plans_file).name
+    stem = name[:-len(plan_archive.ARCHIVE_SUFFIX)] if name.endswith(plan_archive.ARCHIVE_SUFFIX) else pathlib.Path(name).stem
+    return str(pathlib.Path(out_dir) / (stem + "-cout." + file_format))
+
+
+def analyze_files(plan_files: List[str], out_files: List[str], queries: List[str], source_labels: List[str] = None, *,
+                  mode="psql", jobs=1, batch_size=64, file_format="csv") -> None:
+    """Calculates the results for a number of plan files (each obtained by running the same queries).
+
+    If jobs > 1, decoding and analyzing the plans is distributed among that many worker processes. All files are
+    pushed through the same pool, such that it stays busy across file boundaries. The rows are still written in the
+    order of the plans, which is the order of the queries.
+    """
+    tasks = ((source, mode, raw_plans) for source, plans_file in enumerate(plan_files)
+             for raw_plans in batched(read_raw_plans(plans_file, mode), batch_size))
+
+    with contextlib.ExitStack() as stack:
+        executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=jobs)) if jobs > 1 else None
+        analyzed_batches = ordered_map(analyze_raw_plans, tasks, executor=executor, window=4 * jobs)
+
+        written_files = set()
+        for source, batches in itertools.groupby(analyzed_batches, key=operator.itemgetter(0)):
+            plan_metrics = itertools.chain.from_iterable(batch for __, batch in batches)
+            n_rows = RESULT_WRITERS[file_format](assemble_rows(queries, plan_metrics, source_labels), out_files[source],
+                                                 labelled=bool(source_labels))
+            written_files.add(source)
+            logging.info("Wrote %d rows to %s", n_rows, out_files[source])
+
+    for source, plans_file in enumerate(plan_files):
+        if source not in written_files:
+            raise ValueError(f"No query plans found in {plans_file}")
+
+
 def main():
     logging.captureWarnings(True)
     logging.basicConfig(format="%(asctime)s : %(message)s", level=logging.INFO)
 
     parser = argparse.ArgumentParser(description="Utility to calculate C_out values from batches of EXPLAIN ANALYZE queries")
-    parser.add_argument("--plans", "-p", action="store", help="File containing the EXPLAIN ANALYZE output", required=True)
+    parser.add_argument("--plans", "-p", action="store", nargs="+", help="File(s) containing the EXPLAIN ANALYZE output, either as written by psql/the workload runners (possibly gzip-compressed) or as plan archive (.plans.gz). All files have to be obtained from the same queries file. Use '-' to read a single batch from stdin, e.g. straight from psql.", required=True)
     parser.add_argument("--queries", "-q", action="store", help="File containing the actual queries. Tries to read COUT_QUERIES environment variable if not specified.")
-    parser.add_argument("--out", "-o", action="store", help="Name of the output csv file", required=True)
+    parser.add_argument("--out", "-o", action="store", help="Name of the output csv file. If multiple plan files are given, this is the directory to write the result files to, which will be named after the plan files (e.g. run1.out becomes run1-cout.csv).", required=True)
     parser.add_argument("--sources", "-s", action="store", help="Directory containing the raw query files (before merging), file names will be used as labels.  Tries to read COUT_SOURCES environment variable if not specified.", required=False, default="")
-    parser.add_argument("--mode", "-m", action="store", choices=["psql", "bao"], default="psql", help="Description of the EXPLAIN ANALYZE format. 'psql' indicates that the results were obtained directly from psql, using CSV output, which makes a lot of cleanup necessary. If set to 'bao', the output was obtained from a BAO instance directly via the psycopg2 interface, resulting in a different cleanup. Defaults to 'psql'.")
+    parser.add_argument("--mode", "-m", action="store", choices=["psql", "bao", "aqo"], default="psql", help="Description of the EXPLAIN ANALYZE format. 'psql' indicates that the results were obtained directly from psql, using CSV output, which makes a lot of cleanup necessary. If set to 'bao', the output was obtained from a BAO instance directly via the psycopg2 interface, resulting in a different cleanup. 'aqo' is the same for results of postgres-aqo-ctl.py. Defaults to 'psql'.")
+    parser.add_argument("--format", "-f", action="store", choices=list(RESULT_WRITERS), default="csv", help="Format of the output file. 'csv' embeds the JSON-encoded plans into the file. The columnar formats 'parquet' and 'npz' (compressed numpy arrays) store only the metrics in typed columns and write the plans to a separate compressed file next to it. If no Parquet engine is available, 'parquet' falls back to 'npz'. Defaults to 'csv'.")
+    parser.add_argument("--jobs", "-j", action="store", type=int, default=1, help="Number of worker processes to decode and analyze the plans with. Defaults to 1, i.e. no parallelism.")
+    parser.add_argument("--batch-size", action="store", type=int, default=64, help="Number of plans to analyze at once. This is also the unit of work sent to the worker processes if --jobs is larger than 1.")
 
     args = parser.parse_args()
 
@@ -160,8 +478,8 @@ def main():
     if not queries_file:
         parser.error("Queries file not specified. Either add --queries or set the COUT_QUERIES environment variable.")
 
-    plans = read_query_plans_psql(args.plans) if args.mode == "psql" else read_query_plans_bao(args.plans)
-    operator_trees = [parse_query_plan(p[0]["Plan"]) for p in plans]
+    if "-" in args.plans and len(args.plans) > 1:
+        parser.error("Plans can only be read from stdin for a single batch.")
 
     queries = read_queries(queries_file)
 
@@ -175,8 +493,24 @@ def main():
         labels_map = read_query_sources(sources_dir)
         sources = [labels_map.get(normalize_query(q), "") for q in queries]
 
-    df = generate_dataframe(queries, operator_trees, plans, sources)
-    df.to_csv(args.out, index=False)
+    file_format = args.format
+    if file_format == "parquet" and not parquet_available():
+        logging.warning("No Parquet engine (pyarrow or fastparquet) found, writing npz files instead")
+        file_format = "npz"
+
+    if len(args.plans) > 1:
+        os.makedirs(args.out, exist_ok=True)
+        out_files = [result_file_name(plans_file, args.out, file_format) for plans_file in args.plans]
+    elif file_format != "csv":
+        # columnar files are recognized by their suffix, so we enforce it here
+        out_files = [str(pathlib.Path(args.out).with_suffix("." + file_format))]
+    else:
+        out_files = [args.out]
+
+    # plans are streamed from the input files straight into the output files, such that only the plans that are
+    # currently being processed have to be kept in memory
+    analyze_files(args.plans, out_files, queries, sources, mode=args.mode, jobs=args.jobs, batch_size=args.batch_size,
+                  file_format=file_format)
 
 
 if __name__ == "__main__":
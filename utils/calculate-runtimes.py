@@ -1,31 +1,77 @@
 #!/usr/bin/env python3
 
 import argparse
-import json
 import pathlib
 
 import pandas as pd
 
+import helper
 
-def read_batch(file: str) -> "pd.DataFrame":
-    df = pd.read_csv(file)
-    df.plan = df.plan.apply(json.loads)
-    return df
+
+def read_runtimes(file: str) -> "pd.Series":
+    return helper.read_results(file, columns=["t_exec"]).t_exec
+
+
+def find_result_files(directory: str, prefix: str):
+    return sorted(file for file in pathlib.Path(directory).glob(f"{prefix}*-cout.*")
+                  if file.suffix in helper.RESULT_SUFFIXES)
+
+
+def prepare_runs(files, args: argparse.Namespace) -> "pd.DataFrame":
+    """Reads the runs of a configuration, dropping the warm-up executions and (if requested) the outliers."""
+    runs_df = helper.read_runs(files, key=args.key, columns=[args.column])
+    runs_df = helper.discard_warmup(runs_df, args.warmup)
+    runs_df = helper.flag_outliers(runs_df, key=args.key, column=args.column, k=args.outlier_k)
+    print(f"{len(files)} runs, {runs_df.outlier.sum()} outliers")
+    return runs_df.loc[~runs_df.outlier] if args.drop_outliers else runs_df
 
 
 def main():
     parser = argparse.ArgumentParser(description="Utility to quickly calculate SQL batch runtimes.")
-    parser.add_argument("--dir", "-d", action="store", help="Directory containing the batch result CSV files")
+    parser.add_argument("--dir", "-d", action="store", help="Directory containing the batch result files (CSV, Parquet or npz)")
     parser.add_argument("--file-prefix", "-p", action="store", help="File name pattern (suffix) for the result files. All matching files will be included.")
     parser.add_argument("--separator", "-s", action="store", default=": ", help="Output separator between file name and runtime")
+    parser.add_argument("--stats", action="store_true", help="Rather than printing the runtime of each file, treat all matching files as repeated runs of the same workload and print statistics of the workload runtime (median, percentiles and bootstrap confidence interval).")
+    parser.add_argument("--compare-prefix", action="store", help="File name pattern of the runs of a second configuration to compare the first one against, using a Mann-Whitney U test per query and for the entire workload. Implies --stats.")
+    parser.add_argument("--column", action="store", default="t_exec", help="Result column to analyze. Defaults to t_exec.")
+    parser.add_argument("--key", action="store", default="query", help="Result column which identifies the queries across runs. Defaults to query.")
+    parser.add_argument("--warmup", action="store", type=int, default=0, help="Number of executions of each query to discard as warm-up.")
+    parser.add_argument("--outlier-k", action="store", type=float, default=1.5, help="Executions more than k times the interquartile range away from the quartiles of their query are outliers. Defaults to 1.5.")
+    parser.add_argument("--drop-outliers", action="store_true", help="Exclude outliers from the statistics. By default, they are only counted.")
+    parser.add_argument("--percentiles", action="store", type=int, nargs="+", default=[5, 25, 75, 95], help="Percentiles to report. Defaults to 5 25 75 95.")
+    parser.add_argument("--bootstrap", action="store", type=int, default=1000, help="Number of bootstrap resamples for the confidence intervals. Defaults to 1000.")
+    parser.add_argument("--confidence", action="store", type=float, default=0.95, help="Confidence level of the intervals. Defaults to 0.95.")
+    parser.add_argument("--alpha", action="store", type=float, default=0.05, help="Significance level of the comparison. Defaults to 0.05.")
+    parser.add_argument("--seed", action="store", type=int, help="Seed for the bootstrap resampling.")
+    parser.add_argument("--out", "-o", action="store", help="File to write the per-query statistics (or the comparison) to, as CSV.")
 
     args = parser.parse_args()
 
-    files_to_analyze = sorted(list(pathlib.Path(args.dir).glob(f"{args.file_prefix}*-cout.csv")))
-    plans = [(file, read_batch(file)) for file in files_to_analyze]
-    runtimes = [(file, plan.t_exec.sum()) for (file, plan) in plans]
-    for file, rt in runtimes:
-        print(f"{file}{args.separator}{rt}")
+    files_to_analyze = find_result_files(args.dir, args.file_prefix)
+    if not (args.stats or args.compare_prefix):
+        runtimes = [(file, read_runtimes(file).sum()) for file in files_to_analyze]
+        for file, rt in runtimes:
+            print(f"{file}{args.separator}{rt}")
+        return
+
+    summary_args = dict(percentiles=args.percentiles, n_bootstrap=args.bootstrap, confidence=args.confidence, seed=args.seed)
+    runs_df = prepare_runs(files_to_analyze, args)
+    print(helper.workload_statistics(runs_df, column=args.column, **summary_args).to_string(index=False))
+
+    if args.compare_prefix:
+        compare_files = find_result_files(args.dir, args.compare_prefix)
+        compare_df = prepare_runs(compare_files, args)
+        print(helper.workload_statistics(compare_df, column=args.column, **summary_args).to_string(index=False))
+        comparison_df = helper.compare_statistics(runs_df, compare_df, key=args.key, column=args.column, alpha=args.alpha)
+        print(comparison_df.tail(1).drop(columns=args.key).to_string(index=False))
+        print(f"{comparison_df.significant.iloc[:-1].sum()} of {len(comparison_df) - 1} queries differ significantly")
+        result_df = comparison_df
+    else:
+        result_df = helper.query_statistics(runs_df, key=args.key, column=args.column, **summary_args)
+        result_df["outliers"] = runs_df.groupby(args.key).outlier.sum().reindex(result_df[args.key]).to_numpy()
+
+    if args.out:
+        result_df.to_csv(args.out, index=False)
 
 
 if __name__ == "__main__":
@@ -23,14 +23,16 @@ def clean_results(contents: List[str]) -> List[str]:
         line for line in contents if not line.startswith(COMMENT_PREFIX)]
 
     # drop all statements before the first actual query plan
-    while not cleaned[0].startswith(QUERY_PLAN) and not cleaned[0].startswith(QUERY_PLAN_START):
-        cleaned.pop(0)
+    start = 0
+    while not cleaned[start].startswith(QUERY_PLAN) and not cleaned[start].startswith(QUERY_PLAN_START):
+        start += 1
 
     # drop all statements after the last actual query plan
-    while not cleaned[-1].startswith(QUERY_PLAN_END):
-        cleaned.pop(-1)
+    end = len(cleaned)
+    while not cleaned[end - 1].startswith(QUERY_PLAN_END):
+        end -= 1
 
-    return cleaned
+    return cleaned[start:end]
 
 
 def write_cleaned(contents: List[str], out: str) -> None:
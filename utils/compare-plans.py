@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import argparse
+
+import pandas as pd
+
+import helper
+
+
+def read_configuration(files, args: argparse.Namespace) -> "pd.DataFrame":
+    runs_df = helper.read_plan_runs(files, key=args.key)
+    return helper.discard_warmup(runs_df, args.warmup)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Utility to detect plan changes and performance regressions between two sets of workload runs (e.g. two optimizer configurations or model generations). Queries are lined up by their label and compared by their most frequent plan.")
+    parser.add_argument("--before", "-a", action="store", nargs="+", required=True, help="Result files (as written by calculate-cout.py) of the runs to compare against")
+    parser.add_argument("--after", "-b", action="store", nargs="+", required=True, help="Result files of the runs to check for regressions")
+    parser.add_argument("--key", action="store", default="label", help="Result column which identifies the queries across runs. Defaults to label, which requires the results to be calculated with --sources.")
+    parser.add_argument("--warmup", action="store", type=int, default=0, help="Number of executions of each query to discard as warm-up.")
+    parser.add_argument("--threshold", action="store", type=float, default=1.1, help="Queries whose median execution time grew by more than this factor count as regressions. Defaults to 1.1.")
+    parser.add_argument("--top", action="store", type=int, default=10, help="Number of regressions to print. Defaults to 10.")
+    parser.add_argument("--out", "-o", action="store", help="File to write the comparison of all queries to, as CSV.")
+
+    args = parser.parse_args()
+
+    runs_a = read_configuration(args.before, args)
+    runs_b = read_configuration(args.after, args)
+    comparison_df = helper.compare_plans(runs_a, runs_b, key=args.key, threshold=args.threshold)
+
+    # only the plans that actually changed have to be decoded
+    changed_df = comparison_df.loc[comparison_df.plan_changed]
+    shapes = helper.plan_shapes(args.before, runs_a, changed_df.fingerprint_a.dropna())
+    shapes.update(helper.plan_shapes(args.after, runs_b, changed_df.fingerprint_b.dropna()))
+    comparison_df = helper.describe_plan_changes(comparison_df, shapes)
+
+    regressions_df = comparison_df.loc[comparison_df.regression]
+    print(f"{comparison_df.plan_changed.sum()} of {len(comparison_df)} queries changed their plan, "
+          f"{len(regressions_df)} regressed ({(regressions_df.plan_changed).sum()} of them with a plan change)")
+    for row in regressions_df.head(args.top).itertuples(index=False):
+        print(f"{getattr(row, args.key)}: t_exec {row.t_exec_a:.1f} -> {row.t_exec_b:.1f} ms ({row.t_exec_ratio:.2f}x), "
+              f"C_out {row.cout_a:.0f} -> {row.cout_b:.0f} ({row.cout_ratio:.2f}x)")
+        for change in ["join_order", "join_methods", "scans"]:
+            if getattr(row, change):
+                print(f"    {change.replace('_', ' ')}: {getattr(row, change)}")
+        if not row.plan_changed:
+            print("    same plan")
+
+    if args.out:
+        comparison_df.to_csv(args.out, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,29 @@
+import importlib.util
+import json
+import math
+import pathlib
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import plan_archive
+import plan_store
+
+# Result files as written by calculate-cout.py. Columnar result files only contain the scalar metrics, the plans are
+# stored next to them in a plan archive (see plan_archive.py) which is only read on demand.
+RESULT_SUFFIXES = [".csv", ".parquet", ".npz"]
+PLANS_SUFFIX = plan_archive.ARCHIVE_SUFFIX
+
+
+def load_script(path):
+    """Loads one of the (hyphenated, thus not importable) scripts of this repo as a module."""
+    path = pathlib.Path(path)
+    spec = importlib.util.spec_from_file_location(path.stem.replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
 
 def flatten(deep_list):
     """Extracts the items from a list of lists into a single list.
@@ -33,3 +59,280 @@ def unwrap(singleton_series):
     if len(singleton_series) > 1:
         raise ValueError("Not a singleton series")
     return singleton_series.values[0]
+
+
+def plans_file(result_file):
+    """Provides the file that stores the query plans belonging to a columnar result file.
+
+    E.g. the plans for run1-cout.parquet are stored in run1-cout.plans.gz
+    """
+    return str(pathlib.Path(result_file).with_suffix(PLANS_SUFFIX))
+
+
+def read_results(result_file, columns=None):
+    """Reads a result file as written by calculate-cout.py into a data frame.
+
+    The file format is determined by the file suffix. If columns are given, only those columns will be read. For the
+    columnar formats, this means that no other data has to be loaded at all. The query plans are never loaded here,
+    use read_plans for that.
+    """
+    suffix = pathlib.Path(result_file).suffix
+    if suffix == ".csv":
+        # the plans are embedded in CSV files, but we can at least skip building the column
+        # fingerprints are hex strings, which must not be mistaken for numbers if they happen to look like one
+        return pd.read_csv(result_file, usecols=columns if columns else lambda col: col != "plan",
+                           dtype={"fingerprint": str})
+    elif suffix == ".parquet":
+        return pd.read_parquet(result_file, columns=columns)
+    elif suffix == ".npz":
+        with np.load(result_file) as contents:
+            columns = columns if columns else contents.files
+            return pd.DataFrame({col: contents[col] for col in columns})
+    raise ValueError("Unknown result file format: " + str(result_file))
+
+
+def read_plans(result_file, positions=None):
+    """Loads the (decoded) query plans for a result file as written by calculate-cout.py.
+
+    The plans are provided in the same order as the rows of the result file. If positions are given, only the plans of
+    those rows are loaded (in that order). For columnar files, this only decompresses the blocks containing them.
+    """
+    if pathlib.Path(result_file).suffix == ".csv":
+        plans = pd.read_csv(result_file, usecols=["plan"]).plan
+        return [json.loads(plan) for plan in (plans if positions is None else plans.iloc[list(positions)])]
+    archive = plan_archive.PlanArchive(plans_file(result_file))
+    return [json.loads(plan) for plan in (archive if positions is None else archive.raw_plans(positions))]
+
+
+def read_fingerprints(result_file):
+    """Provides the plan fingerprints of a result file. For files without fingerprints, they are derived from the plans."""
+    try:
+        return read_results(result_file, columns=["fingerprint"]).fingerprint
+    except (KeyError, ValueError):
+        return pd.Series([plan_store.plan_fingerprint(query_plan[0]["Plan"]) for query_plan in read_plans(result_file)],
+                         name="fingerprint", dtype=str)
+
+
+def read_runs(result_files, *, key="query", columns=("t_exec", "t_plan")):
+    """Reads the result files of repeated runs of the same workload into a single data frame.
+
+    Each row corresponds to one query execution. Besides the requested columns, the frame contains the key column
+    (which identifies the query across runs), the run (i.e. the index of the result file), the position of the
+    execution within its run and the iteration of the query, i.e. how often the query has been executed before (in
+    earlier runs or earlier within the same run).
+    """
+    frames = []
+    for run, result_file in enumerate(result_files):
+        df = read_results(result_file, columns=[key] + list(columns))
+        df["run"] = run
+        df["position"] = np.arange(len(df))
+        frames.append(df)
+    runs_df = pd.concat(frames, ignore_index=True)
+    runs_df["iteration"] = runs_df.groupby(key, sort=False).cumcount()
+    return runs_df
+
+
+def discard_warmup(runs_df, n_warmup):
+    """Drops the first n_warmup executions of each query (see the iteration column of read_runs)."""
+    return runs_df.loc[runs_df.iteration >= n_warmup]
+
+
+def flag_outliers(runs_df, *, key="query", column="t_exec", k=1.5):
+    """Marks all executions that are outliers compared to the other executions of the same query.
+
+    Outliers are determined by Tukey's fences, i.e. values more than k times the interquartile range below the first
+    or above the third quartile. The result is a copy of runs_df with an additional boolean column outlier.
+    """
+    grouped = runs_df.groupby(key)[column]
+    q1 = runs_df[key].map(grouped.quantile(0.25))
+    q3 = runs_df[key].map(grouped.quantile(0.75))
+    iqr = q3 - q1
+    flagged_df = runs_df.copy()
+    flagged_df["outlier"] = (runs_df[column] < q1 - k * iqr) | (runs_df[column] > q3 + k * iqr)
+    return flagged_df
+
+
+def value_matrix(runs_df, *, key="query", column="t_exec", keys=None):
+    """Arranges the values of a column into a matrix with one row per query and one column per execution.
+
+    Rows are ordered as the keys (all distinct values of the key column in order of appearance by default). Queries
+    with less executions than others are padded with NaN values at the end of their row.
+    """
+    keys = pd.Index(keys if keys is not None else runs_df[key].unique())
+    rows = keys.get_indexer(runs_df[key])
+    known = rows >= 0
+    rows = rows[known]
+    positions = runs_df.loc[known].groupby(key, sort=False).cumcount().to_numpy()
+    matrix = np.full((len(keys), positions.max() + 1 if len(positions) else 0), np.nan)
+    matrix[rows, positions] = runs_df.loc[known, column].to_numpy(dtype=float)
+    return keys, matrix
+
+
+def bootstrap_ci(matrix, *, statistic=np.nanmedian, n_bootstrap=1000, confidence=0.95, seed=None, chunk_size=100):
+    """Computes percentile bootstrap confidence intervals of a statistic for each row of a matrix (see value_matrix).
+
+    All rows are resampled at the same time, chunk_size resamples at once. The result consists of two arrays, the lower
+    and the upper bounds.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows, n_cols = matrix.shape
+    counts = np.sum(~np.isnan(matrix), axis=1)
+    rows = np.arange(n_rows)[:, np.newaxis, np.newaxis]
+    padding = np.arange(n_cols) >= counts[:, np.newaxis, np.newaxis]
+    estimates = np.empty((n_rows, n_bootstrap))
+    with warnings.catch_warnings():
+        # rows without any values simply produce NaN bounds
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for start in range(0, n_bootstrap, chunk_size):
+            n_samples = min(chunk_size, n_bootstrap - start)
+            sample_idx = (rng.random((n_rows, n_samples, n_cols)) * counts[:, np.newaxis, np.newaxis]).astype(int)
+            samples = np.where(padding, np.nan, matrix[rows, sample_idx])
+            estimates[:, start:start + n_samples] = statistic(samples, axis=2)
+        alpha = (1 - confidence) / 2
+        lower, upper = np.nanpercentile(estimates, [100 * alpha, 100 * (1 - alpha)], axis=1)
+    return lower, upper
+
+
+def summarize_matrix(keys, matrix, *, percentiles=(5, 25, 75, 95), n_bootstrap=1000, confidence=0.95, seed=None):
+    """Computes the number of values, the median, the percentiles and the bootstrap CI of the median for each row."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        summary_df = pd.DataFrame({"key": keys, "n": np.sum(~np.isnan(matrix), axis=1),
+                                   "median": np.nanmedian(matrix, axis=1)})
+        for percentile, values in zip(percentiles, np.nanpercentile(matrix, percentiles, axis=1)):
+            summary_df[f"p{percentile}"] = values
+    summary_df["ci_low"], summary_df["ci_high"] = bootstrap_ci(matrix, n_bootstrap=n_bootstrap, confidence=confidence,
+                                                               seed=seed)
+    return summary_df
+
+
+def query_statistics(runs_df, *, key="query", column="t_exec", **summary_args):
+    """Summarizes the executions of each query, see summarize_matrix for the statistics and their parameters."""
+    keys, matrix = value_matrix(runs_df, key=key, column=column)
+    return summarize_matrix(keys, matrix, **summary_args).rename(columns={"key": key})
+
+
+def workload_statistics(runs_df, *, column="t_exec", **summary_args):
+    """Summarizes the total value (e.g. the runtime) of the workload across all runs."""
+    totals = runs_df.groupby("run")[column].sum().to_numpy(dtype=float)
+    return summarize_matrix(["workload"], totals[np.newaxis, :], **summary_args)
+
+
+def mann_whitney(matrix_a, matrix_b):
+    """Two-sided Mann-Whitney U test for each row of two matrices (see value_matrix), e.g. of two configurations.
+
+    P-values are obtained via the normal approximation, including continuity and tie corrections. The result consists
+    of two arrays, the U statistics (of the first sample) and the p-values.
+    """
+    n_a = np.sum(~np.isnan(matrix_a), axis=1)
+    n_b = np.sum(~np.isnan(matrix_b), axis=1)
+    n = n_a + n_b
+    combined = np.hstack([matrix_a, matrix_b])
+    ranks = pd.DataFrame(combined).rank(axis=1).to_numpy()
+    u_a = np.nansum(ranks[:, :matrix_a.shape[1]], axis=1) - n_a * (n_a + 1) / 2
+
+    # tied values lower the variance of U: sum of t^3 - t over all groups of t tied values per row
+    long_df = pd.DataFrame(combined).stack().rename("value").reset_index()
+    tie_counts = long_df.groupby(["level_0", "value"]).size()
+    ties = (tie_counts ** 3 - tie_counts).groupby(level=0).sum().reindex(range(len(combined)), fill_value=0).to_numpy()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_u = n_a * n_b / 2
+        sigma_u = np.sqrt(n_a * n_b / 12 * ((n + 1) - ties / (n * (n - 1))))
+        z = (np.abs(u_a - mean_u) - 0.5) / sigma_u
+        p_values = np.vectorize(math.erfc, otypes=[float])(np.clip(z, 0, None) / math.sqrt(2))
+    p_values[(n_a == 0) | (n_b == 0) | ~(sigma_u > 0)] = np.nan
+    return u_a, p_values
+
+
+def compare_statistics(runs_a, runs_b, *, key="query", column="t_exec", alpha=0.05):
+    """Compares two configurations per query and for the entire workload (total value per run).
+
+    For each query, the medians of both configurations, their ratio (b / a) and the result of a Mann-Whitney U test
+    are reported. The difference is considered significant if the p-value is below alpha.
+    """
+    keys = pd.Index(runs_a[key].unique()).union(pd.Index(runs_b[key].unique()), sort=False)
+    __, matrix_a = value_matrix(runs_a, key=key, column=column, keys=keys)
+    __, matrix_b = value_matrix(runs_b, key=key, column=column, keys=keys)
+
+    # the workload totals are simply treated as an additional row
+    totals_a = runs_a.groupby("run")[column].sum().to_numpy(dtype=float)
+    totals_b = runs_b.groupby("run")[column].sum().to_numpy(dtype=float)
+    matrix_a = np.vstack([pad_columns(matrix_a, len(totals_a)), pad_columns(totals_a[np.newaxis, :], matrix_a.shape[1])])
+    matrix_b = np.vstack([pad_columns(matrix_b, len(totals_b)), pad_columns(totals_b[np.newaxis, :], matrix_b.shape[1])])
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        median_a = np.nanmedian(matrix_a, axis=1)
+        median_b = np.nanmedian(matrix_b, axis=1)
+    u_a, p_values = mann_whitney(matrix_a, matrix_b)
+    return pd.DataFrame({key: list(keys) + ["workload"], "median_a": median_a, "median_b": median_b,
+                         "ratio": median_b / median_a, "u": u_a, "p_value": p_values, "significant": p_values < alpha})
+
+
+def pad_columns(matrix, n_cols):
+    """Appends NaN columns to a matrix until it has (at least) n_cols columns."""
+    missing = max(n_cols - matrix.shape[1], 0)
+    return np.hstack([matrix, np.full((matrix.shape[0], missing), np.nan)])
+
+
+def read_plan_runs(result_files, *, key="label", columns=("t_exec", "cout")):
+    """Reads repeated runs (see read_runs) together with the fingerprints of the plans of all executions."""
+    runs_df = read_runs(result_files, key=key, columns=columns)
+    runs_df["fingerprint"] = pd.concat([read_fingerprints(result_file) for result_file in result_files],
+                                       ignore_index=True).to_numpy(dtype=str)
+    return runs_df
+
+
+def plan_shapes(result_files, runs_df, fingerprints):
+    """Loads the shapes of the given plans from the result files, using the first execution of each plan."""
+    first_df = runs_df.loc[runs_df.fingerprint.isin(set(fingerprints))].drop_duplicates("fingerprint")
+    shapes = {}
+    for run, run_df in first_df.groupby("run"):
+        for fingerprint, query_plan in zip(run_df.fingerprint, read_plans(result_files[run], run_df.position.tolist())):
+            shapes[fingerprint] = plan_store.plan_shape(query_plan[0]["Plan"])
+    return shapes
+
+
+def dominant_plans(runs_df, *, key="label", columns=("t_exec", "cout")):
+    """Determines the plan each query was executed with most often, the number of its distinct plans and the medians."""
+    plan_counts = runs_df.groupby([key, "fingerprint"], sort=False).size().rename("executions").reset_index()
+    dominant = (plan_counts.sort_values("executions", ascending=False, kind="stable")
+                .drop_duplicates(key).set_index(key).fingerprint)
+    grouped = runs_df.groupby(key, sort=False)
+    return pd.DataFrame({"plans": grouped.fingerprint.nunique(), "fingerprint": dominant,
+                         **{col: grouped[col].median() for col in columns}})
+
+
+def compare_plans(runs_a, runs_b, *, key="label", threshold=1.1):
+    """Lines up the plans of two configurations per query and links plan changes to the change in t_exec and C_out.
+
+    Each query is represented by its most frequent plan and the medians of all its executions (see dominant_plans).
+    A query regressed if its median t_exec grew by more than the threshold factor. The result is ordered by the
+    increase in t_exec, such that the biggest regressions come first. Use describe_plan_changes to find out how the
+    plans differ.
+    """
+    plans_a, plans_b = dominant_plans(runs_a, key=key), dominant_plans(runs_b, key=key)
+    comparison_df = plans_a.join(plans_b, how="outer", lsuffix="_a", rsuffix="_b", sort=False)
+    comparison_df["plan_changed"] = comparison_df.fingerprint_a != comparison_df.fingerprint_b
+    comparison_df["t_exec_delta"] = comparison_df.t_exec_b - comparison_df.t_exec_a
+    comparison_df["t_exec_ratio"] = comparison_df.t_exec_b / comparison_df.t_exec_a
+    comparison_df["cout_ratio"] = comparison_df.cout_b / comparison_df.cout_a
+    comparison_df["regression"] = comparison_df.t_exec_ratio > threshold
+    comparison_df = comparison_df.sort_values("t_exec_delta", ascending=False, kind="stable")
+    return comparison_df.rename_axis(key).reset_index()
+
+
+def describe_plan_changes(comparison_df, shapes):
+    """Adds the changes in join order, join methods and scans to the changed plans of a comparison (see compare_plans).
+
+    The shapes map the fingerprints of all changed plans to the plan shapes, see plan_shapes or plan_store.PlanStore.
+    """
+    described_df = comparison_df.copy()
+    for change in ["join_order", "join_methods", "scans"]:
+        described_df[change] = ""
+    changed = described_df.plan_changed & described_df.fingerprint_a.isin(shapes) & described_df.fingerprint_b.isin(shapes)
+    for idx, fingerprint_a, fingerprint_b in described_df.loc[changed, ["fingerprint_a", "fingerprint_b"]].itertuples():
+        for change, description in plan_store.describe_changes(shapes[fingerprint_a], shapes[fingerprint_b]).items():
+            described_df.at[idx, change] = description
+    return described_df
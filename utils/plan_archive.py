@@ -0,0 +1,188 @@
+"""Compressed, indexed storage for the query plans of a workload run.
+
+An archive consists of two files: the plans themselves (one JSON-encoded plan per line) are compressed in blocks, each
+block being a separate gzip member. Since concatenated gzip members form a valid gzip file, the archive can still be
+read sequentially (e.g. via zcat or gzip.open). Next to it, the index file stores a fixed-size record for each plan:
+its position in the archive, the offset and length of its block, its line within the block and its label (e.g. the
+JOB query name). The index is memory-mapped when reading, such that single plans can be obtained by decompressing just
+their block.
+"""
+
+import gzip
+import json
+import os
+from typing import Any, Dict, Iterable, Iterator, List
+
+import numpy as np
+
+ARCHIVE_SUFFIX = ".plans.gz"
+INDEX_SUFFIX = ".idx"
+LABEL_LENGTH = 32
+INDEX_DTYPE = np.dtype([("position", "<i8"), ("offset", "<i8"), ("length", "<i8"), ("line", "<i4"),
+                        ("label", f"<U{LABEL_LENGTH}")])
+
+
+def is_archive(path: str) -> bool:
+    return str(path).endswith(ARCHIVE_SUFFIX) and os.path.exists(index_file(path))
+
+
+def index_file(path: str) -> str:
+    return str(path) + INDEX_SUFFIX
+
+
+def read_index(path: str) -> np.ndarray:
+    """Memory-maps the index of an archive (an empty array if there are no plans yet)."""
+    if not os.path.exists(index_file(path)) or not os.path.getsize(index_file(path)):
+        return np.empty(0, dtype=INDEX_DTYPE)
+    return np.memmap(index_file(path), dtype=INDEX_DTYPE, mode="r")
+
+
+class PlanArchiveWriter:
+    """Writes plans to an archive, compressing block_size plans at a time.
+
+    Plans are added via `add`, or via `write` which makes the writer usable in place of a text file (one plan per
+    line). If durable is set, each `flush` completes the current block and syncs both files to disk, such that all
+    plans written so far survive a crash. Otherwise, blocks are only completed once they are full (or on `close`).
+    """
+    def __init__(self, path: str, *, block_size=16, append=False, durable=False, compression_level=6):
+        self.path = str(path)
+        self.block_size = block_size
+        self.durable = durable
+        self.compression_level = compression_level
+        if append:
+            truncate_archive(self.path, len(read_index(self.path)))
+        self.n_plans = len(read_index(self.path)) if append else 0
+        self.data_file = open(self.path, "ab" if append else "wb")
+        self.index_file = open(index_file(self.path), "ab" if append else "wb")
+        self.pending = []
+
+    def add(self, raw_plan: str, *, label="") -> int:
+        """Adds a single (JSON-encoded) plan, providing its position in the archive."""
+        position = self.n_plans
+        self.pending.append((raw_plan.strip(), label))
+        self.n_plans += 1
+        if len(self.pending) >= self.block_size:
+            self._write_block()
+        return position
+
+    def write(self, text: str) -> None:
+        for line in text.splitlines():
+            if line.strip():
+                self.add(line)
+
+    def flush(self) -> None:
+        if self.durable:
+            self._write_block()
+            os.fsync(self.data_file.fileno())
+            os.fsync(self.index_file.fileno())
+
+    def fileno(self) -> int:
+        return self.data_file.fileno()
+
+    def close(self) -> None:
+        self._write_block()
+        self.data_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_block(self) -> None:
+        if not self.pending:
+            return
+        block = gzip.compress("".join(raw_plan + "\n" for raw_plan, __ in self.pending).encode(),
+                              compresslevel=self.compression_level)
+        offset = self.data_file.tell()
+        self.data_file.write(block)
+        self.data_file.flush()
+
+        # the index is only written once the block is complete, so it never refers to missing data
+        records = np.empty(len(self.pending), dtype=INDEX_DTYPE)
+        records["position"] = np.arange(self.n_plans - len(self.pending), self.n_plans)
+        records["offset"] = offset
+        records["length"] = len(block)
+        records["line"] = np.arange(len(self.pending))
+        records["label"] = [label[:LABEL_LENGTH] for __, label in self.pending]
+        records.tofile(self.index_file)
+        self.index_file.flush()
+        self.pending = []
+
+
+class PlanArchive:
+    """Random access to the plans of an archive. Only the blocks of the requested plans are decompressed."""
+    def __init__(self, path: str):
+        self.path = str(path)
+        self.index = read_index(self.path)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def labels(self) -> np.ndarray:
+        return self.index["label"]
+
+    def positions(self, label: str) -> np.ndarray:
+        """Provides the positions of all plans with the given label."""
+        return self.index["position"][self.index["label"] == label]
+
+    def raw_plans(self, positions: Iterable[int]) -> List[str]:
+        """Provides the JSON text of the plans at the given positions (in that order)."""
+        positions = np.asarray(list(positions), dtype=np.int64)
+        records = self.index[positions]
+        blocks = {}
+        with open(self.path, "rb") as data_file:
+            for offset, length in sorted(set(zip(records["offset"].tolist(), records["length"].tolist()))):
+                data_file.seek(offset)
+                blocks[offset] = gzip.decompress(data_file.read(length)).decode().splitlines()
+        return [blocks[offset][line] for offset, line in zip(records["offset"].tolist(), records["line"].tolist())]
+
+    def raw_plan(self, position: int) -> str:
+        return self.raw_plans([position])[0]
+
+    def plan(self, position: int) -> Any:
+        return json.loads(self.raw_plan(position))
+
+    def plans(self, positions: Iterable[int]) -> List[Any]:
+        return [json.loads(raw_plan) for raw_plan in self.raw_plans(positions)]
+
+    def __iter__(self) -> Iterator[str]:
+        """Reads all plans sequentially (as JSON text)."""
+        with gzip.open(self.path, "rt") as data_file:
+            for line in data_file:
+                yield line
+
+
+def truncate_archive(path: str, n_plans: int) -> int:
+    """Drops all plans after the first n_plans ones (as well as data that has not been indexed, e.g. due to a crash).
+
+    Since the archive can only be cut at block boundaries, plans that share a block with dropped plans are dropped as
+    well. The number of remaining plans is returned.
+    """
+    if not os.path.exists(path):
+        return 0
+    index = np.array(read_index(path))
+    if n_plans < len(index):
+        cut_offset = index["offset"][n_plans]
+        index = index[index["offset"] < cut_offset]
+    data_end = int(index["offset"][-1] + index["length"][-1]) if len(index) else 0
+    with open(path, "r+b") as data_file:
+        data_file.truncate(data_end)
+    with open(index_file(path), "wb") as idx_file:
+        index.tofile(idx_file)
+    return len(index)
+
+
+def write_archive(path: str, raw_plans: Iterable[str], labels: Iterable[str] = None, *, block_size=16) -> int:
+    """Writes an entire archive at once, returning the number of plans written."""
+    labels = iter(labels) if labels else None
+    with PlanArchiveWriter(path, block_size=block_size) as writer:
+        for raw_plan in raw_plans:
+            writer.add(raw_plan, label=next(labels) if labels else "")
+        return writer.n_plans
+
+
+def archive_stats(path: str) -> Dict[str, Any]:
+    index = read_index(path)
+    return {"plans": len(index), "blocks": len(np.unique(index["offset"])), "bytes": os.path.getsize(path)}
@@ -0,0 +1,253 @@
+"""Deduplicated storage for the query plans of repeated workload runs.
+
+Repeated runs of a workload mostly end up with the same plans, differing only in their actual row counts and timings.
+A plan store therefore keeps each distinct plan shape (see `plan_shape`) only once, identified by its fingerprint.
+Each executed plan is recorded as a small numeric record against its shape: the run and position it belongs to, its
+label, its planning and execution time, its C_out value and the per-node actuals (rows, loops and total time, in
+pre-order).
+
+A store is a directory containing the shapes (one JSON object per line, gzip-compressed) and the records (a compressed
+npz file). Only the shapes have to be parsed as JSON when loading a store, their number is bounded by the number of
+distinct plans rather than by the number of runs.
+"""
+
+import collections
+import gzip
+import hashlib
+import json
+import os
+import pathlib
+from typing import Any, Dict, Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+SHAPES_FILE = "shapes.jsonl.gz"
+RECORDS_FILE = "records.npz"
+
+# Plan attributes which determine the shape of a plan. Everything else (costs, estimates, actuals, filters) is ignored
+# when comparing plans. Filters are not part of the shape since they are determined by the query, not by the optimizer.
+SHAPE_KEYS = ("Node Type", "Parent Relationship", "Join Type", "Strategy", "Partial Mode", "Relation Name", "Alias",
+              "Index Name", "Scan Direction", "Inner Unique")
+
+JOIN_NODES = ("Nested Loop", "Hash Join", "Merge Join")
+
+RECORD_COLUMNS = ["run", "position", "label", "fingerprint", "t_plan", "t_exec", "cout", "node_offset", "n_nodes"]
+
+
+def plan_shape(plan_node: Dict[str, Any]) -> Dict[str, Any]:
+    """Strips a plan down to its shape, i.e. the operators, their order, join and scan types and the relations."""
+    shape = {key: plan_node[key] for key in SHAPE_KEYS if key in plan_node}
+    stack = [(plan_node, shape)]
+    while stack:
+        current_plan, current_shape = stack.pop()
+        if "Plans" not in current_plan:
+            continue
+        current_shape["Plans"] = []
+        for child_plan in current_plan["Plans"]:
+            child_shape = {key: child_plan[key] for key in SHAPE_KEYS if key in child_plan}
+            current_shape["Plans"].append(child_shape)
+            stack.append((child_plan, child_shape))
+    return shape
+
+
+def shape_fingerprint(shape: Dict[str, Any]) -> str:
+    encoded_shape = json.dumps(shape, sort_keys=True, separators=(",", ":")).encode()
+    return hashlib.blake2b(encoded_shape, digest_size=8).hexdigest()
+
+
+def plan_fingerprint(plan_node: Dict[str, Any]) -> str:
+    """Provides a structural fingerprint of a plan: plans with the same fingerprint only differ in costs or actuals."""
+    return shape_fingerprint(plan_shape(plan_node))
+
+
+def shape_features(shape: Dict[str, Any]) -> Dict[str, Any]:
+    """Describes a plan shape by its join order, the number of joins of each join method and the scan of each relation.
+
+    The join order is given as nested join expression over the relations (their aliases, if available), e.g.
+    "((t x mi) x k)" with the outer relation of each join first.
+    """
+    nodes = []
+    stack = [shape]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.get("Plans", []))
+
+    # nodes are visited after their parent above, so in reverse the children are always handled first
+    expressions = {}
+    join_methods = collections.Counter()
+    scans = {}
+    for node in reversed(nodes):
+        children = [expressions[id(child)] for child in node.get("Plans", []) if expressions[id(child)]]
+        if "Relation Name" in node:
+            relation = node.get("Alias", node["Relation Name"])
+            scans[relation] = node["Node Type"] + (" using " + node["Index Name"] if "Index Name" in node else "")
+            expressions[id(node)] = relation
+        elif node["Node Type"] in JOIN_NODES:
+            join_methods[node["Node Type"]] += 1
+            expressions[id(node)] = "(" + " x ".join(children) + ")"
+        else:
+            expressions[id(node)] = ", ".join(children)
+    return {"join_order": expressions[id(shape)], "join_methods": dict(join_methods), "scans": scans}
+
+
+def describe_changes(shape_a: Dict[str, Any], shape_b: Dict[str, Any]) -> Dict[str, str]:
+    """Lists the differences in join order, join methods and scans between two plan shapes (empty if there are none)."""
+    features_a, features_b = shape_features(shape_a), shape_features(shape_b)
+    changes = {}
+    if features_a["join_order"] != features_b["join_order"]:
+        changes["join_order"] = f"{features_a['join_order']} -> {features_b['join_order']}"
+    if features_a["join_methods"] != features_b["join_methods"]:
+        changes["join_methods"] = " -> ".join(", ".join(f"{method} x{count}" for method, count in sorted(methods.items()))
+                                              for methods in [features_a["join_methods"], features_b["join_methods"]])
+    scans_a, scans_b = features_a["scans"], features_b["scans"]
+    changed_scans = [f"{relation}: {scans_a.get(relation, '-')} -> {scans_b.get(relation, '-')}"
+                     for relation in dict.fromkeys(list(scans_a) + list(scans_b))
+                     if scans_a.get(relation) != scans_b.get(relation)]
+    if changed_scans:
+        changes["scans"] = ", ".join(changed_scans)
+    return changes
+
+
+def plan_actuals(plan_node: Dict[str, Any]) -> Tuple[List[Any], List[int], List[float]]:
+    """Collects the actual rows, loops and total time of all nodes of a plan in pre-order."""
+    actual_rows, loops, total_times = [], [], []
+    stack = [plan_node]
+    while stack:
+        node = stack.pop()
+        actual_rows.append(node.get("Actual Rows", 0))
+        loops.append(node.get("Actual Loops", 0))
+        total_times.append(node.get("Actual Total Time", np.nan))
+        stack.extend(reversed(node.get("Plans", [])))
+    return actual_rows, loops, total_times
+
+
+def join_rows(plan_node: Dict[str, Any], join_nodes: Iterable[str] = ("Nested Loop", "Hash Join")) -> Any:
+    """Calculates the C_out value of a plan, using the same join nodes as calculate-cout.py by default."""
+    total = 0
+    stack = [plan_node]
+    while stack:
+        node = stack.pop()
+        if node["Node Type"] in join_nodes:
+            total += node.get("Actual Rows", 0)
+        stack.extend(node.get("Plans", []))
+    return total
+
+
+class PlanStore:
+    """A collection of plan shapes and the records of the executed plans. See the module documentation."""
+    def __init__(self, path: str = None):
+        self.path = path
+        self.shapes: Dict[str, Dict[str, Any]] = {}
+        self._records = {col: [] for col in RECORD_COLUMNS}
+        self._actual_rows, self._loops, self._total_times = [], [], []
+        self._n_nodes = 0
+        if path and os.path.exists(pathlib.Path(path) / RECORDS_FILE):
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._records["run"])
+
+    def add(self, query_plan: Any, *, run: str, position: int, label="") -> str:
+        """Records a single decoded EXPLAIN ANALYZE output (as produced by calculate-cout.py), providing its fingerprint."""
+        plan_node = query_plan[0]["Plan"]
+        shape = plan_shape(plan_node)
+        fingerprint = shape_fingerprint(shape)
+        self.shapes.setdefault(fingerprint, shape)
+
+        actual_rows, loops, total_times = plan_actuals(plan_node)
+        record = dict(run=run, position=position, label=label, fingerprint=fingerprint,
+                      t_plan=query_plan[0]["Planning Time"], t_exec=query_plan[0]["Execution Time"],
+                      cout=join_rows(plan_node), node_offset=self._n_nodes, n_nodes=len(actual_rows))
+        for col, value in record.items():
+            self._records[col].append(value)
+        self._actual_rows.extend(actual_rows)
+        self._loops.extend(loops)
+        self._total_times.extend(total_times)
+        self._n_nodes += len(actual_rows)
+        return fingerprint
+
+    def add_run(self, query_plans: Iterable[Any], *, run: str, labels: Iterable[str] = None) -> int:
+        """Records all plans of a workload run, returning the number of plans."""
+        labels = iter(labels) if labels else None
+        n_plans = 0
+        for position, query_plan in enumerate(query_plans):
+            self.add(query_plan, run=run, position=position, label=next(labels) if labels else "")
+            n_plans += 1
+        return n_plans
+
+    def records(self) -> pd.DataFrame:
+        """Provides one row per recorded plan (without the per-node actuals)."""
+        return pd.DataFrame(self._records, columns=RECORD_COLUMNS)
+
+    def runs(self) -> List[str]:
+        return list(dict.fromkeys(self._records["run"]))
+
+    def actuals(self, record: int) -> pd.DataFrame:
+        """Provides the per-node actuals of a record, in pre-order of the nodes of its shape."""
+        start = self._records["node_offset"][record]
+        end = start + self._records["n_nodes"][record]
+        return pd.DataFrame({"actual_rows": self._actual_rows[start:end], "loops": self._loops[start:end],
+                             "total_time": self._total_times[start:end]})
+
+    def plan(self, record: int) -> Dict[str, Any]:
+        """Rebuilds the plan of a record from its shape and actuals. Costs, estimates and filters are not retained."""
+        plan_node = json.loads(json.dumps(self.shapes[self._records["fingerprint"][record]]))
+        actuals = self.actuals(record).itertuples(index=False)
+        stack = [plan_node]
+        while stack:
+            node = stack.pop()
+            node_actuals = next(actuals)
+            node["Actual Rows"], node["Actual Loops"] = node_actuals.actual_rows, node_actuals.loops
+            node["Actual Total Time"] = node_actuals.total_time
+            stack.extend(reversed(node.get("Plans", [])))
+        return plan_node
+
+    def distinct_plans(self, label: str = None, *, key="label") -> pd.DataFrame:
+        """Counts the distinct plans per query (identified by key), as well as the runs and executions covered.
+
+        If a label is given, only the plans of that query are counted.
+        """
+        records_df = self.records()
+        if label is not None:
+            records_df = records_df.loc[records_df[key] == label]
+        return (records_df.groupby(key, sort=False)
+                .agg(distinct_plans=("fingerprint", "nunique"), runs=("run", "nunique"), executions=("fingerprint", "size"))
+                .reset_index())
+
+    def plan_frequencies(self, label: str, *, key="label") -> pd.DataFrame:
+        """Lists the distinct plans of a single query, with the number of executions and runs of each one."""
+        records_df = self.records()
+        records_df = records_df.loc[records_df[key] == label]
+        return (records_df.groupby("fingerprint", sort=False)
+                .agg(executions=("run", "size"), runs=("run", "nunique"), median_t_exec=("t_exec", "median"))
+                .sort_values("executions", ascending=False)
+                .reset_index())
+
+    def save(self, path: str = None) -> None:
+        path = pathlib.Path(path if path else self.path)
+        path.mkdir(parents=True, exist_ok=True)
+        with gzip.open(path / SHAPES_FILE, "wt") as shapes_file:
+            for fingerprint, shape in self.shapes.items():
+                shapes_file.write(json.dumps({"fingerprint": fingerprint, "shape": shape}) + "\n")
+
+        # text columns have to be stored as unicode arrays, otherwise numpy would need to pickle them
+        records_df = self.records()
+        columns = {col: records_df[col].to_numpy(dtype=str) if records_df[col].dtype.kind == "O" else records_df[col].to_numpy()
+                   for col in RECORD_COLUMNS}
+        np.savez_compressed(path / RECORDS_FILE, actual_rows=np.array(self._actual_rows), loops=np.array(self._loops, dtype=np.int64),
+                            total_time=np.array(self._total_times, dtype=np.float64), **columns)
+
+    def _load(self) -> None:
+        path = pathlib.Path(self.path)
+        with gzip.open(path / SHAPES_FILE, "rt") as shapes_file:
+            for line in shapes_file:
+                entry = json.loads(line)
+                self.shapes[entry["fingerprint"]] = entry["shape"]
+        with np.load(path / RECORDS_FILE) as contents:
+            self._records = {col: contents[col].tolist() for col in RECORD_COLUMNS}
+            self._actual_rows = contents["actual_rows"].tolist()
+            self._loops = contents["loops"].tolist()
+            self._total_times = contents["total_time"].tolist()
+        self._n_nodes = len(self._actual_rows)
@@ -45,11 +45,15 @@ def main():
     parser.add_argument("--prefix", action="store", required=False, default="", help="Prefix (e.g. query) to insert before the first real query")
     parser.add_argument("--suffix", action="store", required=False, default="", help="Suffix (e.g. query) to insert after the last query")
     parser.add_argument("--pattern", action="store", required=False, default="", help="Glob-pattern matching the source file names")
+    parser.add_argument("--buffers", action="store_true", help="Collect buffer statistics (shared hits and reads, temp spills) for each plan node, i.e. run EXPLAIN (ANALYZE, BUFFERS)")
+    parser.add_argument("--io-timing", action="store_true", help="Enable track_io_timing before the first query, such that the plans include I/O timings as well. Implies --buffers. Requires superuser privileges.")
 
     args = parser.parse_args()
     queries = read_queries(args.source_dir, query_pattern=args.pattern)
-    queries = expand_queries(queries, "explain (analyze, format json) ", "\n")
-    write_queries(queries, args.out_file, prefix=args.prefix, suffix=args.suffix)
+    explain_options = "analyze, buffers, format json" if args.buffers or args.io_timing else "analyze, format json"
+    queries = expand_queries(queries, f"explain ({explain_options}) ", "\n")
+    prefix = "\n".join(stmt for stmt in ["set track_io_timing = on;" if args.io_timing else "", args.prefix] if stmt)
+    write_queries(queries, args.out_file, prefix=prefix, suffix=args.suffix)
 
 
 if __name__ == "__main__":
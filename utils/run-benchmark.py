@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import getpass
+import json
+import math
+import os
+import pathlib
+import random
+import subprocess
+import sys
+import textwrap
+from typing import Any, Dict, List, Tuple
+
+import pandas as pd
+import psycopg2 as pg
+
+import helper
+
+REPO_DIR = pathlib.Path(__file__).resolve().parent.parent
+BAO_DIR = REPO_DIR / "pg-bao"
+AQO_DIR = REPO_DIR / "pg-aqo"
+
+RESULT_COLUMNS = ["label", "system", "run", "training", "t_plan", "t_exec", "cout"]
+SELECT_QUERY_PREFIX = "select"
+EXPLAIN_QUERY_PREFIX = "explain"
+
+
+def message(*contents: str) -> None:
+    """print for stderr."""
+    print(*contents, file=sys.stderr)
+
+
+@contextlib.contextmanager
+def working_directory(path: pathlib.Path):
+    """Temporarily switches the working directory, for the scripts that expect to be run from their own folder."""
+    previous_dir = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous_dir)
+
+
+def strip_explain(query: str) -> str:
+    """Removes a leading EXPLAIN (...) from a query, the backends add their own."""
+    select_stmt_idx = query.lower().find(SELECT_QUERY_PREFIX)
+    return query[select_stmt_idx:] if select_stmt_idx >= 0 else query
+
+
+def read_workload(source: str) -> Dict[str, str]:
+    """Reads the queries of a workload, labelled by their name.
+
+    The source is either a directory of numbered SQL files (one query each, labelled by the file name, such as the JOB
+    queries in job/), or a file with one query per line (labelled by their position: q1, q2, ...). Other statements
+    contained in the file, e.g. SET statements, are skipped. The backends take care of the session settings themselves.
+    """
+    source_path = pathlib.Path(source)
+    if source_path.is_dir():
+        workload = {}
+        # same pattern as query-merger.py, such that schema.sql or fkindexes.sql of job/ are not mistaken for queries
+        for query_file in sorted(source_path.glob("[0-9]*sql")):
+            with query_file.open("r") as query:
+                workload[query_file.stem] = strip_explain(" ".join(line.strip() for line in query.readlines()))
+        return workload
+
+    with source_path.open("r") as workload_file:
+        queries = [line.strip() for line in workload_file
+                   if line.lower().startswith(SELECT_QUERY_PREFIX) or line.lower().startswith(EXPLAIN_QUERY_PREFIX)]
+    return {f"q{idx + 1}": strip_explain(query) for idx, query in enumerate(queries)}
+
+
+def plan_workload(labels: List[str], *, seed: int = None, repetitions=1, training_fraction=1.0) -> Tuple[set, List[List[str]]]:
+    """Determines the training queries and the execution order of each repetition.
+
+    Both are derived from the seed, such that all systems execute exactly the same sequence of queries. Without a seed,
+    the queries are executed in their original order and the training queries are chosen from the front.
+    """
+    n_training = math.ceil(training_fraction * len(labels))
+    if seed is None:
+        return set(labels[:n_training]), [list(labels) for __ in range(repetitions)]
+
+    rng = random.Random(seed)
+    training = set(rng.sample(labels, k=n_training))
+    orders = [rng.sample(labels, k=len(labels)) for __ in range(repetitions)]
+    return training, orders
+
+
+class Backend:
+    """The interface a system under test has to provide to the benchmark runner.
+
+    For each repetition of the workload, the runner calls `setup_query`, `capture_plan` and `teardown_query` for every
+    query and `finish_run` afterwards. `reset` is called once before the first repetition if the spec requests it.
+    `capture_plan` has to provide the EXPLAIN ANALYZE output (in JSON format) of the query, any entries of the optimizer
+    itself (e.g. BAO's choice) may precede the actual plan.
+
+    This default implementation runs the queries on a plain Postgres instance, without any learning.
+    """
+    name = "vanilla"
+
+    def __init__(self, options: Dict[str, Any]):
+        self.options = options
+        self.conn = None
+        self.cursor = None
+
+    def connect(self) -> None:
+        pg_connect = self.options.get("pg_connect", "dbname=imdb user={u} host=localhost".format(u=getpass.getuser()))
+        self.conn = pg.connect(pg_connect)
+        self.conn.autocommit = True
+        self.cursor = self.conn.cursor()
+
+    def close(self) -> None:
+        self.cursor.close()
+        self.conn.close()
+
+    def reset(self) -> None:
+        pass
+
+    def setup_query(self, label: str, *, training: bool) -> None:
+        pass
+
+    def capture_plan(self, query: str, *, training: bool) -> List[Dict[str, Any]]:
+        self.cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query)
+        return self.cursor.fetchone()[0]
+
+    def teardown_query(self, label: str) -> None:
+        pass
+
+    def finish_run(self, run: int) -> None:
+        pass
+
+
+class BaoBackend(Backend):
+    """Runs the queries via postgres-bao-ctl.py and retrains the BAO model after each repetition.
+
+    Options: bao_dir (the pg-bao folder, containing the BAO server).
+    """
+    name = "bao"
+
+    def __init__(self, options: Dict[str, Any]):
+        super().__init__(options)
+        self.bao_dir = pathlib.Path(options.get("bao_dir", BAO_DIR))
+        self.ctl = helper.load_script(self.bao_dir / "postgres-bao-ctl.py")
+
+    def reset(self) -> None:
+        with working_directory(self.bao_dir):
+            self.ctl.bao_reset(keep_postgres=True)
+
+    def capture_plan(self, query: str, *, training: bool) -> List[Dict[str, Any]]:
+        return self.ctl.execute_single_query(self.cursor, query, for_training=training)
+
+    def finish_run(self, run: int) -> None:
+        message(f"Retraining the BAO model after run {run}")
+        with working_directory(self.bao_dir):
+            self.ctl.bao_retrain()
+
+
+class AqoBackend(Backend):
+    """Runs the queries via postgres-aqo-ctl.py, training queries in learn mode and all others in frozen mode.
+
+    Options: training_mode, evaluation_mode (see postgres-aqo-ctl.py).
+    """
+    name = "aqo"
+
+    def __init__(self, options: Dict[str, Any]):
+        super().__init__(options)
+        self.ctl = helper.load_script(AQO_DIR / "postgres-aqo-ctl.py")
+
+    def reset(self) -> None:
+        self.ctl.AqoCtl(self.cursor).reset()
+
+    def capture_plan(self, query: str, *, training: bool) -> List[Dict[str, Any]]:
+        aqo_mode = self.options.get("training_mode", "learn") if training else self.options.get("evaluation_mode", "frozen")
+        return self.ctl.execute_single_query(self.cursor, query, aqo_mode=aqo_mode)
+
+
+class UesBackend(Backend):
+    """Runs the UES-optimized queries (explicit joins) with a fixed join order.
+
+    By default, the queries are sent to a Postgres instance via pg_connect, e.g. a local stand-in or the published port
+    of the UES container. If the docker option names a container (e.g. ues_container, see ues/ues-docker-create.sh),
+    the queries are executed by psql within that container instead.
+
+    Options: docker, psql (path of psql in the container), database.
+    """
+    name = "ues"
+    SETUP = ["SET join_collapse_limit = 1"]
+    TEARDOWN = ["RESET join_collapse_limit"]
+
+    def connect(self) -> None:
+        if not self.options.get("docker"):
+            super().connect()
+
+    def close(self) -> None:
+        if not self.options.get("docker"):
+            super().close()
+
+    def setup_query(self, label: str, *, training: bool) -> None:
+        if not self.options.get("docker"):
+            for statement in UesBackend.SETUP:
+                self.cursor.execute(statement)
+
+    def capture_plan(self, query: str, *, training: bool) -> List[Dict[str, Any]]:
+        if not self.options.get("docker"):
+            return super().capture_plan(query, training=training)
+
+        # psql runs the commands one after another in the same session, -t -A reduces the output to the plain JSON
+        psql = self.options.get("psql", "/home/postgres/ues/psql/bin/bin/psql")
+        commands = UesBackend.SETUP + ["EXPLAIN (ANALYZE, FORMAT JSON) " + query]
+        psql_call = ["docker", "exec", self.options["docker"], psql, self.options.get("database", "imdb"),
+                     "-X", "-q", "-t", "-A"]
+        for command in commands:
+            psql_call.extend(["-c", command])
+        psql_output = subprocess.run(psql_call, check=True, capture_output=True, text=True)
+        return json.loads(psql_output.stdout)
+
+    def teardown_query(self, label: str) -> None:
+        if not self.options.get("docker"):
+            for statement in UesBackend.TEARDOWN:
+                self.cursor.execute(statement)
+
+
+BACKENDS = {backend.name: backend for backend in [Backend, BaoBackend, AqoBackend, UesBackend]}
+
+
+def run_backend(backend: Backend, workload: Dict[str, str], training: set, orders: List[List[str]], *,
+                reset=False) -> List[Dict[str, Any]]:
+    """Executes all repetitions of the workload on a single system, providing the plan of each query execution."""
+    backend.connect()
+    if reset:
+        backend.reset()
+
+    executions = []
+    for run, order in enumerate(orders, start=1):
+        message(f"Starting run {run} of {backend.name}")
+        for label in order:
+            use_for_training = label in training
+            backend.setup_query(label, training=use_for_training)
+            explain_output = backend.capture_plan(workload[label], training=use_for_training)
+            backend.teardown_query(label)
+            plan = next(entry for entry in explain_output if "Plan" in entry)
+            executions.append({"label": label, "system": backend.name, "run": run, "training": use_for_training,
+                               "plan": plan})
+        backend.finish_run(run)
+
+    backend.close()
+    return executions
+
+
+def normalize_results(executions: List[Dict[str, Any]]) -> pd.DataFrame:
+    """Builds the result table (see RESULT_COLUMNS) of the query executions of all systems."""
+    calculate_cout = helper.load_script(REPO_DIR / "utils" / "calculate-cout.py")
+    plan_batch = calculate_cout.PlanBatch(execution["plan"]["Plan"] for execution in executions)
+    result_df = pd.DataFrame({
+        "label": [execution["label"] for execution in executions],
+        "system": [execution["system"] for execution in executions],
+        "run": [execution["run"] for execution in executions],
+        "training": [execution["training"] for execution in executions],
+        "t_plan": [execution["plan"].get("Planning Time") for execution in executions],
+        "t_exec": [execution["plan"].get("Execution Time") for execution in executions],
+        "cout": plan_batch.cout()
+    })
+    return result_df[RESULT_COLUMNS]
+
+
+def read_spec(spec_file: str) -> Dict[str, Any]:
+    with open(spec_file, "r") as spec:
+        return json.load(spec)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=textwrap.dedent("""\
+        Utility to run the same workload on different optimizers, producing a single result table.
+
+        The workload is described by a JSON spec such as the following:
+
+            {
+                "queries": "job/",
+                "seed": 42,
+                "repetitions": 3,
+                "training_fraction": 0.8,
+                "systems": {
+                    "vanilla": {},
+                    "bao": {"pg_connect": "dbname=imdb port=5432", "reset": true},
+                    "aqo": {"pg_connect": "dbname=imdb port=5433", "reset": true},
+                    "ues": {"pg_connect": "dbname=imdb port=5434", "queries": "ues/sdr-data/JOB-Queries/explicit/"}
+                }
+            }
+
+        Queries are read from a directory of SQL files (labelled by file name) or from a file with one query per line.
+        Each system may use its own queries (e.g. the UES-optimized ones), which are matched by their label. The seed
+        determines the training queries and the (permuted) execution order of each repetition. Without a seed, the
+        original order is kept. Relative paths are resolved against the repository root.
+
+        The result table contains one row per query execution: label, system, run, training, t_plan, t_exec, cout."""))
+    parser.add_argument("spec", action="store", help="JSON file describing the workload and the systems to benchmark")
+    parser.add_argument("--out", "-o", action="store", required=True, help="Name of the output csv file")
+    parser.add_argument("--systems", "-s", action="store", nargs="+", help="Only benchmark the given systems of the spec")
+
+    args = parser.parse_args()
+    spec = read_spec(args.spec)
+    systems = spec.get("systems", {"vanilla": {}})
+    selected_systems = args.systems if args.systems else list(systems.keys())
+    for system in selected_systems:
+        if system not in systems:
+            parser.error(f"System {system} is not part of the spec")
+        if system not in BACKENDS:
+            parser.error(f"Unknown system {system}, available: {', '.join(BACKENDS.keys())}")
+
+    workload = read_workload(REPO_DIR / spec["queries"])
+    training, orders = plan_workload(list(workload.keys()), seed=spec.get("seed"),
+                                     repetitions=spec.get("repetitions", 1),
+                                     training_fraction=spec.get("training_fraction", 1.0))
+
+    executions = []
+    for system in selected_systems:
+        options = systems[system]
+        system_workload = dict(workload)
+        if "queries" in options:
+            system_queries = read_workload(REPO_DIR / options["queries"])
+            missing_labels = set(workload.keys()) - set(system_queries.keys())
+            if missing_labels:
+                raise ValueError(f"Queries of {system} are missing labels: {', '.join(sorted(missing_labels))}")
+            system_workload.update({label: system_queries[label] for label in workload})
+        backend = BACKENDS[system](options)
+        executions.extend(run_backend(backend, system_workload, training, orders, reset=options.get("reset", False)))
+
+    result_df = normalize_results(executions)
+    result_df.to_csv(args.out, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import csv
+import datetime
+import getpass
+import glob
+import os
+import pathlib
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+import timeit
+from typing import Dict, List
+
+import psycopg2 as pg
+
+REPO_DIR = pathlib.Path(__file__).resolve().parent.parent
+BAO_DIR = REPO_DIR / "pg-bao"
+AQO_DIR = REPO_DIR / "pg-aqo"
+
+# template clusters, Postgres binaries and workload runners of the systems, as created by the setup scripts
+SYSTEMS = {
+    "bao": {"data": BAO_DIR / "postgres-bao" / "build" / "data", "bin": BAO_DIR / "postgres-bao" / "build" / "bin",
+            "ctl": BAO_DIR / "postgres-bao-ctl.py", "mode": "bao"},
+    "aqo": {"data": AQO_DIR / "postgres-aqo" / "build" / "data", "bin": AQO_DIR / "postgres-aqo" / "build" / "bin",
+            "ctl": AQO_DIR / "postgres-aqo-ctl.py", "mode": "aqo"},
+    "postgres": {"data": None, "bin": None, "ctl": None, "mode": "psql"},
+}
+
+# actions of postgres-bao-ctl.py and postgres-aqo-ctl.py besides --run-workload
+CTL_ACTIONS = ["--run-workload", "--retrain-bao", "--reset-bao", "--snapshot", "--restore", "--reset-aqo"]
+
+MANIFEST_COLUMNS = ["job", "instance", "port", "pinning", "workload", "output", "log", "start", "end", "duration_s",
+                    "returncode"]
+
+# files of the template BAO server which belong to the running template instance rather than to its state
+BAO_SERVER_IGNORE = shutil.ignore_patterns("__pycache__", "*.log", "*.pid")
+
+
+def message(*args) -> None:
+    print(*args, file=sys.stderr)
+
+
+def port_in_use(port: int) -> bool:
+    try:
+        with socket.create_connection(("localhost", port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def wait_for_port(port: int, timeout=60) -> None:
+    deadline = timeit.default_timer() + timeout
+    while timeit.default_timer() < deadline:
+        if port_in_use(port):
+            return
+        time.sleep(0.1)
+    raise RuntimeError(f"Nothing accepted connections on port {port} within {timeout} seconds")
+
+
+def numa_nodes() -> List[int]:
+    return sorted(int(node[len("/sys/devices/system/node/node"):]) for node in glob.glob("/sys/devices/system/node/node[0-9]*"))
+
+
+def partition_cpus(n_instances: int, cpus_per_instance: int = None) -> List[List[int]]:
+    """Splits the CPUs available to this process into disjoint groups, one per instance.
+
+    If there are not enough CPUs for all instances, the groups wrap around and some instances share their CPUs.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    cpus_per_instance = cpus_per_instance if cpus_per_instance else max(1, len(cpus) // n_instances)
+    if cpus_per_instance * n_instances > len(cpus):
+        message(f".. Only {len(cpus)} CPUs available for {n_instances} instances with {cpus_per_instance} CPUs each, "
+                "some instances will share their CPUs")
+    return [[cpus[(i * cpus_per_instance + j) % len(cpus)] for j in range(cpus_per_instance)] for i in range(n_instances)]
+
+
+def permute_workload(workload_file: str, out_file: pathlib.Path, seed: int) -> None:
+    """Writes a permutation of the workload queries. Comments stay in front, empty lines are dropped."""
+    with open(workload_file, "r") as workload:
+        lines = [line if line.endswith("\n") else line + "\n" for line in workload if line.strip()]
+    comments = [line for line in lines if line.startswith("--")]
+    queries = [line for line in lines if not line.startswith("--")]
+    with open(out_file, "w") as permuted:
+        permuted.writelines(comments + random.Random(seed).sample(queries, k=len(queries)))
+
+
+class Instance:
+    """An isolated Postgres cluster (and BAO server, if required) for a single shard of the campaign.
+
+    Each instance lives in its own working directory, which contains the copy of the template cluster, the logs and,
+    for BAO, a copy of the BAO server with its own experience and models. The processes of an instance are pinned to
+    its CPUs (or to its NUMA node), such that concurrent instances interfere as little as possible.
+    """
+    def __init__(self, number: int, workdir: pathlib.Path, *, system: str, port: int, bao_port: int, cpus: List[int],
+                 numa_node: int = None, pg_bin: pathlib.Path = None, dbname="imdb", settings: Dict[str, str] = None):
+        self.number = number
+        self.workdir = workdir
+        self.data_dir = workdir / "data"
+        self.system = system
+        self.port = port
+        self.bao_port = bao_port
+        self.cpus = cpus
+        self.numa_node = numa_node
+        self.pg_bin = pg_bin
+        self.dbname = dbname
+        self.settings = settings if settings else {}
+
+    @property
+    def pg_connect(self) -> str:
+        return f"dbname={self.dbname} user={getpass.getuser()} host=localhost port={self.port}"
+
+    def pinning(self) -> List[str]:
+        if self.numa_node is not None:
+            return ["numactl", f"--cpunodebind={self.numa_node}", f"--membind={self.numa_node}"]
+        if shutil.which("taskset"):
+            return ["taskset", "-c", ",".join(str(cpu) for cpu in self.cpus)]
+        return []
+
+    def pinned_to(self) -> str:
+        """Describes the pinning that is actually applied (see `pinning`)."""
+        if self.numa_node is not None:
+            return f"node {self.numa_node}"
+        if shutil.which("taskset"):
+            return "cpus " + ",".join(str(cpu) for cpu in self.cpus)
+        return "none"
+
+    def pg_command(self, command: str) -> str:
+        return str(self.pg_bin / command) if self.pg_bin else command
+
+    def create(self, template_dir: pathlib.Path, *, template_port: int, bao_template: pathlib.Path = None,
+               fresh_bao=False) -> None:
+        """Copies the template cluster into the working directory of this instance.
+
+        A stopped template is copied as-is, a running one via pg_basebackup from its port.
+        """
+        self.workdir.mkdir(parents=True, exist_ok=True)
+        if self.data_dir.exists():
+            shutil.rmtree(self.data_dir)
+        if (template_dir / "postmaster.pid").exists():
+            subprocess.run([self.pg_command("pg_basebackup"), "-h", "localhost", "-p", str(template_port),
+                            "-D", str(self.data_dir), "-X", "stream", "-c", "fast"], check=True)
+        else:
+            shutil.copytree(template_dir, self.data_dir, ignore=shutil.ignore_patterns("postmaster.pid", "postmaster.opts"))
+        self.data_dir.chmod(0o700)
+
+        if self.system == "bao":
+            self._create_bao_server(bao_template, fresh=fresh_bao)
+
+    def _create_bao_server(self, bao_template: pathlib.Path, *, fresh: bool) -> None:
+        """Lays out bao/bao_server and bao/bao-venv the way postgres-bao-ctl.py expects them in its working directory."""
+        bao_dir = self.workdir / "bao"
+        server_dir = bao_dir / "bao_server"
+        if server_dir.exists():
+            shutil.rmtree(server_dir)
+        bao_dir.mkdir(exist_ok=True)
+        shutil.copytree(bao_template / "bao_server", server_dir, ignore=BAO_SERVER_IGNORE)
+        if not (bao_dir / "bao-venv").exists():
+            (bao_dir / "bao-venv").symlink_to((bao_template / "bao-venv").resolve())
+        if fresh:
+            for state in [server_dir / "bao.db", *server_dir.glob("bao_*_model")]:
+                if state.is_dir():
+                    shutil.rmtree(state)
+                elif state.exists():
+                    state.unlink()
+
+        config_file = server_dir / "bao.cfg"
+        config = [line for line in config_file.read_text().splitlines()
+                  if not line.strip().startswith(("Port", "PostgreSQLConnectString"))]
+        config.extend([f"Port = {self.bao_port}", f"PostgreSQLConnectString = {self.pg_connect}"])
+        config_file.write_text("\n".join(config) + "\n")
+
+    def start(self) -> None:
+        if port_in_use(self.port):
+            raise RuntimeError(f"Port {self.port} of instance {self.number} is already in use")
+        options = " ".join([f"-p {self.port}"] + [f"-c {name}={value}" for name, value in self.settings.items()])
+        subprocess.run(self.pinning() + [self.pg_command("pg_ctl"), "-D", str(self.data_dir), "-l", str(self.workdir / "pg.log"),
+                                         "-o", options, "-w", "start"], check=True, stdout=subprocess.DEVNULL)
+
+        if self.system == "bao":
+            if port_in_use(self.bao_port):
+                raise RuntimeError(f"BAO port {self.bao_port} of instance {self.number} is already in use")
+            with open(self.workdir / "bao_server.log", "a") as log_file:
+                server = subprocess.Popen(self.pinning() + [str(self.workdir / "bao" / "bao-venv" / "bin" / "python3"), "main.py"],
+                                          cwd=self.workdir / "bao" / "bao_server", stdout=log_file, stderr=subprocess.STDOUT,
+                                          env=dict(os.environ, CUDA_VISIBLE_DEVICES=""), start_new_session=True)
+            # The server is a child of this process, so it has to be reaped as soon as it terminates. Otherwise it would
+            # linger as a zombie and anyone waiting for its PID to disappear (e.g. postgres-bao-ctl.py) would wait forever.
+            threading.Thread(target=server.wait, daemon=True).start()
+            # same PID file as in the system directory, so postgres-bao-ctl.py finds the server of the instance
+            (self.workdir / ".bao_server.pid").write_text(f"{server.pid}\n")
+            wait_for_port(self.bao_port)
+
+            # the extension connects to the BAO server of the template otherwise
+            conn = pg.connect(self.pg_connect)
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f"ALTER DATABASE {self.dbname} SET bao_port = {self.bao_port}")
+            conn.close()
+
+    def stop(self, timeout=30) -> None:
+        pid_file = self.workdir / ".bao_server.pid"
+        if pid_file.exists():
+            pid = int(pid_file.read_text().strip())
+            try:
+                os.kill(pid, signal.SIGINT)
+                deadline = timeit.default_timer() + timeout
+                while timeit.default_timer() < deadline:
+                    os.kill(pid, 0)
+                    time.sleep(0.1)
+                message(f".. BAO server of instance {self.number} did not stop within {timeout} seconds, killing it")
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            pid_file.unlink()
+        if (self.data_dir / "postmaster.pid").exists():
+            subprocess.run([self.pg_command("pg_ctl"), "-D", str(self.data_dir), "-m", "fast", "-w", "stop"],
+                           stdout=subprocess.DEVNULL)
+
+    def remove(self) -> None:
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def command(self, workload: pathlib.Path, output: pathlib.Path, ctl: pathlib.Path, ctl_args: List[str]) -> List[str]:
+        if ctl is None:
+            return self.pinning() + [self.pg_command("psql"), "-h", "localhost", "-p", str(self.port), "-d", self.dbname,
+                                     "-X", "--csv", "-f", str(workload), "-o", str(output)]
+        return self.pinning() + [sys.executable, str(ctl), "--run-workload", "--workload", str(workload),
+                                 "--output", str(output), "--pg-connect", self.pg_connect] + ctl_args
+
+
+def parse_ctl_args(ctl_args: List[str]) -> argparse.Namespace:
+    """Parses the forwarded workload runner arguments that have to be checked, in both the '--opt val' and the
+    '--opt=val' form. Abbreviations are not matched, since they could be prefixes of other runner options."""
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--cache-state", default="as-is")
+    for action in CTL_ACTIONS:
+        parser.add_argument(action, nargs="?", const=True)
+    return parser.parse_known_args(ctl_args)[0]
+
+
+def run_jobs(instance: Instance, jobs: List[Dict], *, template: Dict, ctl: pathlib.Path, ctl_args: List[str],
+             cout_args: List[str]) -> List[Dict]:
+    """Executes the jobs of an instance one after another, providing a manifest entry for each of them.
+
+    Before each job but the first, the instance is re-created from the template (see `Instance.create`, which takes
+    the template arguments), such that no job starts with the state another job left behind.
+    """
+    entries = []
+    env = dict(os.environ, BAO_SERVER_PORT=str(instance.bao_port))
+    for job_idx, job in enumerate(jobs):
+        if job_idx > 0:
+            message(f".. Instance {instance.number}: restoring the template state for {job['name']}")
+            instance.stop()
+            instance.create(**template)
+            instance.start()
+        message(f".. Instance {instance.number}: running {job['name']}")
+        started = datetime.datetime.now()
+        start = timeit.default_timer()
+        with open(job["log"], "w") as log_file:
+            result = subprocess.run(instance.command(job["workload"], job["output"], ctl, ctl_args), cwd=instance.workdir,
+                                    env=env, stdout=log_file, stderr=subprocess.STDOUT)
+        duration = timeit.default_timer() - start
+        if result.returncode != 0:
+            message(f".. Instance {instance.number}: {job['name']} failed with exit code {result.returncode}, see {job['log']}")
+        elif cout_args is not None:
+            subprocess.run([sys.executable, str(REPO_DIR / "utils" / "calculate-cout.py"), "--plans", str(job["output"]),
+                            "--queries", str(job["workload"]), "--out", str(job["cout"])] + cout_args, check=True)
+        entries.append({"job": job["name"], "instance": instance.number, "port": instance.port,
+                        "pinning": instance.pinned_to(), "workload": job["workload"],
+                        "output": job["output"], "log": job["log"], "start": started.isoformat(timespec="seconds"),
+                        "end": datetime.datetime.now().isoformat(timespec="seconds"), "duration_s": round(duration, 3),
+                        "returncode": result.returncode})
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=textwrap.dedent("""\
+        Utility to run independent repetitions of a workload in parallel, each on its own Postgres instance.
+
+        All instances are copies of the same template cluster (including BAO's experience and models, or AQO's
+        knowledge base) on separate ports. Their processes are pinned to disjoint sets of CPUs (or NUMA nodes), so a
+        campaign takes roughly as long as a single run rather than the sum of all runs. The repetitions are distributed
+        round-robin across the instances, each instance runs its share sequentially and is restored from the template before
+        each of its runs, such that all repetitions are independent.
+
+        For example, the following runs three BAO repetitions of the JOB workload at once and calculates their C_out:
+
+            utils/run-sharded.py --system bao --instances 3 --repetitions 3 \\
+                --workload pg-bao/workloads/job-full.sql --out-dir campaign --cout -- --retrain 25
+
+        All arguments after '--' are passed on to the workload runner of the system. The results are written to the
+        output directory, next to a manifest (campaign.csv) listing the instance, pinning, timing and output of each run."""))
+    parser.add_argument("--system", action="store", choices=list(SYSTEMS), default="bao", help="System to run the workload on. 'bao' and 'aqo' use the workload runners of their directories, 'postgres' runs the workload through psql. Defaults to 'bao'.")
+    parser.add_argument("--workload", "-w", action="store", required=True, help="File containing the workload queries (one per line)")
+    parser.add_argument("--out-dir", "-o", action="store", required=True, help="Directory to write the results, logs and the campaign manifest to. Also contains the working directories of the instances.")
+    parser.add_argument("--name", action="store", help="Prefix of the result files, which are named <name>-run<i>.out. Defaults to the name of the workload file.")
+    parser.add_argument("--instances", "-n", action="store", type=int, default=2, help="Number of Postgres instances to run in parallel. Defaults to 2.")
+    parser.add_argument("--repetitions", "-r", action="store", type=int, default=None, help="Number of workload runs. Defaults to one per instance.")
+    parser.add_argument("--permute", metavar="SEED", action="store", type=int, help="Run a different permutation of the workload queries in each repetition, derived from the given seed. By default, all repetitions run the queries in their original order.")
+    parser.add_argument("--template", action="store", help="Data directory of the template cluster. Defaults to the cluster created by the setup script of the system, required for 'postgres'.")
+    parser.add_argument("--template-port", action="store", type=int, default=5432, help="Port of the template cluster. Only used if the template is running, in which case it is copied via pg_basebackup. Defaults to 5432.")
+    parser.add_argument("--pg-bin", action="store", help="Directory containing the Postgres binaries (pg_ctl, pg_basebackup, psql). Defaults to the binaries of the system, or the ones on the PATH.")
+    parser.add_argument("--bao-dir", action="store", default=str(BAO_DIR / "bao"), help="Directory containing the template BAO server (bao_server) and its virtual environment (bao-venv). Defaults to pg-bao/bao.")
+    parser.add_argument("--fresh-bao", action="store_true", help="Start each BAO server without any experience or models, rather than with the ones of the template.")
+    parser.add_argument("--dbname", action="store", default="imdb", help="Database to run the workload on. Defaults to imdb.")
+    parser.add_argument("--base-port", action="store", type=int, default=5440, help="Port of the first instance, the following instances use the next ports. Defaults to 5440.")
+    parser.add_argument("--bao-base-port", action="store", type=int, default=9390, help="Port of the BAO server of the first instance. Defaults to 9390.")
+    parser.add_argument("--cpus-per-instance", action="store", type=int, help="Number of CPUs to pin each instance to. Defaults to an even split of the available CPUs.")
+    parser.add_argument("--numa", action="store_true", help="Pin each instance to the CPUs and memory of a NUMA node (via numactl) rather than to a set of CPUs.")
+    parser.add_argument("--shared-buffers", action="store", help="Size of the buffer cache of each instance, e.g. 4GB. Keep in mind that all instances share the memory of the machine. Defaults to the setting of the template.")
+    parser.add_argument("--pg-setting", metavar="NAME=VALUE", action="append", default=[], help="Additional server setting for all instances, may be given multiple times.")
+    parser.add_argument("--cout", action="store_true", help="Calculate the C_out of each run (see calculate-cout.py), written to <name>-run<i>-cout.csv.")
+    parser.add_argument("--sources", "-s", action="store", help="Directory containing the raw query files, to label the results of --cout.")
+    parser.add_argument("--keep-instances", action="store_true", help="Keep the data directories of the instances after the campaign. By default, they are removed.")
+    parser.add_argument("ctl_args", nargs=argparse.REMAINDER, help="Arguments for the workload runner (postgres-bao-ctl.py or postgres-aqo-ctl.py), after '--'")
+
+    args = parser.parse_args()
+    system = SYSTEMS[args.system]
+    ctl_args = args.ctl_args[1:] if args.ctl_args[:1] == ["--"] else args.ctl_args
+    if ctl_args and not system["ctl"]:
+        parser.error("Workload runner arguments are not supported for 'postgres'")
+    forwarded_args = parse_ctl_args(ctl_args)
+    # cold caches restart the Postgres instance of the system directory, which would interfere with all shards
+    if forwarded_args.cache_state == "cold":
+        parser.error("--cache-state cold is not supported, since dropping the OS page cache affects all instances")
+    # the runner always runs the workload, all other actions of the workload runners are exclusive to it
+    actions = [action for action in CTL_ACTIONS if getattr(forwarded_args, action[2:].replace("-", "_")) is not None]
+    if actions:
+        parser.error(f"{', '.join(actions)} cannot be passed on to the workload runner, use --fresh-bao to start without experience")
+
+    template_dir = pathlib.Path(args.template) if args.template else system["data"]
+    if template_dir is None:
+        parser.error("--template is required for 'postgres'")
+    if not template_dir.exists():
+        parser.error(f"Template cluster {template_dir} does not exist")
+    pg_bin = pathlib.Path(args.pg_bin) if args.pg_bin else system["bin"]
+    if pg_bin is not None and not pg_bin.exists():
+        pg_bin = None
+
+    settings = dict(setting.split("=", 1) for setting in args.pg_setting)
+    if args.shared_buffers:
+        settings["shared_buffers"] = args.shared_buffers
+
+    out_dir = pathlib.Path(args.out_dir).resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    name = args.name if args.name else pathlib.Path(args.workload).stem
+    repetitions = args.repetitions if args.repetitions else args.instances
+    n_instances = min(args.instances, repetitions)
+
+    jobs = []
+    for run in range(1, repetitions + 1):
+        workload = pathlib.Path(args.workload).resolve()
+        if args.permute is not None:
+            workload = out_dir / f"{name}-run{run}.sql"
+            permute_workload(args.workload, workload, args.permute + run)
+        jobs.append({"name": f"{name}-run{run}", "workload": workload, "output": out_dir / f"{name}-run{run}.out",
+                     "log": out_dir / f"{name}-run{run}.log", "cout": out_dir / f"{name}-run{run}-cout.csv"})
+
+    nodes = numa_nodes() if args.numa else []
+    if args.numa and not nodes:
+        parser.error("No NUMA nodes found")
+    cpu_groups = partition_cpus(n_instances, args.cpus_per_instance)
+    instances = [Instance(i, out_dir / f"instance-{i}", system=args.system, port=args.base_port + i,
+                          bao_port=args.bao_base_port + i, cpus=cpu_groups[i],
+                          numa_node=nodes[i % len(nodes)] if nodes else None, pg_bin=pg_bin, dbname=args.dbname,
+                          settings=settings)
+                 for i in range(n_instances)]
+
+    cout_args = None
+    if args.cout:
+        cout_args = ["--mode", system["mode"]] + (["--sources", args.sources] if args.sources else [])
+
+    template = {"template_dir": template_dir, "template_port": args.template_port,
+                "bao_template": pathlib.Path(args.bao_dir), "fresh_bao": args.fresh_bao}
+    entries = []
+    start = timeit.default_timer()
+    try:
+        for instance in instances:
+            message(f".. Creating instance {instance.number} on port {instance.port} (pinned to {instance.pinned_to()})")
+            instance.create(**template)
+            instance.start()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_instances) as executor:
+            futures = [executor.submit(run_jobs, instance, jobs[instance.number::n_instances], template=template,
+                                       ctl=system["ctl"], ctl_args=ctl_args, cout_args=cout_args)
+                       for instance in instances]
+            for future in futures:
+                entries.extend(future.result())
+    finally:
+        for instance in instances:
+            instance.stop()
+            if not args.keep_instances:
+                instance.remove()
+
+    campaign_time = timeit.default_timer() - start
+    job_names = [job["name"] for job in jobs]
+    entries.sort(key=lambda entry: job_names.index(entry["job"]))
+    with open(out_dir / "campaign.csv", "w", newline="") as manifest_file:
+        writer = csv.DictWriter(manifest_file, fieldnames=MANIFEST_COLUMNS)
+        writer.writeheader()
+        writer.writerows(entries)
+
+    run_time = sum(entry["duration_s"] for entry in entries)
+    failed_runs = [entry["job"] for entry in entries if entry["returncode"] != 0]
+    message(f".. {len(entries)} runs on {n_instances} instances took {campaign_time:.0f} s "
+            f"({run_time:.0f} s if run sequentially)")
+    if failed_runs:
+        message(f".. Failed runs: {', '.join(failed_runs)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
 import os
 import pathlib
 import textwrap
+import timeit
+from typing import List
+
+import psycopg2 as pg
+from psycopg2 import sql
+
+DEFAULT_JOBS = min(8, os.cpu_count() or 1)
 
 
 def load_online(out: str, source="http://homepages.cwi.nl/~boncz/job/imdb.tgz") -> None:
@@ -16,52 +24,145 @@ def load_online(out: str, source="http://homepages.cwi.nl/~boncz/job/imdb.tgz")
     print(".. Download done")
 
 
-def postgres_setup(source_dir: str) -> None:
+def load_table(pg_connect: str, data_file: pathlib.Path) -> None:
+    """Streams a single CSV file into the table of the same name, reporting the throughput afterwards."""
+    table = data_file.stem
+    start_time = timeit.default_timer()
+    with pg.connect(pg_connect) as conn, conn.cursor() as cursor, data_file.open("rb") as data:
+        cursor.copy_expert(f"COPY {table} FROM STDIN WITH CSV QUOTE '\"' ESCAPE '\\'", data)
+        rows = cursor.rowcount
+    conn.close()
+    runtime = timeit.default_timer() - start_time
+    size_mb = data_file.stat().st_size / 1024**2
+    print(f".. Imported {table}: {rows} rows in {runtime:.1f}s ({rows / runtime:.0f} rows/s, {size_mb / runtime:.1f} MB/s)")
+
+
+def run_parallel(pg_connect: str, statements: List[str], *, jobs=DEFAULT_JOBS) -> None:
+    """Executes independent statements (e.g. CREATE INDEX) on multiple connections at the same time."""
+    def run_statement(statement: str) -> None:
+        with pg.connect(pg_connect) as conn, conn.cursor() as cursor:
+            cursor.execute(statement)
+        conn.close()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        # consume the results to raise errors of the individual statements
+        list(executor.map(run_statement, statements))
+
+
+def analyze(pg_connect: str) -> None:
+    print(".. Updating statistics")
+    conn = pg.connect(pg_connect)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    conn.close()
+
+
+def create_database(pg_connect: str) -> None:
+    """Creates the database of the connect string on the server it refers to, unless it exists already."""
+    params = pg.extensions.parse_dsn(pg_connect)
+    if "dbname" not in params:
+        raise ValueError(f"The connect string does not name a database: {pg_connect}")
+    # the database itself does not exist yet, so the maintenance database of the server is used instead
+    conn = pg.connect(**dict(params, dbname="postgres"))
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s", (params["dbname"],))
+        if cursor.fetchone():
+            print(f".. Database {params['dbname']} exists already")
+        else:
+            cursor.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(params["dbname"])))
+    conn.close()
+
+
+def postgres_setup(source_dir: str, *, pg_connect="dbname=imdb", jobs=DEFAULT_JOBS, unlogged=False) -> List[str]:
+    """Creates the IMDB database and imports all tables, providing the names of the tables."""
     print(".. Creating database")
-    os.system("createdb imdb")
-    os.system("psql imdb -f {wdir}/schematext.sql".format(wdir=source_dir))
-
+    create_database(pg_connect)
     source_path = pathlib.Path(source_dir)
-    data_files = source_path.glob("*.csv")
-    for data_file in data_files:
-        print(".. Now importing", data_file)
-        table = data_file.stem
-        os.system("""psql imdb -c "\copy {table} from {source} with csv quote '\\"' escape '\\';" """.format(table=table, source=data_file))
+    with pg.connect(pg_connect) as conn, conn.cursor() as cursor, (source_path / "schematext.sql").open("r") as schema:
+        cursor.execute(schema.read())
+    conn.close()
+
+    # load the largest tables first, such that they do not end up as the stragglers of the parallel import
+    data_files = sorted(source_path.glob("*.csv"), key=lambda data_file: data_file.stat().st_size, reverse=True)
+
+    if unlogged:
+        # unlogged tables skip the WAL, which speeds up the import considerably. They are switched back to logged
+        # tables once all data and indices are in place (see `set_logged`).
+        print(".. Switching tables to UNLOGGED")
+        run_parallel(pg_connect, [f"ALTER TABLE {data_file.stem} SET UNLOGGED" for data_file in data_files], jobs=jobs)
 
+    print(f".. Importing {len(data_files)} tables using {jobs} connections")
+    start_time = timeit.default_timer()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(lambda data_file: load_table(pg_connect, data_file), data_files))
+    print(f".. Import done after {timeit.default_timer() - start_time:.1f}s")
+    return [data_file.stem for data_file in data_files]
 
-def create_fkeys(out: str) -> None:
+
+def set_logged(pg_connect: str, tables: List[str], *, jobs=DEFAULT_JOBS) -> None:
+    """Switches unlogged tables (and their indices) back to logged tables.
+
+    Unlogged tables are truncated after a crash and skipped by pg_basebackup, i.e. copies of the instance (such as the
+    templates of utils/run-sharded.py) would end up with empty tables. Switching writes each table to the WAL once.
+    """
+    print(f".. Switching {len(tables)} tables to LOGGED")
+    start_time = timeit.default_timer()
+    run_parallel(pg_connect, [f"ALTER TABLE {table} SET LOGGED" for table in tables], jobs=jobs)
+    print(f".. Tables switched after {timeit.default_timer() - start_time:.1f}s")
+
+
+def create_fkeys(out: str, *, pg_connect="dbname=imdb", jobs=DEFAULT_JOBS) -> None:
     fkeys_spec = "https://raw.githubusercontent.com/gregrahn/join-order-benchmark/master/fkindexes.sql"
     fkey_src = "imdb-fkeys.sql"
     fkey_path = out + "/" + fkey_src
     print(f".. Fetching Foreign keys specification from {fkeys_spec}")
     os.system(f"wget -nv --output-document {fkey_path} {fkeys_spec}")
-    print(".. Creating foreign key indices")
-    os.system(f"psql imdb -f {fkey_path}")
+
+    with open(fkey_path, "r") as fkey_file:
+        statements = [stmt.strip() for stmt in fkey_file.read().split(";") if stmt.strip()]
+    print(f".. Creating {len(statements)} foreign key indices using {jobs} connections")
+    start_time = timeit.default_timer()
+    run_parallel(pg_connect, statements, jobs=jobs)
+    print(f".. Indices created after {timeit.default_timer() - start_time:.1f}s")
 
 
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=textwrap.dedent("""\
         Utility to create IMDB database instances for PostgreSQL
 
-        When running this script, the PostgreSQL server has to be running and accessible via the `psql` command. Furthermore, utilities
-        such as `createdb` have to be on the PATH as well."""))
+        When running this script, the PostgreSQL server has to be running and accessible via the --pg-connect string. The database
+        is created on that server if it does not exist yet. Downloading the data set and the foreign keys requires wget."""))
     arg_grp = parser.add_mutually_exclusive_group()
     arg_grp.add_argument("--online", action="store_true", help="If set, download the IMDB data set")
     arg_grp.add_argument("--source", action="store", help="Directory to load the raw IMDB data set from")
     arg_grp.add_argument("--fkeys", action="store_true", help="Don't setup a new IMDB instance, but create foreign keys for an existing one.")
     parser.add_argument("--target", action="store", default="imdb", help="Directory to store the raw IMDB data in, if downloading from network")
+    parser.add_argument("--with-fkeys", action="store_true", help="Create the foreign key indices right after setting up a new IMDB instance.")
+    parser.add_argument("--jobs", "-j", action="store", type=int, default=DEFAULT_JOBS, help=f"Number of connections to import the tables and to create the indices with. Defaults to {DEFAULT_JOBS}.")
+    parser.add_argument("--unlogged", action="store_true", help="Import all tables as UNLOGGED, i.e. without writing the WAL. This speeds up the import and the creation of the foreign key indices. Afterwards, the tables are switched back to LOGGED, such that they survive crashes and backups.")
+    parser.add_argument("--pg-connect", "-c", metavar="connect", action="store", default="dbname=imdb", help="Custom Postgres connect string for the IMDB database")
 
     args = parser.parse_args()
 
     # if we should load foreign keys, only do so without the actual database setup
     if args.fkeys:
-        create_fkeys(args.target)
+        create_fkeys(args.target, pg_connect=args.pg_connect, jobs=args.jobs)
+        analyze(args.pg_connect)
         return
 
     source_dir = args.target if args.online else args.source
     if args.online:
         load_online(args.target)
-    postgres_setup(source_dir)
+    tables = postgres_setup(source_dir, pg_connect=args.pg_connect, jobs=args.jobs, unlogged=args.unlogged)
+    if args.with_fkeys:
+        create_fkeys(source_dir, pg_connect=args.pg_connect, jobs=args.jobs)
+    if args.unlogged:
+        set_logged(args.pg_connect, tables, jobs=args.jobs)
+
+    # statistics are only computed once all data and indices are in place
+    analyze(args.pg_connect)
 
 
 if __name__ == "__main__":
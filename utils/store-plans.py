@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import pathlib
+import sys
+
+import helper
+import plan_store
+
+
+def run_name(plans_file: str) -> str:
+    name = pathlib.Path(plans_file).name
+    for suffix in [".plans.gz", ".gz"]:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return pathlib.Path(name).stem
+
+
+def add(args: argparse.Namespace) -> None:
+    calculate_cout = helper.load_script(pathlib.Path(__file__).parent / "calculate-cout.py")
+    labels = None
+    if args.queries and args.sources:
+        labels_map = calculate_cout.read_query_sources(args.sources)
+        labels = [labels_map.get(calculate_cout.normalize_query(q), "") for q in calculate_cout.read_queries(args.queries)]
+
+    store = plan_store.PlanStore(args.store)
+    known_runs = set(store.runs())
+    # all runs are checked up front, such that nothing is stored if one of them is rejected
+    for plans_file in args.plans:
+        run = run_name(plans_file)
+        if run in known_runs:
+            sys.exit(f"Run {run} is already part of the store (or given twice)")
+        known_runs.add(run)
+
+    n_shapes = len(store.shapes)
+    for plans_file in args.plans:
+        run = run_name(plans_file)
+        decoder = calculate_cout.PLAN_DECODERS[args.mode]
+        query_plans = map(decoder, calculate_cout.read_raw_plans(plans_file, args.mode))
+        n_plans = store.add_run(query_plans, run=run, labels=labels)
+        print(f"Added {n_plans} plans of run {run}", file=sys.stderr)
+    store.save()
+    print(f"{len(store)} plans, {len(store.shapes)} distinct shapes ({len(store.shapes) - n_shapes} new)", file=sys.stderr)
+
+
+def distinct(args: argparse.Namespace) -> None:
+    store = plan_store.PlanStore(args.store)
+    if args.label:
+        label = int(args.label) if args.key == "position" else args.label
+        print(store.plan_frequencies(label, key=args.key).to_string(index=False))
+    else:
+        print(store.distinct_plans(key=args.key).to_string(index=False))
+
+
+def show(args: argparse.Namespace) -> None:
+    store = plan_store.PlanStore(args.store)
+    if args.fingerprint not in store.shapes:
+        sys.exit(f"Unknown plan: {args.fingerprint}")
+    print(json.dumps(store.shapes[args.fingerprint], indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Utility to collect the plans of repeated workload runs in a deduplicated plan store, which keeps each distinct plan shape only once.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    add_parser = subparsers.add_parser("add", help="Add the plans of one or more workload runs to a store.")
+    add_parser.add_argument("store", action="store", help="Directory of the store, created if it does not exist yet")
+    add_parser.add_argument("plans", action="store", nargs="+", help="File(s) containing the EXPLAIN ANALYZE output, one per run. The runs are named after the files.")
+    add_parser.add_argument("--mode", "-m", action="store", choices=["psql", "bao", "aqo"], default="psql", help="Format of the EXPLAIN ANALYZE output, see calculate-cout.py. Defaults to 'psql'.")
+    add_parser.add_argument("--queries", "-q", action="store", help="File containing the actual queries. Together with --sources, this labels the plans.")
+    add_parser.add_argument("--sources", "-s", action="store", help="Directory containing the raw query files (before merging), file names will be used as labels.")
+    add_parser.set_defaults(action=add)
+
+    distinct_parser = subparsers.add_parser("distinct", help="Print the number of distinct plans of each query across all runs.")
+    distinct_parser.add_argument("store", action="store", help="Directory of the store")
+    distinct_parser.add_argument("--label", "-l", action="store", help="Rather than counting the plans of all queries, list the plans of the query with this label")
+    distinct_parser.add_argument("--key", "-k", action="store", choices=["label", "position"], default="label", help="Identify the queries by their label or by their position in the workload (e.g. if the plans have not been labelled). Defaults to label.")
+    distinct_parser.set_defaults(action=distinct)
+
+    show_parser = subparsers.add_parser("show", help="Print the shape of a plan.")
+    show_parser.add_argument("store", action="store", help="Directory of the store")
+    show_parser.add_argument("fingerprint", action="store", help="Fingerprint of the plan")
+    show_parser.set_defaults(action=show)
+
+    args = parser.parse_args()
+    args.action(args)
+
+
+if __name__ == "__main__":
+    main()
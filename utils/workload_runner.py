@@ -0,0 +1,238 @@
+"""Helpers shared by the workload runners of BAO (pg-bao/postgres-bao-ctl.py) and AQO (pg-aqo/postgres-aqo-ctl.py)."""
+
+import contextlib
+import csv
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+import timeit
+import warnings
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import psycopg2 as pg
+
+SELECT_QUERY_PREFIX = "select"
+EXPLAIN_QUERY_PREFIX = "explain"
+COMMENT_PREFIX = "--"
+
+CACHE_STATES = ["as-is", "warm", "cold"]
+TRAINING_SELECTIONS = ["uniform", "stratified"]
+
+QUIET = False
+
+
+def message(*contents: str) -> None:
+    """print for stderr."""
+    global QUIET
+
+    if QUIET:
+        return
+    print(*contents, file=sys.stderr)
+
+
+def is_workload_query(query: str) -> bool:
+    normalized = query.lower()
+    return normalized.startswith(SELECT_QUERY_PREFIX) or normalized.startswith(EXPLAIN_QUERY_PREFIX)
+
+
+def simplify_query(query: str) -> str:
+    """Deletes all leading statements of a query up to the first SELECT statement (e.g. EXPLAIN)."""
+    if not is_workload_query(query):
+        return query
+
+    select_stmt_idx = query.lower().find(SELECT_QUERY_PREFIX)
+    if select_stmt_idx >= 0:
+        return query[select_stmt_idx:]
+    else:
+        # query is already simplified
+        return query
+
+
+def plan_relations(plan: Dict[Any, Any]) -> List[str]:
+    """Collects the names of all relations and indexes a query plan accesses."""
+    relations = []
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop()
+        for key in ("Relation Name", "Index Name"):
+            if key in node and node[key] not in relations:
+                relations.append(node[key])
+        nodes.extend(node.get("Plans", []))
+    return relations
+
+
+def read_raw_workload(workload: str) -> List[str]:
+    contents = []
+    with open(workload, "r") as workload_file:
+        contents = workload_file.readlines()
+
+    return [query for query in contents if not query.startswith(COMMENT_PREFIX)]
+
+
+def read_queries_for_training(workload: List[str], src: str) -> List[Tuple[str, bool]]:
+    training_df = pd.read_csv(src)
+    workload_df = pd.DataFrame({"query": workload})
+    merged_df = workload_df.merge(training_df, how="left")
+    if merged_df.training.isna().any():
+        missing_count = merged_df.training.isna().sum()
+        warnings.warn(f"Could not completely reconstruct training information. Excluding missing queries from training. {missing_count} queries affected.")
+        merged_df.training.fillna(value=False, inplace=True)
+    return list(zip(merged_df["query"], merged_df.training))
+
+
+def select_queries_for_training(workload: List[str], training_fraction: float, *, strategy="uniform",
+                                strata: List[str] = None, weights: List[float] = None,
+                                seed: int = None) -> List[Tuple[str, bool]]:
+    """Chooses a fraction of the workload queries for training, annotating each query accordingly.
+
+    The 'uniform' strategy samples from all lines of the workload. The 'stratified' strategy draws from each stratum
+    (one per line, e.g. the query templates) in proportion to its size, but at least one query per stratum as long as
+    the training budget allows. If weights are given (one per line), queries are drawn with probability proportional
+    to their weight, e.g. their baseline runtime, such that expensive queries are preferred. In both cases, only
+    workload queries are considered. The seed makes the selection reproducible.
+    """
+    n_queries = len(workload)
+    num_training_queries = math.ceil(training_fraction * n_queries)
+    if strategy == "uniform" and weights is None:
+        sampler = random.Random(seed) if seed is not None else random
+        training_idx = sampler.sample(range(n_queries), k=num_training_queries)
+    else:
+        rng = np.random.default_rng(seed)
+        candidates = np.array([idx for idx, query in enumerate(workload) if is_workload_query(query)], dtype=int)
+        num_training_queries = min(math.ceil(training_fraction * len(candidates)), len(candidates))
+        weights = np.asarray(weights, dtype=float)[candidates] if weights is not None else np.ones(len(candidates))
+        strata = np.asarray(strata)[candidates] if strategy == "stratified" else np.zeros(len(candidates))
+        training_idx = []
+        for stratum_candidates, n_selected in zip(*allocate_strata(strata, num_training_queries, rng=rng)):
+            stratum_weights = weights[stratum_candidates]
+            training_idx.extend(candidates[rng.choice(stratum_candidates, size=n_selected, replace=False,
+                                                      p=stratum_weights / stratum_weights.sum())])
+
+    query_idx = np.full(n_queries, fill_value=False, dtype=bool)
+    query_idx[training_idx] = True
+    annotated_queries = zip(workload, query_idx)
+    return list(annotated_queries)
+
+
+def allocate_strata(strata: np.ndarray, n_selected: int, *, rng: np.random.Generator) -> Tuple[List[np.ndarray], List[int]]:
+    """Distributes n_selected queries among the strata, providing the members of each stratum and its share.
+
+    Each stratum receives one query first (randomly chosen strata, if there are more strata than queries). The rest is
+    allocated in proportion to the remaining size of the strata, rounding by the largest remainder.
+    """
+    __, stratum_ids = np.unique(strata, return_inverse=True)
+    members = [np.flatnonzero(stratum_ids == stratum) for stratum in range(stratum_ids.max() + 1)] if len(strata) else []
+    sizes = np.array([len(stratum_members) for stratum_members in members], dtype=int)
+    shares = np.zeros(len(members), dtype=int)
+    if n_selected < len(members):
+        shares[rng.choice(len(members), size=n_selected, replace=False)] = 1
+        return members, shares.tolist()
+
+    shares += 1
+    remaining_sizes = sizes - shares
+    n_remaining = n_selected - len(members)
+    if n_remaining > 0:
+        quotas = n_remaining * remaining_sizes / remaining_sizes.sum()
+        shares += np.floor(quotas).astype(int)
+        leftover = n_selected - shares.sum()
+        shares[np.argsort(-(quotas - np.floor(quotas)), kind="stable")[:leftover]] += 1
+    return members, np.minimum(shares, sizes).tolist()
+
+
+def write_training_status(workload: List[Tuple[str, bool]], out: str) -> None:
+    training_df = pd.DataFrame(workload, columns=["query", "training"])
+    training_df.to_csv(out, index=False)
+
+
+@contextlib.contextmanager
+def measure(timings: Dict[str, float], key: str):
+    """Adds the wall time (in ms) spent in the context to the timing with the given key."""
+    start_time = timeit.default_timer()
+    try:
+        yield
+    finally:
+        timings[key] = timings.get(key, 0) + (timeit.default_timer() - start_time) * 1000
+
+
+class MetricsLog:
+    """Writes one record of measurements per workload action, as the workload progresses.
+
+    The format is determined by the file suffix: CSV for .csv files and JSON lines otherwise. Each record is flushed
+    immediately. All times are given in ms. The runners define the FIELDS of their records.
+    """
+    FIELDS = ["timestamp", "action", "index"]
+
+    def __init__(self, path: str, *, append=False):
+        self.metrics_file = open(path, "a" if append else "w", newline="")
+        self.csv_writer = None
+        if path.endswith(".csv"):
+            self.csv_writer = csv.DictWriter(self.metrics_file, fieldnames=self.FIELDS, lineterminator="\n")
+            if not append or not self.metrics_file.tell():
+                self.csv_writer.writeheader()
+        self.lock = threading.Lock()
+
+    def log(self, action: str, **data: Any) -> None:
+        record = dict(timestamp=time.time(), action=action, **data)
+        with self.lock:
+            if self.csv_writer:
+                self.csv_writer.writerow(record)
+            else:
+                self.metrics_file.write(json.dumps(record) + "\n")
+            self.metrics_file.flush()
+
+    def close(self) -> None:
+        self.metrics_file.close()
+
+
+class CacheControl:
+    """Establishes the cache state each workload query is measured in.
+
+    'as-is' leaves the caches alone. For 'warm', all relations and indexes of the query plan are loaded into the
+    buffer cache via pg_prewarm. For 'cold', Postgres is restarted to empty the buffer cache and the OS page cache is
+    dropped via drop-caches.bin (see utils/drop-caches). The runners implement `prepare`, which obtains the plan or
+    re-establishes the connection in their own way.
+    """
+    def __init__(self, state="as-is", *, pg_connect: str = None, restart_cmd: str = None):
+        self.state = state
+        self.pg_connect = pg_connect
+        self.restart_cmd = restart_cmd
+        self.drop_caches = shutil.which("drop-caches.bin")
+        if state == "cold" and not self.drop_caches:
+            warnings.warn("drop-caches.bin not found on the PATH (see utils/drop-caches). Only the Postgres buffer "
+                          "cache will be emptied for cold runs.")
+        if state == "warm":
+            # The extension is created once, on a separate connection that commits right away. Creating it in each
+            # session instead would block all further sessions until the transaction of the first one ends.
+            conn = pg.connect(pg_connect)
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_prewarm")
+            conn.close()
+        self.connections = []
+
+    def prewarm(self, cursor: "pg.cursor", plan: Dict[Any, Any]) -> None:
+        """Loads all relations and indexes of the plan into the buffer cache."""
+        for relation in plan_relations(plan):
+            cursor.execute("SELECT pg_prewarm(%s)", (relation,))
+
+    def empty_caches(self) -> "pg.connection":
+        """Restarts Postgres and drops the OS page cache, providing a new connection to the restarted server."""
+        quiet = "> /dev/null" if QUIET else ""
+        os.system(f"{self.restart_cmd} {quiet}")
+        os.system("sync")
+        if self.drop_caches:
+            os.system(self.drop_caches)
+        conn = pg.connect(self.pg_connect)
+        self.connections.append(conn)
+        return conn
+
+    def close(self) -> None:
+        for conn in self.connections:
+            conn.close()